@@ -1,59 +1,309 @@
 from tkinter import *
+import csv
+import os
+import queue
+from itertools import islice
 import sqlite3
+import threading
+import time
 from PIL import Image, ImageTk
-from tkinter import ttk
+from tkinter import ttk, filedialog, messagebox
+from contact_files import FIELDS, read_csv, read_vcards, write_vcard
+from duplicates import blocking_keys, duplicate_score
 
 root = Tk()
 root.title("Address Book")
 root.iconphoto(True, ImageTk.PhotoImage(Image.open('D:/git/learning-stuff/image_view/logo.png').resize((32, 32), Image.Resampling.LANCZOS)))
 
-# Connect to the SQLite database
-conn = sqlite3.connect('addressbook.db')
-c = conn.cursor()
-
-# Create the table if it does not exist
-c.execute("""
-CREATE TABLE IF NOT EXISTS addresses (
-    fname text,
-    lname text,
-    address text,
-    city text,
-    state text,
-    zip integer
-)
-""")
-conn.commit()
-
-
-# Function to delete a selected record
-def delete():
-    selected_item = tree.selection()  # Get the selected item in the Treeview
-    if selected_item:  # Check if any item is selected
-        # Get the values of the selected row
-        selected_row = tree.item(selected_item)["values"]
-        # The selected_row contains (fname, lname, address, city, state, zip),
-        # we need to delete it from the database based on the primary key (oid)
-
-        # Retrieve the database record's ID (assuming `oid` is the primary key)
-        c.execute("SELECT rowid FROM addresses WHERE fname = ? AND lname = ? AND address = ?",
-                  (selected_row[0], selected_row[1], selected_row[2]))
-        record = c.fetchone()
+# Every SQLite call runs on one worker thread, which owns the connection, so
+# a slow disk or a lock held by another program never freezes the window.
+# The UI queues jobs with run_db(); results come back through db_results and
+# are handed to their callbacks on the Tk thread by poll_db(). Writes that
+# pile up while the worker is busy are committed together in one transaction.
+DATABASE = 'addressbook.db'
+LOCK_TIMEOUT = 30  # Seconds to wait for another program's lock; the window stays usable meanwhile
+POLL_MS = 20  # How often the Tk thread picks up finished jobs
+PENDING_DELAY_MS = 200  # Only show the pending indicator once a job takes longer than this
+
+# Full-text index for the search box, kept in step with the table by triggers.
+# The prefix option indexes 2 and 3 letter prefixes so search-as-you-type
+# queries stay fast on short input. SQLite builds without FTS5 fall back to
+# a LIKE scan.
+FTS_INSERT_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS addresses_fts_insert AFTER INSERT ON addresses BEGIN
+    INSERT INTO addresses_fts (rowid, fname, lname, address, city)
+    VALUES (new.rowid, new.fname, new.lname, new.address, new.city);
+END
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS addresses_fts USING fts5 (
+    fname, lname, address, city, content='addresses', content_rowid='rowid', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS addresses_fts_delete AFTER DELETE ON addresses BEGIN
+    INSERT INTO addresses_fts (addresses_fts, rowid, fname, lname, address, city)
+    VALUES ('delete', old.rowid, old.fname, old.lname, old.address, old.city);
+END;
+CREATE TRIGGER IF NOT EXISTS addresses_fts_update AFTER UPDATE ON addresses BEGIN
+    INSERT INTO addresses_fts (addresses_fts, rowid, fname, lname, address, city)
+    VALUES ('delete', old.rowid, old.fname, old.lname, old.address, old.city);
+    INSERT INTO addresses_fts (rowid, fname, lname, address, city)
+    VALUES (new.rowid, new.fname, new.lname, new.address, new.city);
+END;
+""" + FTS_INSERT_TRIGGER
+
+# Duplicate detection. Each record gets blocking keys in dedup_keys: "n" +
+# zip + Soundex of the surname, "a" + zip + "#" + house number, and "a" +
+# zip + each trigram of the street name (without words like "st" or "apt"). Only records sharing a key are compared, so
+# checking a new record touches its own blocks rather than the whole table.
+# Pairs that score high enough are kept in dedup_candidates for review.
+DEDUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dedup_keys (
+    key TEXT NOT NULL,
+    record INTEGER NOT NULL,
+    PRIMARY KEY (key, record)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS dedup_keys_record ON dedup_keys (record);
+CREATE TABLE IF NOT EXISTS dedup_candidates (
+    a INTEGER NOT NULL,
+    b INTEGER NOT NULL,
+    score REAL NOT NULL,
+    dismissed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (a, b)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS dedup_candidates_b ON dedup_candidates (b);
+CREATE TRIGGER IF NOT EXISTS dedup_delete AFTER DELETE ON addresses BEGIN
+    DELETE FROM dedup_keys WHERE record = old.rowid;
+    DELETE FROM dedup_candidates WHERE a = old.rowid OR b = old.rowid;
+END;
+"""
+
+# The Treeview only ever holds a window of the table. Rows are fetched a page
+# at a time by rowid (keyset pagination, no OFFSET scans), more are loaded as
+# you scroll to either end of the window, and rows far out of view are
+# dropped again. Items are keyed by rowid so single rows can be patched.
+PAGE_SIZE = 100
+WINDOW_SIZE = 300
+
+SEARCH_DELAY_MS = 150  # Wait for a pause in typing before searching
+
+# Imports and exports stream CHUNK_SIZE records at a time (one executemany,
+# or one fetchmany) and update the progress bar after each chunk. A whole
+# import is one transaction, so a bad file leaves the table as it was.
+CHUNK_SIZE = 5000
+IMPORT_CACHE_KB = 64 * 1024  # Page cache while importing, so index updates stay in memory
+
+# Blocks with more records than MAX_BLOCK_SIZE (a trigram like "ain" shared
+# across a busy zip code) say little and are skipped. Records sharing the name
+# key or at least MIN_SHARED_KEYS address keys are scored, and pairs scoring
+# DUPLICATE_SCORE or more become merge candidates.
+MAX_BLOCK_SIZE = 200
+MIN_SHARED_KEYS = 3
+DUPLICATE_SCORE = 0.8
+
+record_count = 0  # Rows shown (all, or those matching the search), kept up to date by submit() and delete()
+at_start = True  # Whether the window reaches the first / last row of the table
+at_end = True
+loading = False  # A page is on its way; set until the newest view's page is in
+search_words = []  # What the search box holds, split into words; empty shows every record
+search_job = None  # Pending root.after() for the search box
+
+conn = None  # The connection and its cursor belong to the database worker thread
+c = None
+has_fts = False
+db_queue = queue.Queue()  # (work, done, error, write) jobs for the worker; None stops it
+db_results = queue.Queue()  # (callback, args) for the Tk thread
+pending_jobs = 0  # Jobs queued whose results haven't been handled yet, and how many of them write
+pending_writes = 0
+busy_since = 0.0  # When pending_jobs last went up from zero
+view_generation = 0  # Bumped whenever the Treeview is reloaded, so pages for the old view are dropped
+
+# Function to open the database and create the tables; runs on the worker
+# thread. Returns whether the duplicate tables were just created.
+def open_database():
+    global conn, c, has_fts
+    conn = sqlite3.connect(DATABASE, timeout=LOCK_TIMEOUT)
+    c = conn.cursor()
+    # WAL lets a commit skip rewriting the main file, and with it NORMAL only
+    # syncs at checkpoints; together they make big imports much cheaper
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+
+    # Create the table if it does not exist
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS addresses (
+        fname text,
+        lname text,
+        address text,
+        city text,
+        state text,
+        zip integer
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS addresses_name ON addresses (lname, fname)")
+    c.execute("CREATE INDEX IF NOT EXISTS addresses_zip ON addresses (zip)")
+
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'addresses_fts'")
+    fts_exists = c.fetchone() is not None
+    try:
+        c.executescript(FTS_SCHEMA)
+        if not fts_exists:
+            # Index the records that were there before the search index
+            c.execute("INSERT INTO addresses_fts (addresses_fts) VALUES ('rebuild')")
+        has_fts = True
+    except sqlite3.OperationalError:
+        print("SQLite was built without FTS5, search falls back to a full scan")
+        has_fts = False
+    conn.commit()
 
-        if record:
-            rowid = record[0]  # Get the rowid (OID) of the selected record
-            c.execute("DELETE FROM addresses WHERE rowid = ?", (rowid,))
-            conn.commit()
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'dedup_keys'")
+    dedup_exists = c.fetchone() is not None
+    c.executescript(DEDUP_SCHEMA)
+    conn.commit()
+    return not dedup_exists
+
+# Function to queue a database job. work() runs on the worker thread; then
+# done(result), or error(exception) if it raised, runs on the Tk thread.
+# Jobs run in the order they are queued. Write jobs must not commit, the
+# worker commits them in batches.
+def run_db(work, done=None, error=None, write=False):
+    global pending_jobs, pending_writes, busy_since
+    if not pending_jobs:
+        busy_since = time.monotonic()
+    pending_jobs += 1
+    pending_writes += write
+    db_queue.put((work, done, error, write))
+
+# Function to hand a callback and its arguments to the Tk thread; the worker
+# must not touch widgets itself
+def post(callback, *args):
+    db_results.put((callback, args))
+
+# The database worker thread: runs jobs one at a time, and every write job
+# waiting in the queue together in one transaction
+def db_worker():
+    waiting = []  # Taken off the queue while gathering a batch, to run next
+    while True:
+        job = waiting.pop(0) if waiting else db_queue.get()
+        if job is None:
+            break
+        if not job[3]:
+            try:
+                post(finish_job, job, job[0](), None)
+            except Exception as e:
+                if conn and conn.in_transaction:
+                    conn.rollback()  # Don't leave a half-done job open under the next batch
+                post(finish_job, job, None, e)
+            continue
+        batch = [job]
+        while not waiting:
+            try:
+                job = db_queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and job[3]:
+                batch.append(job)
+            else:
+                waiting.append(job)
+        write_batch(batch)
+    if conn:
+        conn.close()
+
+# Function to run write jobs in one transaction. Each gets a savepoint, so a
+# job that fails is undone without losing the others in the batch.
+def write_batch(batch):
+    outcomes = []
+    try:
+        c.execute("BEGIN")
+        for job in batch:
+            c.execute("SAVEPOINT job")
+            try:
+                outcomes.append((job, job[0](), None))
+            except Exception as e:
+                c.execute("ROLLBACK TO job")
+                outcomes.append((job, None, e))
+            c.execute("RELEASE job")
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        outcomes = [(job, None, e) for job in batch]
+    for outcome in outcomes:
+        post(finish_job, *outcome)
+
+# Function to pass a finished job's result (or error) to its callback
+def finish_job(job, result, error):
+    global pending_jobs, pending_writes
+    work, done, on_error, write = job
+    pending_jobs -= 1
+    pending_writes -= write
+    if error is not None:
+        (on_error or show_db_error)(error)
+    elif done:
+        done(result)
+
+# Function to run the callbacks of finished jobs, polled from the Tk event loop
+def poll_db():
+    root.after(POLL_MS, poll_db)
+    while True:
+        try:
+            callback, args = db_results.get_nowait()
+        except queue.Empty:
+            break
+        callback(*args)
+    update_pending()
+
+# Function to show that jobs are still waiting on the database
+def update_pending():
+    if not pending_jobs or time.monotonic() - busy_since < PENDING_DELAY_MS / 1000:
+        pending_label.config(text="")
+    else:
+        action = "Saving" if pending_writes else "Working"
+        pending_label.config(text=f"{action}... ({pending_jobs} pending)")
+
+def show_db_error(e):
+    messagebox.showerror("Database Error", str(e))
+
+# Function to give up when the database can't be opened at all
+def database_failed(e):
+    messagebox.showerror("Database Error", f"Could not open {DATABASE}: {e}")
+    root.destroy()
 
-        # Refresh the records in the Treeview
-        refresh_records()
+# Function to load the view once the database is open, and index existing
+# records for duplicates the first time
+def database_opened(dedup_new):
+    refresh_records()
+    if dedup_new:
+        show_progress("Indexing for duplicates...")
+        run_db(index_duplicates, lambda found: (show_progress(""), update_duplicates_label()))
+    else:
+        update_duplicates_label()
 
+# Function to delete the selected records
+def delete():
+    global record_count
+    selected_items = tree.selection()  # Get the selected items in the Treeview
+    if selected_items:  # Check if any item is selected
+        # Items are keyed by rowid, so there's no need to look the records up
+        rowids = [(int(item),) for item in selected_items]
+        run_db(lambda: c.executemany("DELETE FROM addresses WHERE rowid = ?", rowids),
+               error=delete_failed, write=True)
+
+        # Remove just those rows from the Treeview, without waiting for the database
+        record_count -= len(selected_items)
+        tree.delete(*selected_items)
+        update_count()
+
+# Function to put the rows back when a delete fails
+def delete_failed(e):
+    show_db_error(e)
+    refresh_records()
 
 # Function to submit a new record
 def submit():
-    # Insert data into the database
-    c.execute("INSERT INTO addresses (fname, lname, address, city, state, zip) VALUES (?, ?, ?, ?, ?, ?)",
-              (f_name.get(), l_name.get(), address.get(), city.get(), state.get(), zip.get()))
-    conn.commit()
+    # Queue the insert; the fields are cleared without waiting for it
+    values = (f_name.get(), l_name.get(), address.get(), city.get(), state.get(), zip.get())
+    words, generation = search_words, view_generation
+    run_db(lambda: add_record(values, words), lambda result: show_new_record(values, generation, *result),
+           lambda e: submit_failed(values, e), write=True)
 
     # Clear the input fields
     f_name.delete(0, END)
@@ -63,22 +313,505 @@ def submit():
     state.delete(0, END)
     zip.delete(0, END)
 
-    # Refresh the records in the Treeview
+# Function to insert a record and check it for duplicates, on the worker
+# thread. Returns its rowid, the duplicates found and whether it matches the
+# search words.
+def add_record(values, words):
+    c.execute("INSERT INTO addresses (fname, lname, address, city, state, zip) VALUES (?, ?, ?, ?, ?, ?)",
+              values)
+    rowid = c.lastrowid
+    found = check_duplicates(rowid, values)
+    shown = not words or bool(query_rows(words, "=", rowid, limit=1))
+    return rowid, found, shown
+
+# Function to add just the new row to the Treeview once it is saved; it goes
+# at the end of the table, so move the window there first if it isn't already
+def show_new_record(values, generation, rowid, found, shown):
+    global record_count
+    update_duplicates_label(found, rowid)
+    if not shown:
+        return  # Doesn't match the search, nothing to show
+    record_count += 1
+    update_count()
+    if generation != view_generation:
+        return  # The view was reloaded since, after the record was saved, so it has it
+    if at_end:
+        tree.insert("", "end", iid=rowid, values=values)
+        trim_window(from_top=True)
+        tree.see(rowid)
+    else:
+        show_last_page(then=lambda: tree.see(rowid) if tree.exists(rowid) else None)
+
+# Function to give the input back when a record couldn't be saved
+def submit_failed(values, e):
+    show_db_error(e)
+    if not any((f_name.get(), l_name.get(), address.get(), city.get(), state.get(), zip.get())):
+        f_name.insert(0, values[0])
+        l_name.insert(0, values[1])
+        address.insert(0, values[2])
+        city.insert(0, values[3])
+        state.insert(0, values[4])
+        zip.insert(0, values[5])
+
+# Function to get the FROM clause, rowid column and WHERE terms (with their
+# parameters) that select the records matching the search words
+def search_source(words):
+    if not words:
+        return "addresses a", "a.rowid", [], []
+    if has_fts:
+        # Quote each word so FTS5 syntax is taken literally, and match it as a prefix
+        query = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+        return ("addresses_fts JOIN addresses a ON a.rowid = addresses_fts.rowid", "addresses_fts.rowid",
+                ["addresses_fts MATCH ?"], [query])
+    terms, params = [], []
+    for word in words:
+        terms.append("(a.fname LIKE ? OR a.lname LIKE ? OR a.address LIKE ? OR a.city LIKE ?)")
+        params += [f"%{word}%"] * 4
+    return "addresses a", "a.rowid", terms, params
+
+# Function to fetch up to limit records matching the search words, in rowid
+# order, optionally only those whose rowid compares to value (e.g. "> 100")
+def query_rows(words, compare=None, value=None, descending=False, limit=PAGE_SIZE):
+    source, rowid, terms, params = search_source(words)
+    if compare:
+        terms = terms + [f"{rowid} {compare} ?"]
+        params = params + [value]
+    where = " WHERE " + " AND ".join(terms) if terms else ""
+    order = " DESC" if descending else ""
+    c.execute(f"SELECT {rowid}, a.fname, a.lname, a.address, a.city, a.state, a.zip FROM {source}{where}"
+              f" ORDER BY {rowid}{order} LIMIT ?", params + [limit])
+    return c.fetchall()
+
+# Function to fetch one page of records after (or before) a rowid
+def fetch_page(words, after=0, before=None):
+    if before is None:
+        return query_rows(words, ">", after)
+    return query_rows(words, "<", before, descending=True)[::-1]
+
+# Function to drop rows from one end of the Treeview once it holds more than WINDOW_SIZE
+def trim_window(from_top):
+    global at_start, at_end
+    items = tree.get_children()
+    excess = len(items) - WINDOW_SIZE
+    if excess <= 0:
+        return
+    if from_top:
+        tree.delete(*items[:excess])
+        at_start = False
+    else:
+        tree.delete(*items[-excess:])
+        at_end = False
+
+# Function to load the page after the last row shown
+def load_next():
+    items = tree.get_children()
+    words, generation = search_words, view_generation
+
+    def show(rows):
+        global at_end, loading
+        if generation != view_generation:
+            return  # The newer load resets loading
+        loading = False
+        at_end = len(rows) < PAGE_SIZE
+        for row in rows:
+            tree.insert("", "end", iid=row[0], values=row[1:])
+        trim_window(from_top=True)
+        if items and tree.exists(items[-1]):
+            tree.see(items[-1])  # Keep the rows that were in view in view
+    run_db(lambda: fetch_page(words, after=int(items[-1]) if items else 0), show, load_failed)
+
+# Function to load the page before the first row shown
+def load_previous():
+    items = tree.get_children()
+    if not items:
+        return
+    words, generation = search_words, view_generation
+
+    def show(rows):
+        global at_start, loading
+        if generation != view_generation:
+            return  # The newer load resets loading
+        loading = False
+        at_start = len(rows) < PAGE_SIZE
+        for i, row in enumerate(rows):
+            tree.insert("", i, iid=row[0], values=row[1:])
+        trim_window(from_top=False)
+        if tree.exists(items[0]):
+            tree.see(items[0])
+    run_db(lambda: fetch_page(words, before=int(items[0])), show, load_failed)
+
+def load_failed(e):
+    global loading
+    loading = False
+    show_db_error(e)
+
+# Function to move the window to the end of the table, then call then()
+def show_last_page(then=None):
+    global view_generation, loading
+    view_generation += 1
+    loading = True
+    words, generation = search_words, view_generation
+
+    def show(rows):
+        global at_start, at_end, loading
+        if generation != view_generation:
+            return
+        loading = False
+        tree.delete(*tree.get_children())
+        at_start = len(rows) < PAGE_SIZE
+        at_end = True
+        for row in rows:
+            tree.insert("", "end", iid=row[0], values=row[1:])
+        if then:
+            then()
+    run_db(lambda: query_rows(words, descending=True)[::-1], show, load_failed)
+
+# Function to load more rows when the Treeview is scrolled to either end of the window
+def on_tree_scroll(first, last):
+    global loading
+    tree_scroll.set(first, last)
+    if loading:
+        return
+    if float(last) >= 1.0 and not at_end:
+        loading = True
+        load_next()
+    elif float(first) <= 0.0 and not at_start:
+        loading = True
+        load_previous()
+
+def update_count():
+    count_label.config(text=f"{record_count:,} {'matches' if search_words else 'records'}")
+
+# Function to search once typing in the search box pauses
+def on_search_change(*args):
+    global search_job
+    if search_job is not None:
+        root.after_cancel(search_job)
+    search_job = root.after(SEARCH_DELAY_MS, run_search)
+
+def run_search():
+    global search_words, search_job
+    search_job = None
+    search_words = search_var.get().split()
     refresh_records()
 
 # Function to refresh the records displayed in the Treeview
 def refresh_records():
-    # Clear the existing data in the Treeview
-    for row in tree.get_children():
-        tree.delete(row)
-
-    # Fetch all records from the database
-    c.execute("SELECT * FROM addresses")
-    rows = c.fetchall()
-
-    # Insert fetched records into the Treeview
-    for row in rows:
-        tree.insert("", "end", values=row)
+    global at_start, at_end, view_generation, loading
+    # Clear the existing data in the Treeview and start again from the first page
+    view_generation += 1
+    tree.delete(*tree.get_children())
+    at_start, at_end = True, False
+    loading = True  # Until the first page is in
+    load_next()
+    recount()
+
+# Function to count the records shown (all of them, or the search matches)
+def recount():
+    words = search_words
+
+    def count():
+        source, rowid, terms, params = search_source(words)
+        where = " WHERE " + " AND ".join(terms) if terms else ""
+        c.execute(f"SELECT COUNT(*) FROM {source}{where}", params)
+        return c.fetchone()[0]
+
+    def show(count):
+        global record_count
+        if words is search_words:
+            record_count = count
+            update_count()
+    run_db(count, show)
+
+# Function to score candidate pairs and keep those that look like duplicates
+def record_candidates(pairs):
+    pairs = list(pairs)
+    rowids = sorted({rowid for pair in pairs for rowid in pair})
+    records = {}
+    for i in range(0, len(rowids), 500):
+        chunk = rowids[i:i + 500]
+        c.execute(f"SELECT rowid, * FROM addresses WHERE rowid IN ({', '.join('?' * len(chunk))})", chunk)
+        records.update((row[0], row[1:]) for row in c.fetchall())
+    found = []
+    for a, b in pairs:
+        score = duplicate_score(records[a], records[b])
+        if score >= DUPLICATE_SCORE:
+            found.append((a, b, score))
+    c.executemany("INSERT OR IGNORE INTO dedup_candidates (a, b, score) VALUES (?, ?, ?)", found)
+    return found
+
+# Function to add blocking keys for records after a rowid and find their
+# duplicates; used on the worker thread for the initial build and after an import
+def index_duplicates(after_rowid=0):
+    c.execute("PRAGMA cache_size")
+    cache_size = c.fetchone()[0]
+    c.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KB}")
+    cursor = conn.execute("SELECT rowid, * FROM addresses WHERE rowid > ?", (after_rowid,))
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        # Sorted, so the inserts walk the key index in order
+        c.executemany("INSERT OR IGNORE INTO dedup_keys (key, record) VALUES (?, ?)",
+                      sorted((key, row[0]) for row in rows for key in blocking_keys(row[1:])))
+        post(show_progress, f"Indexing for duplicates... up to record {rows[-1][0]:,}")
+    # Pairs with at least one new record, sharing keys in blocks that aren't too big
+    pairs = conn.execute("""
+        WITH blocks AS (
+            SELECT key FROM dedup_keys
+            WHERE key IN (SELECT key FROM dedup_keys WHERE record > ?)
+            GROUP BY key HAVING COUNT(*) BETWEEN 2 AND ?
+        )
+        SELECT a.record, b.record FROM blocks
+        JOIN dedup_keys a ON a.key = blocks.key
+        JOIN dedup_keys b ON b.key = blocks.key AND b.record > a.record
+        WHERE b.record > ?
+        GROUP BY a.record, b.record
+        HAVING SUM(substr(blocks.key, 1, 1) = 'n') > 0 OR COUNT(*) >= ?
+    """, (after_rowid, MAX_BLOCK_SIZE, after_rowid, MIN_SHARED_KEYS))
+    found = 0
+    while True:
+        chunk = pairs.fetchmany(CHUNK_SIZE)
+        if not chunk:
+            break
+        found += len(record_candidates(chunk))
+    conn.commit()
+    c.execute(f"PRAGMA cache_size={cache_size}")
+    return found
+
+# Function to find duplicates of one new record, looking only in its own blocks
+def check_duplicates(rowid, record):
+    keys = blocking_keys(record)
+    c.executemany("INSERT OR IGNORE INTO dedup_keys (key, record) VALUES (?, ?)", [(key, rowid) for key in keys])
+    if not keys:
+        return []
+    placeholders = ", ".join("?" * len(keys))
+    c.execute(f"""
+        SELECT record FROM dedup_keys
+        WHERE key IN (SELECT key FROM dedup_keys WHERE key IN ({placeholders})
+                      GROUP BY key HAVING COUNT(*) <= ?)
+          AND record != ?
+        GROUP BY record
+        HAVING SUM(substr(key, 1, 1) = 'n') > 0 OR COUNT(*) >= ?
+    """, keys + [MAX_BLOCK_SIZE, rowid, MIN_SHARED_KEYS])
+    return record_candidates((min(other, rowid), max(other, rowid)) for other, in c.fetchall())
+
+# Function to show how many candidates there are, and the best match for a new record
+def update_duplicates_label(found=(), rowid=None):
+    run_db(lambda: duplicates_text(found, rowid), lambda text: duplicates_label.config(text=text))
+
+def duplicates_text(found, rowid):
+    c.execute("SELECT COUNT(*) FROM dedup_candidates WHERE NOT dismissed")
+    count = c.fetchone()[0]
+    text = f"{count:,} possible duplicates" if count else "No duplicates found"
+    if found:
+        a, b, score = max(found, key=lambda pair: pair[2])
+        c.execute("SELECT fname, lname FROM addresses WHERE rowid = ?", (b if a == rowid else a,))
+        row = c.fetchone()
+        if row:
+            text = f"Possible duplicate of {row[0]} {row[1]} ({score:.0%}), {text}"
+    return text
+
+# Function to show the candidate pairs so they can be merged or dismissed
+def show_duplicates():
+    window = Toplevel(root)
+    window.title("Possible Duplicates")
+    columns = ("score", "first", "second")
+    pairs = ttk.Treeview(window, columns=columns, show="headings", height=15)
+    pairs.heading("score", text="Match")
+    pairs.heading("first", text="Record")
+    pairs.heading("second", text="Possible duplicate")
+    pairs.column("score", width=60)
+    pairs.column("first", width=320)
+    pairs.column("second", width=320)
+    pairs.grid(row=0, column=0, columnspan=2, padx=10, pady=10)
+
+    def describe(fname, lname, street, town, region, code):
+        return f"{fname} {lname}, {street}, {town} {region} {code}"
+
+    def fetch():
+        c.execute("""
+            SELECT d.a, d.b, d.score, x.fname, x.lname, x.address, x.city, x.state, x.zip,
+                   y.fname, y.lname, y.address, y.city, y.state, y.zip
+            FROM dedup_candidates d
+            JOIN addresses x ON x.rowid = d.a
+            JOIN addresses y ON y.rowid = d.b
+            WHERE NOT d.dismissed ORDER BY d.score DESC LIMIT 500
+        """)
+        return c.fetchall()
+
+    def fill(rows):
+        if not window.winfo_exists():
+            return  # Closed before the pairs came in
+        for row in rows:
+            pairs.insert("", "end", iid=f"{row[0]}:{row[1]}",
+                         values=(f"{row[2]:.0%}", describe(*row[3:9]), describe(*row[9:])))
+    run_db(fetch, fill)
+
+    def selected():
+        return [tuple(int(rowid) for rowid in item.split(":")) for item in pairs.selection()]
+
+    def merge():
+        chosen = selected()
+        run_db(lambda: [(keep, other, merge_records(keep, other)) for keep, other in chosen], merged,
+               write=True)
+
+    def merged(results):
+        for keep, other, values in results:
+            # Patch the two rows in the Treeview
+            if tree.exists(other):
+                tree.delete(other)
+            if values and tree.exists(keep):
+                tree.item(keep, values=values)
+            # Any other pair with the merged record is gone too
+            if window.winfo_exists():
+                for item in pairs.get_children():
+                    if str(other) in item.split(":"):
+                        pairs.delete(item)
+        recount()
+        update_duplicates_label()
+
+    def dismiss():
+        chosen = selected()
+        run_db(lambda: c.executemany("UPDATE dedup_candidates SET dismissed = 1 WHERE a = ? AND b = ?", chosen),
+               lambda result: update_duplicates_label(), write=True)
+        pairs.delete(*pairs.selection())
+
+    Button(window, text="Merge", command=merge).grid(row=1, column=0, padx=10, pady=10, ipadx=10)
+    Button(window, text="Not Duplicates", command=dismiss).grid(row=1, column=1, padx=10, pady=10, ipadx=10)
+
+# Function to merge a duplicate into the older record: fields empty in the
+# kept record are filled in from the other, which is then deleted. Runs on
+# the worker thread and returns the merged values, or None if either record
+# is gone.
+def merge_records(keep, other):
+    c.execute("SELECT rowid, * FROM addresses WHERE rowid IN (?, ?)", (keep, other))
+    rows = {row[0]: row[1:] for row in c.fetchall()}
+    if len(rows) < 2:
+        return None  # One of them was deleted meanwhile
+    merged = tuple(value if value not in (None, "") else rows[other][i] for i, value in enumerate(rows[keep]))
+    c.execute("UPDATE addresses SET fname = ?, lname = ?, address = ?, city = ?, state = ?, zip = ? WHERE rowid = ?",
+              merged + (keep,))
+    c.execute("DELETE FROM addresses WHERE rowid = ?", (other,))
+    # The kept record may have changed, so its keys are rebuilt
+    c.execute("DELETE FROM dedup_keys WHERE record = ?", (keep,))
+    c.executemany("INSERT OR IGNORE INTO dedup_keys (key, record) VALUES (?, ?)",
+                  [(key, keep) for key in blocking_keys(merged)])
+    return merged
+
+def show_progress(text, fraction=None):
+    progress_label.config(text=text)
+    if fraction is not None:
+        progress_bar["value"] = fraction * 100
+
+# Function to import contacts from a CSV or vCard file
+def import_contacts():
+    path = filedialog.askopenfilename(title="Import Contacts",
+                                      filetypes=[("Contacts", "*.csv *.vcf *.vcard"), ("All files", "*.*")])
+    if not path:
+        return
+    show_progress(f"Importing {os.path.basename(path)}...", 0)
+    run_db(lambda: import_file(path), imported, lambda e: import_failed(path, e))
+
+# Function to read a contacts file into the table on the worker thread,
+# posting progress as it goes. Returns how many contacts were imported and
+# how many possible duplicates they brought.
+def import_file(path):
+    size = max(os.path.getsize(path), 1)
+    read = [0]
+
+    # Count characters as lines are read, for the progress bar
+    def counted(f):
+        for line in f:
+            read[0] += len(line)
+            yield line
+
+    imported = 0
+    c.execute("PRAGMA cache_size")
+    cache_size = c.fetchone()[0]
+    c.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KB}")
+    try:
+        with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+            is_vcard = path.lower().endswith((".vcf", ".vcard"))
+            records = read_vcards(counted(f)) if is_vcard else read_csv(counted(f))
+            with conn:  # One transaction for the whole file
+                c.execute("BEGIN")  # Explicitly, so it covers dropping the trigger too
+                c.execute("SELECT IFNULL(MAX(rowid), 0) FROM addresses")
+                last_rowid = c.fetchone()[0]
+                if has_fts:
+                    # Indexing the new rows in one statement at the end is
+                    # several times faster than the trigger doing it row by row
+                    c.execute("DROP TRIGGER addresses_fts_insert")
+                while True:
+                    chunk = list(islice(records, CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    c.executemany("INSERT INTO addresses (fname, lname, address, city, state, zip)"
+                                  " VALUES (?, ?, ?, ?, ?, ?)", chunk)
+                    imported += len(chunk)
+                    post(show_progress, f"Importing... {imported:,} contacts", read[0] / size)
+                if has_fts:
+                    post(show_progress, f"Indexing {imported:,} contacts for search...")
+                    c.execute("INSERT INTO addresses_fts (rowid, fname, lname, address, city)"
+                              " SELECT rowid, fname, lname, address, city FROM addresses WHERE rowid > ?",
+                              (last_rowid,))
+                    c.execute(FTS_INSERT_TRIGGER)
+    finally:
+        c.execute(f"PRAGMA cache_size={cache_size}")
+    return imported, index_duplicates(last_rowid)
+
+def imported(result):
+    count, found = result
+    show_progress(f"Imported {count:,} contacts, {found:,} possible duplicates", 1)
+    refresh_records()
+    update_duplicates_label()
+
+def import_failed(path, e):
+    show_progress("Import failed", 0)
+    messagebox.showerror("Import Failed", f"Nothing was imported from {os.path.basename(path)}: {e}")
+
+# Function to export every contact to a CSV or vCard file
+def export_contacts():
+    path = filedialog.asksaveasfilename(title="Export Contacts", defaultextension=".csv",
+                                        filetypes=[("CSV", "*.csv"), ("vCard", "*.vcf")])
+    if not path:
+        return
+    show_progress(f"Exporting to {os.path.basename(path)}...", 0)
+    run_db(lambda: export_file(path),
+           lambda exported: show_progress(f"Exported {exported:,} contacts to {os.path.basename(path)}", 1),
+           lambda e: export_failed(path, e))
+
+# Function to write every contact to a file on the worker thread, posting
+# progress as it goes. Returns how many contacts were written.
+def export_file(path):
+    c.execute("SELECT COUNT(*) FROM addresses")
+    total = max(c.fetchone()[0], 1)
+    exported = 0
+    # A cursor of its own, read a chunk at a time, so memory stays flat
+    cursor = conn.execute("SELECT fname, lname, address, city, state, zip FROM addresses ORDER BY rowid")
+    try:
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            is_vcard = path.lower().endswith((".vcf", ".vcard"))
+            writer = None if is_vcard else csv.writer(f)
+            if writer:
+                writer.writerow(FIELDS)
+            while True:
+                rows = cursor.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                if writer:
+                    writer.writerows(rows)
+                else:
+                    f.write("".join(write_vcard(row) for row in rows))
+                exported += len(rows)
+                post(show_progress, f"Exporting... {exported:,} of {total:,} contacts", exported / total)
+    finally:
+        cursor.close()
+    return exported
+
+def export_failed(path, e):
+    show_progress("Export failed", 0)
+    messagebox.showerror("Export Failed", f"Could not export to {os.path.basename(path)}: {e}")
 
 def clear():
     f_name.delete(0, END)
@@ -139,9 +872,49 @@ clear.grid(row=7, column=1, padx=10, pady=10, ipadx=10)
 Delete = Button(root, text="delete", command=delete)
 Delete.grid(row=7, column=0, padx=10, pady=10, ipadx=10)
 
+# Search box, filters the records as you type
+search_label = Label(root, text="Search")
+search_label.grid(row=8, column=0, padx=10, pady=10)
+
+search_var = StringVar()
+search_var.trace_add("write", on_search_change)
+search = Entry(root, width=40, textvariable=search_var)
+search.grid(row=8, column=1, padx=10, pady=10)
+
 # Treeview widget to display records
 tree = ttk.Treeview(root, columns=("fname", "lname", "address", "city", "state", "zip"), show="headings")
-tree.grid(row=8, column=0, columnspan=2, padx=10, pady=10)
+tree.grid(row=9, column=0, columnspan=2, padx=(10, 0), pady=10)
+
+tree_scroll = Scrollbar(root, orient=VERTICAL, command=tree.yview)
+tree_scroll.grid(row=9, column=2, sticky="ns", pady=10)
+tree.configure(yscrollcommand=on_tree_scroll)
+
+count_label = Label(root, text="")
+count_label.grid(row=10, column=0, padx=10, sticky="w")
+
+# Shows while jobs are waiting on the database
+pending_label = Label(root, text="")
+pending_label.grid(row=10, column=1, padx=10, sticky="e")
+
+# Bulk import / export, with progress for big files
+import_btn = Button(root, text="Import", command=import_contacts)
+import_btn.grid(row=11, column=0, padx=10, pady=10, ipadx=10)
+
+export_btn = Button(root, text="Export", command=export_contacts)
+export_btn.grid(row=11, column=1, padx=10, pady=10, ipadx=10)
+
+progress_bar = ttk.Progressbar(root, length=300, maximum=100)
+progress_bar.grid(row=12, column=1, padx=10, pady=(0, 10))
+
+progress_label = Label(root, text="")
+progress_label.grid(row=12, column=0, padx=10, pady=(0, 10))
+
+# Merge candidates found by the duplicate check
+duplicates_btn = Button(root, text="Duplicates", command=show_duplicates)
+duplicates_btn.grid(row=13, column=0, padx=10, pady=10, ipadx=10)
+
+duplicates_label = Label(root, text="")
+duplicates_label.grid(row=13, column=1, padx=10, pady=10)
 
 # Define the columns
 tree.heading("fname", text="First Name")
@@ -151,15 +924,17 @@ tree.heading("city", text="City")
 tree.heading("state", text="State")
 tree.heading("zip", text="Zip")
 
-# Refresh the records when the application starts
-refresh_records()
+# Open the database on the worker thread, then refresh the records
+db_thread = threading.Thread(target=db_worker, daemon=True)
+db_thread.start()
+run_db(open_database, database_opened, database_failed)
+poll_db()
 
-# Close the connection when the window is closed
-def on_close():
-    conn.close()
-    root.destroy()
-
-root.protocol("WM_DELETE_WINDOW", on_close)
+root.protocol("WM_DELETE_WINDOW", root.destroy)
 
 # Start the Tkinter event loop
 root.mainloop()
+
+# Let the worker finish the writes still queued, then close the connection
+db_queue.put(None)
+db_thread.join()
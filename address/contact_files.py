@@ -0,0 +1,100 @@
+import csv
+from itertools import chain
+
+# The contact fields in table order; CSV exports use these as their header
+FIELDS = ("fname", "lname", "address", "city", "state", "zip")
+# Header names accepted for each field in an imported CSV, lowercased without spaces or underscores
+CSV_HEADERS = {
+    "fname": ("fname", "firstname", "first", "givenname"),
+    "lname": ("lname", "lastname", "last", "surname", "familyname"),
+    "address": ("address", "street", "streetaddress", "address1"),
+    "city": ("city", "town", "locality"),
+    "state": ("state", "region", "province"),
+    "zip": ("zip", "zipcode", "postcode", "postalcode"),
+}
+
+# Function to read records from a CSV file as tuples in FIELDS order
+def read_csv(lines):
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    names = ["".join(name.lower().replace("_", " ").split()) for name in header]
+    columns = [next((names.index(name) for name in CSV_HEADERS[field] if name in names), None) for field in FIELDS]
+    if sum(column is not None for column in columns) < 2:
+        # No header we know, so take the columns in FIELDS order and the first row as a record
+        columns = list(range(len(FIELDS)))
+        reader = chain([header], reader)
+    for row in reader:
+        if any(row):
+            yield tuple(row[column] if column is not None and column < len(row) else "" for column in columns)
+
+# Function to split a vCard value on unescaped separators and unescape each part
+def split_vcard_value(value, separator=";"):
+    parts, current, escaped = [], [], False
+    for char in value:
+        if escaped:
+            current.append("\n" if char in "nN" else char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == separator:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    return parts
+
+# Function to read records from a vCard file as tuples in FIELDS order;
+# only the name (N, or FN without it) and the first address (ADR) are kept
+def read_vcards(lines):
+    card = None
+    for line in unfold_vcard(lines):
+        name, _, value = line.partition(":")
+        key = name.split(";")[0].upper()
+        if key == "BEGIN":
+            card = {}
+        elif card is None:
+            continue
+        elif key == "END":
+            yield tuple(card.get(field, "") for field in FIELDS)
+            card = None
+        elif key == "N":
+            parts = split_vcard_value(value) + ["", ""]
+            card["lname"], card["fname"] = parts[0], parts[1]
+        elif key == "FN" and "fname" not in card:
+            first, _, last = split_vcard_value(value)[0].rpartition(" ")
+            card["fname"], card["lname"] = (first, last) if first else (last, "")
+        elif key == "ADR" and "address" not in card:
+            # PO box; extended address; street; city; region; postal code; country
+            parts = split_vcard_value(value) + [""] * 7
+            card.update(address=parts[2], city=parts[3], state=parts[4], zip=parts[5])
+
+# Function to join folded vCard lines (continuations start with a space or tab)
+def unfold_vcard(lines):
+    pending = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and pending is not None:
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending is not None:
+        yield pending
+
+def escape_vcard(value):
+    return (str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\n", "\\n"))
+
+# Function to format one record as a vCard
+def write_vcard(row):
+    fname, lname, street, town, region, code = ("" if value is None else value for value in row)
+    return ("BEGIN:VCARD\r\nVERSION:3.0\r\n"
+            f"N:{escape_vcard(lname)};{escape_vcard(fname)};;;\r\n"
+            f"FN:{escape_vcard(f'{fname} {lname}'.strip())}\r\n"
+            f"ADR;TYPE=HOME:;;{escape_vcard(street)};{escape_vcard(town)};{escape_vcard(region)};"
+            f"{escape_vcard(code)};\r\n"
+            "END:VCARD\r\n")
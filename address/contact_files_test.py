@@ -0,0 +1,67 @@
+import csv
+import io
+
+from contact_files import FIELDS, read_csv, read_vcards, unfold_vcard, write_vcard
+
+CONTACTS = [
+    ("Ada", "Lovelace", "12 St James's Square", "London", "LDN", "01234"),
+    ("Jean-Luc", "O'Neil, Jr.", "1; Rue \\ de la Paix", "Paris", "IDF", "75002"),
+    ("Bo", "", "", "", "", ""),
+]
+
+
+def write_csv(rows):
+    # The same way export_file writes it: a header of FIELDS, then the rows
+    out = io.StringIO(newline="")
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    writer.writerows(rows)
+    return io.StringIO(out.getvalue(), newline="")
+
+
+def test_csv_round_trip():
+    assert list(read_csv(write_csv(CONTACTS))) == CONTACTS
+
+
+def test_csv_header_aliases_and_column_order():
+    lines = ["Last Name,Phone,First Name,Postal Code,Street Address,Town,Province",
+             "Lovelace,555,Ada,01234,12 Square,London,LDN",
+             ",,,,,,",
+             "Short"]
+    assert list(read_csv(lines)) == [("Ada", "Lovelace", "12 Square", "London", "LDN", "01234"),
+                                     ("", "Short", "", "", "", "")]
+
+
+def test_csv_without_a_known_header_keeps_the_first_row():
+    lines = ["A,B,1 Rd,X,Y,1", "C,D,2 Rd,Z,W,2"]
+    assert list(read_csv(lines)) == [("A", "B", "1 Rd", "X", "Y", "1"), ("C", "D", "2 Rd", "Z", "W", "2")]
+
+
+def test_csv_empty_file():
+    assert list(read_csv([])) == []
+
+
+def test_vcard_round_trip():
+    data = "".join(write_vcard(row) for row in CONTACTS)
+    assert list(read_vcards(io.StringIO(data, newline=""))) == CONTACTS
+
+
+def test_vcard_round_trip_with_missing_values():
+    row = (None, "Solo", None, "Town", None, 501)
+    data = write_vcard(row)
+    assert list(read_vcards(io.StringIO(data, newline=""))) == [("", "Solo", "", "Town", "", "501")]
+
+
+def test_vcard_folded_lines_and_fn_without_n():
+    lines = ["BEGIN:VCARD\r\n",
+             "FN:Grace Brewster\r\n",
+             "  Hopper\r\n",  # Folding drops one space, the other is the separator
+             "ADR;TYPE=WORK:;;1 Navy\r\n",
+             "\tYard;Arlington;VA;22201;USA\r\n",
+             "ADR;TYPE=HOME:;;2nd;Ignored;;;\r\n",
+             "END:VCARD\r\n"]
+    assert list(read_vcards(lines)) == [("Grace Brewster", "Hopper", "1 NavyYard", "Arlington", "VA", "22201")]
+
+
+def test_unfold_vcard_keeps_unfolded_lines():
+    assert list(unfold_vcard(["A:1\r\n", " 2\r\n", "B:3\n"])) == ["A:12", "B:3"]
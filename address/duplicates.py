@@ -0,0 +1,63 @@
+import re
+from difflib import SequenceMatcher
+
+# Blocking keys for finding duplicate contacts: a sound-alike surname key and
+# street number and trigram keys, each prefixed with the zip code, after
+# street words are shortened the same way ("Main Street" and "main st").
+STREET_WORDS = {"street": "st", "avenue": "ave", "av": "ave", "road": "rd", "drive": "dr", "lane": "ln",
+                "boulevard": "blvd", "court": "ct", "place": "pl", "apartment": "apt", "suite": "ste",
+                "north": "n", "south": "s", "east": "e", "west": "w"}
+STREET_TYPES = set(STREET_WORDS.values()) | {"unit", "no"}
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(
+    ("aehiouwy", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r")) for letter in letters}
+
+def normalize_zip(value):
+    digits = "".join(ch for ch in str(value or "") if ch.isdigit())[:5]
+    return digits.zfill(5) if digits else ""  # Stored as an integer, leading zeros may be gone
+
+def normalize_address(value):
+    words = re.sub(r"[^a-z0-9]+", " ", str(value or "").lower()).split()
+    return " ".join(STREET_WORDS.get(word, word) for word in words)
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def soundex(name):
+    letters = [ch for ch in str(name or "").lower() if ch in SOUNDEX_CODES]
+    if not letters:
+        return ""
+    code, last = letters[0].upper(), SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        if digit != last and digit != "0":
+            code += digit
+        if letter not in "hw":  # h and w don't separate letters with the same code
+            last = digit
+    return (code + "000")[:4]
+
+# Function to build the blocking keys of a record (fname, lname, address, city, state, zip)
+def blocking_keys(record):
+    code = normalize_zip(record[5])
+    keys = []
+    surname = soundex(record[1])
+    if surname:
+        keys.append(f"n{code}{surname}")
+    words = [word for word in normalize_address(record[2]).split() if word not in STREET_TYPES]
+    numbers = [word for word in words if word.isdigit()]
+    if numbers:
+        keys.append(f"a{code}#{numbers[0]}")
+    street = " ".join(word for word in words if not word.isdigit())
+    if street:
+        keys.extend(f"a{code}{trigram}" for trigram in trigrams(street))
+    return keys
+
+# Function to score how alike two records are, from 0 to 1
+def duplicate_score(first, second):
+    name = SequenceMatcher(None, f"{first[0]} {first[1]}".lower().strip(),
+                           f"{second[0]} {second[1]}".lower().strip()).ratio()
+    first_grams = trigrams(normalize_address(first[2]))
+    second_grams = trigrams(normalize_address(second[2]))
+    street = len(first_grams & second_grams) / max(len(first_grams | second_grams), 1)
+    same_zip = normalize_zip(first[5]) == normalize_zip(second[5])
+    return round(0.45 * name + 0.45 * street + 0.1 * same_zip, 3)
@@ -0,0 +1,32 @@
+from duplicates import blocking_keys, duplicate_score, normalize_address, normalize_zip, soundex
+
+
+def test_normalize_zip_restores_leading_zeros():
+    assert normalize_zip(2134) == "02134"
+    assert normalize_zip("02134-1234") == "02134"
+    assert normalize_zip(None) == ""
+
+
+def test_normalize_address_shortens_street_words():
+    assert normalize_address("12 North Main Street, Apt. 4") == "12 n main st apt 4"
+
+
+def test_soundex():
+    assert soundex("Robert") == soundex("Rupert") == "R163"
+    assert soundex("Ashcraft") == "A261"
+    assert soundex("") == ""
+
+
+def test_spelling_variants_share_blocking_keys():
+    first = ("Jon", "Smith", "12 Main Street", "Town", "ST", 2134)
+    second = ("John", "Smyth", "12 main st", "Town", "ST", "02134")
+    shared = set(blocking_keys(first)) & set(blocking_keys(second))
+    assert "n02134S530" in shared
+    assert "a02134#12" in shared
+
+
+def test_duplicate_score():
+    record = ("Jon", "Smith", "12 Main Street", "Town", "ST", 2134)
+    assert duplicate_score(record, record) == 1.0
+    assert duplicate_score(record, ("John", "Smith", "12 Main St", "Town", "ST", "02134")) >= 0.8
+    assert duplicate_score(record, ("Zed", "Quux", "99 Other Rd", "City", "XX", 99999)) < 0.5
@@ -1,8 +1,11 @@
 import socket
 import threading
 import argparse
+import selectors
 import os
 
+MAX_OUTBOUND = 1024 * 1024  # Bytes queued for a client before it is dropped (selectors mode)
+
 
 class Server(threading.Thread):
     def __init__(self, host, port):
@@ -38,15 +41,20 @@ class Server(threading.Thread):
             print(f"Ready to receive messages from {sc.getpeername()}")
 
     def broadcast(self, message, source):
+        data = message.encode('ascii')  # Once, not once per recipient
         for connection in self.connections:
             # Send to all connected clients except the source client
             if connection.sockname != source:
-                connection.send(message)
+                connection.send(data)
 
     def removeconnection(self, connection):
         self.connections.remove(connection)
         print(f"Connection {connection.sockname} removed")
 
+    def closeconnections(self):
+        for connection in self.connections:
+            connection.sc.close()
+
 
 class ServerSocket(threading.Thread):
     def __init__(self, sc, sockname, server):
@@ -71,11 +79,139 @@ class ServerSocket(threading.Thread):
                 print(f"Error receiving data from {self.sockname}: {e}")
                 break
 
-    def send(self, message):
+    def send(self, data):
+        try:
+            self.sc.sendall(data)
+        except Exception as e:
+            print(f"Error sending message to {self.sockname}: {e}")
+
+
+class SelectorServer(threading.Thread):
+    """Serves every client from this one thread, multiplexing the sockets with
+    selectors (epoll on Linux) instead of starting a thread per connection."""
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.connections = {}  # {fileno: Connection}
+        self.host = host
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+
+    def run(self):
+        print(f"Creating socket...")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        try:
+            print(f"Binding to {self.host}:{self.port}...")
+            sock.bind((self.host, self.port))
+            sock.listen(128)
+            print(f"Listening at {sock.getsockname()} (selectors mode)")
+        except Exception as e:
+            print(f"Error binding to {self.host}:{self.port} - {e}")
+            return
+
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is sock:
+                    self.accept(sock)
+                    continue
+                connection = key.data
+                if events & selectors.EVENT_READ:
+                    self.receive(connection)
+                if events & selectors.EVENT_WRITE and connection.sc.fileno() in self.connections:
+                    connection.flush()
+
+    def accept(self, sock):
+        try:
+            sc, sockname = sock.accept()
+        except BlockingIOError:
+            return
+        print(f"Connection from {sc.getpeername()} to {sc.getsockname()}")
+        sc.setblocking(False)
+        connection = Connection(sc, sockname, self)
+        self.connections[sc.fileno()] = connection
+        self.selector.register(sc, selectors.EVENT_READ, connection)
+        print(f"Ready to receive messages from {sc.getpeername()}")
+
+    def receive(self, connection):
+        try:
+            data = connection.sc.recv(1024)
+            message = data.decode('ascii')
+        except BlockingIOError:
+            return
+        except Exception as e:
+            print(f"Error receiving data from {connection.sockname}: {e}")
+            self.removeconnection(connection)
+            return
+        if message:
+            print(f"{connection.sockname} says: {message}")
+            self.broadcast(data, connection)
+        else:
+            print(f"{connection.sockname} closed")
+            self.removeconnection(connection)
+
+    def broadcast(self, data, source):
+        # data is the bytes as received, so nothing is encoded per recipient
+        for connection in list(self.connections.values()):
+            if connection is not source:
+                connection.send(data)
+
+    def removeconnection(self, connection):
+        if self.connections.pop(connection.sc.fileno(), None) is None:
+            return
+        self.selector.unregister(connection.sc)
+        connection.sc.close()
+        print(f"Connection {connection.sockname} removed")
+
+    def closeconnections(self):
+        for connection in list(self.connections.values()):
+            connection.sc.close()
+
+
+class Connection:
+    """One client of the SelectorServer and the bytes still waiting to be sent to it."""
+
+    def __init__(self, sc, sockname, server):
+        self.sc = sc
+        self.sockname = sockname
+        self.server = server
+        self.outbound = bytearray()
+
+    def send(self, data):
+        if self.outbound:
+            self.outbound += data
+            if len(self.outbound) > MAX_OUTBOUND:
+                print(f"{self.sockname} is not reading, dropping it")
+                self.server.removeconnection(self)
+            return
         try:
-            self.sc.sendall(message.encode('ascii'))
+            sent = self.sc.send(data)
+        except BlockingIOError:
+            sent = 0
         except Exception as e:
             print(f"Error sending message to {self.sockname}: {e}")
+            self.server.removeconnection(self)
+            return
+        if sent < len(data):
+            # Wait until the socket is writable for the rest
+            self.outbound += data[sent:]
+            self.server.selector.modify(self.sc, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    def flush(self):
+        try:
+            sent = self.sc.send(self.outbound)
+        except BlockingIOError:
+            return
+        except Exception as e:
+            print(f"Error sending message to {self.sockname}: {e}")
+            self.server.removeconnection(self)
+            return
+        del self.outbound[:sent]
+        if not self.outbound:
+            self.server.selector.modify(self.sc, selectors.EVENT_READ, self)
 
 
 def shutdown(server):
@@ -83,8 +219,7 @@ def shutdown(server):
         ipt = input("Type 'q' to shutdown the server: ")
         if ipt == "q":
             print("Closing server connections...")
-            for connection in server.connections:
-                connection.sc.close()
+            server.closeconnections()
 
             print("Shutting down server")
             os._exit(0)
@@ -94,13 +229,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Server Chat")
     parser.add_argument('host', help='Interface server listens at')
     parser.add_argument('-p', metavar='port', type=int, default=1060, help='Server port (defaults to 1060)')
+    parser.add_argument('-m', '--mode', choices=('threads', 'selectors'), default='threads',
+                        help='A thread per client (default), or every client on one selectors loop')
 
     args = parser.parse_args()
 
     print(f"Starting server on {args.host}:{args.p}...")
 
     # Create and start the server thread
-    server = Server(args.host, args.p)
+    if args.mode == 'selectors':
+        server = SelectorServer(args.host, args.p)
+    else:
+        server = Server(args.host, args.p)
     server.start()
 
     # Start the shutdown thread
@@ -1,14 +1,109 @@
 import socket
 import threading
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
-import time
+from collections import deque
+import struct
 import json
+import os
+import random
+import re
+import time
+
+from message_cache import MessageCache
 
 HOST = '127.0.0.1'  # Server IP
 PORT = 5000  # Server Port
 
+# Framed wire protocol (must match server2_0.py)
+FRAME_MAGIC = b"\x00C"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBI")
+MAX_FRAME_SIZE = 1024 * 1024
+FRAME_HELLO = 1
+FRAME_HISTORY = 2
+FRAME_CHAT = 3
+FRAME_CONTROL = 4
+FRAME_UPLOAD = 5
+FRAME_DOWNLOAD = 6
+RECV_SIZE = 65536
+
+# Incoming lines are queued and drawn in batches at most RENDER_FPS times a
+# second, so a burst of messages can't flood the Tk event queue. Only the
+# newest MAX_SCROLLBACK lines are kept in the chat window.
+RENDER_FPS = 30
+MAX_LINES_PER_FRAME = 1000
+MAX_SCROLLBACK = 5000
+
+# A dropped connection is retried after RECONNECT_BASE_DELAY seconds, doubling
+# up to RECONNECT_MAX_DELAY, and the rejoin asks only for the messages missed
+# since the last seq seen.
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RECONNECT_ATTEMPTS = 10
+
+# Room messages are cached on disk (see message_cache.py). Joining a cached
+# room shows its newest CACHE_RENDER_LIMIT messages at once and fetches only
+# the newer ones in the background. New messages are written to the cache
+# every CACHE_FLUSH_INTERVAL seconds.
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".chat2_0_cache.db")
+CACHE_RENDER_LIMIT = 500
+CACHE_FLUSH_INTERVAL = 2
+
+# Chat line the server writes for a shared attachment
+ATTACHMENT_LINE = re.compile(r'shared "(.*)" \(.*\) attachment:([0-9a-f]{64})$')
+
+
+def encode_frame(frame_type, payload):
+    """Encode one frame: header followed by the JSON payload."""
+    body = json.dumps(payload).encode()
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, len(body)) + body
+
+
+class FrameDecoder:
+    """Incrementally split a byte stream into (frame_type, payload) tuples."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every frame that is now complete."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            magic, version, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION or length > MAX_FRAME_SIZE:
+                raise ValueError("Invalid frame from server")
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = json.loads(self.buffer[offset + FRAME_HEADER.size:end].decode())
+            frames.append((frame_type, payload))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+def recv_exact(sock, count):
+    """Read exactly count bytes from a socket."""
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(min(RECV_SIZE, count - len(data)))
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def read_reply(sock):
+    """Read one frame on a transfer connection, leaving any raw data after it unread."""
+    magic, version, frame_type, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    if magic != FRAME_MAGIC or version != FRAME_VERSION or length > MAX_FRAME_SIZE:
+        raise ValueError("Invalid frame from server")
+    return frame_type, json.loads(recv_exact(sock, length).decode())
+
 
 class ModernChatClient:
     def __init__(self, root):
@@ -28,7 +123,22 @@ class ModernChatClient:
         self.message_thread = None
         self.is_leaving = False  # Flag to prevent multiple leave prompts
         self.connected = False  # Flag to track connection status
-        self.message_history = []  # Store message history
+        self.oldest_seq = 0  # Cursor for the next "load older" request
+        self.has_more_history = False
+        self.load_older_button = None
+        self.search_window = None
+        self.decoder = FrameDecoder()
+        self.inbox = deque()  # Frames decoded but not handled yet
+        self.pending_lines = deque()  # (line, from_history, tag) waiting for the next frame
+        self.unacked = deque()  # (text, tag) of our own messages the server hasn't acknowledged
+        self.unacked_lock = threading.Lock()  # Acks are matched on the receive thread
+        self.sent_count = 0
+        self.line_kinds = deque()  # One per line shown: True if it is a room message
+        self.render_scheduled = False
+        self.last_seq = -1  # Seq of the newest room message seen
+        self.cache = MessageCache(CACHE_FILE)
+        self.cache_flushed_at = 0
+        self.session = 0  # Bumped on every login, so a stale reconnect gives up
 
         # Create main container
         self.main_container = ttk.Frame(root)
@@ -104,106 +214,132 @@ class ModernChatClient:
     def connect_to_server(self, action):
         """Connect to the server and initialize chat"""
         try:
-            # Close existing connection if any
-            if self.client:
-                try:
-                    self.client.close()
-                except:
-                    pass
-                self.client = None
-                self.connected = False
-
-            # Create new connection
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.settimeout(5)  # Set a timeout for connection
-            self.client.connect((HOST, PORT))
-            self.connected = True
-
-            # Send user info to server with small delays to prevent flooding
-            self.client.send(self.username.encode())
-            time.sleep(0.1)  # Small delay between sends
-            self.client.send(self.room.encode())
-            time.sleep(0.1)  # Small delay between sends
-            self.client.send(action.encode())
+            self.session += 1
+            self.pending_lines.clear()
+            self.line_kinds.clear()
+            with self.unacked_lock:
+                self.unacked.clear()
+            first_seq, cached = self.cache.newest(self.server_key(), self.room, CACHE_RENDER_LIMIT)
+            self.last_seq = first_seq + len(cached) - 1 if cached else -1
+
+            if action == "join" and cached:
+                # Open the room from the cache straight away; the receive
+                # thread connects and fills in what is newer
+                self.oldest_seq = first_seq
+                self.has_more_history = first_seq > 0
+                self.show_chat_frame()
+                for message in cached:
+                    self.display_message(message)
+                self.running = True
+                self.message_thread = threading.Thread(target=self.receive_messages,
+                                                       args=(self.session, action), daemon=True)
+                self.message_thread.start()
+                return
 
-            # Wait for server response
-            response = self.client.recv(1024).decode()
+            response, history = self.open_session(action, self.last_seq + 1 if cached else None)
 
             # Handle different server responses
-            if response == "room_not_found":
-                messagebox.showerror("Error", "Room not found! Please create the room first.")
-                self.client.close()
-                self.client = None
-                self.connected = False
-                return
-            elif response == "room_exists":
-                messagebox.showerror("Error", "Room already exists! Please join instead.")
-                self.client.close()
-                self.client = None
-                self.connected = False
-                return
-            elif response == "invalid_action":
-                messagebox.showerror("Error", "Invalid action! Please try again.")
-                self.client.close()
-                self.client = None
-                self.connected = False
+            if response not in ["room_created", "room_joined"]:
+                self.close_client()
+                messagebox.showerror("Error", self.join_error(response))
                 return
-            elif response not in ["room_created", "room_joined"]:
-                # Try to parse as JSON (chat history)
-                try:
-                    self.message_history = json.loads(response)
-                    # Wait for the room_joined message
-                    response = self.client.recv(1024).decode()
-                    if response != "room_joined":
-                        messagebox.showerror("Error", f"Server error: {response}")
-                        self.client.close()
-                        self.client = None
-                        self.connected = False
-                        return
-                except json.JSONDecodeError:
-                    messagebox.showerror("Error", f"Server error: {response}")
-                    self.client.close()
-                    self.client = None
-                    self.connected = False
-                    return
+            self.connected = True
 
             # Show chat interface
             self.show_chat_frame()
-
-            # Display chat history if available
-            if self.message_history:
-                for message in self.message_history:
+            if cached and not (history and history.get("reset")):
+                self.oldest_seq = first_seq
+                self.has_more_history = first_seq > 0
+                for message in cached:
                     self.display_message(message)
+            self.resync(history, opening=bool(cached))
 
             # Start message receiving thread
             self.running = True
-            self.message_thread = threading.Thread(target=self.receive_messages, daemon=True)
+            self.message_thread = threading.Thread(target=self.receive_messages,
+                                                   args=(self.session,), daemon=True)
             self.message_thread.start()
 
         except socket.timeout:
             messagebox.showerror("Connection Error", "Connection timed out. Please try again.")
-            if self.client:
-                self.client.close()
-                self.client = None
-                self.connected = False
+            self.close_client()
         except ConnectionRefusedError:
             messagebox.showerror("Connection Error", "Could not connect to server. Make sure the server is running.")
-            if self.client:
-                self.client.close()
-                self.client = None
-                self.connected = False
+            self.close_client()
         except socket.error as e:
             messagebox.showerror("Connection Error", f"Unable to connect to server: {e}")
-            if self.client:
-                self.client.close()
-                self.client = None
-                self.connected = False
+            self.close_client()
         except Exception as e:
             messagebox.showerror("Error", f"Unexpected error: {e}")
-            if self.client:
+            self.close_client()
+
+    def join_error(self, response):
+        """The message shown when the server turns down a join or create"""
+        if response == "room_not_found":
+            return "Room not found! Please create the room first."
+        elif response == "room_exists":
+            return "Room already exists! Please join instead."
+        elif response == "invalid_action":
+            return "Invalid action! Please try again."
+        return f"Server error: {response}"
+
+    def open_session(self, action, since=None):
+        """Open a new connection and send the hello; returns (response, history payload or None)
+
+        since asks for just the messages from that seq on instead of the newest page.
+        """
+        self.close_client()
+        self.client = socket.create_connection((HOST, PORT), timeout=5)
+        self.decoder = FrameDecoder()
+        self.inbox.clear()
+
+        # Send user info to server as a single handshake frame
+        hello = {"username": self.username, "room": self.room, "action": action}
+        if since is not None:
+            hello["since"] = since
+        self.client.sendall(encode_frame(FRAME_HELLO, hello))
+
+        # Wait for server response; history frames arrive before "room_joined"
+        history = None
+        while True:
+            frame_type, payload = self.read_frame()
+            if frame_type == FRAME_HISTORY:
+                history = payload
+            elif frame_type == FRAME_CONTROL:
+                return payload.get("event"), history
+
+    def close_client(self):
+        if self.client:
+            try:
                 self.client.close()
-                self.client = None
-                self.connected = False
+            except:
+                pass
+        self.client = None
+        self.connected = False
+
+    def server_key(self):
+        return f"{HOST}:{PORT}"
+
+    def note_seq(self, seq, message):
+        """Remember a room message for the cache, writing the cache out now and then"""
+        if seq > self.last_seq:
+            self.last_seq = seq
+        self.cache.add(self.server_key(), self.room, [(seq, message)])
+        if time.monotonic() - self.cache_flushed_at >= CACHE_FLUSH_INTERVAL:
+            self.flush_cache()
+
+    def flush_cache(self):
+        self.cache_flushed_at = time.monotonic()
+        self.cache.flush()
+
+    def read_frame(self):
+        """Return the next (frame_type, payload) from the server, reading as needed."""
+        while not self.inbox:
+            data = self.client.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.inbox.extend(self.decoder.feed(data))
+        return self.inbox.popleft()
 
     def show_chat_frame(self):
         """Display the main chat interface"""
@@ -228,6 +364,16 @@ class ModernChatClient:
         nav_frame = ttk.Frame(top_bar)
         nav_frame.pack(side=tk.RIGHT, padx=5)
 
+        self.load_older_button = ttk.Button(nav_frame, text="Load Older",
+                                            command=self.load_older)
+        self.load_older_button.pack(side=tk.LEFT, padx=5)
+        if not self.has_more_history:
+            self.load_older_button.state(['disabled'])
+
+        search_button = ttk.Button(nav_frame, text="Search",
+                                   command=self.show_search_window)
+        search_button.pack(side=tk.LEFT, padx=5)
+
         back_button = ttk.Button(nav_frame, text="Back to Login",
                                  command=self.back_to_login)
         back_button.pack(side=tk.LEFT, padx=5)
@@ -255,45 +401,135 @@ class ModernChatClient:
         send_button = ttk.Button(input_frame, text="Send", command=self.send_message)
         send_button.pack(side=tk.RIGHT)
 
+        attach_button = ttk.Button(input_frame, text="Attach", command=self.attach_file)
+        attach_button.pack(side=tk.RIGHT, padx=(0, 5))
+
     def back_to_login(self):
         """Handle returning to login screen"""
         if self.is_leaving:
             return
         
         if messagebox.askyesno("Leave Room", "Are you sure you want to leave the chat room?"):
-            self.is_leaving = True
-            # Stop the message receiving thread
-            self.running = False
+            self.leave_chat()
 
-            # Close the client connection
-            if self.client and self.connected:
-                try:
-                    self.client.send("leave".encode())
-                    # Wait for server acknowledgment
-                    try:
-                        response = self.client.recv(1024).decode()
-                        if response == "left_room":
-                            print("Successfully left the room")
-                    except:
-                        pass
-                except:
-                    pass
-                finally:
-                    self.client.close()
-                    self.client = None
-                    self.connected = False
+    def leave_chat(self):
+        """Leave the room and go back to the login screen"""
+        self.is_leaving = True
+        # Stop the message receiving thread
+        self.running = False
+        self.flush_cache()
+
+        # Close the client connection; the receive thread picks up "left_room"
+        if self.client and self.connected:
+            try:
+                self.client.sendall(encode_frame(FRAME_CONTROL, {"event": "leave"}))
+            except:
+                pass
+            finally:
+                self.client.close()
+                self.client = None
+                self.connected = False
 
-            # Clean up chat frame
-            if hasattr(self, 'chat_frame'):
-                self.chat_frame.destroy()
+        # Clean up chat frame
+        if hasattr(self, 'chat_frame'):
+            self.chat_frame.destroy()
+        if self.search_window and self.search_window.winfo_exists():
+            self.search_window.destroy()
 
-            # Reset variables
-            self.username = None
-            self.room = None
-            self.is_leaving = False
+        # Reset variables
+        self.username = None
+        self.room = None
+        self.is_leaving = False
+
+        # Show login frame
+        self.show_login_frame()
 
-            # Show login frame
-            self.show_login_frame()
+    def load_older(self):
+        """Ask the server for the page of history before the oldest one shown"""
+        if not self.connected or not self.has_more_history:
+            return
+        try:
+            self.client.sendall(encode_frame(FRAME_CONTROL, {"event": "load_older", "before": self.oldest_seq}))
+            self.load_older_button.state(['disabled'])  # Until the page arrives
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load older messages: {e}")
+
+    def display_older_page(self, messages, first_seq, has_more):
+        """Insert an older page of history above what is already shown"""
+        self.oldest_seq = first_seq
+        self.has_more_history = has_more
+        self.cache.add(self.server_key(), self.room, enumerate(messages, first_seq))
+        try:
+            if messages:
+                self.text_area.config(state='normal')
+                for message in reversed(messages):
+                    self.insert_message("1.0", message)
+                self.line_kinds.extendleft([True] * len(messages))
+                self.text_area.config(state='disabled')
+                self.text_area.see("1.0")
+            if has_more:
+                self.load_older_button.state(['!disabled'])
+        except Exception as e:
+            print(f"Error updating GUI: {e}")
+
+    def show_search_window(self):
+        """Open the history search window (or bring it to the front)"""
+        if self.search_window and self.search_window.winfo_exists():
+            self.search_window.lift()
+            return
+        window = tk.Toplevel(self.root)
+        window.title("Search History")
+        window.geometry("600x400")
+        self.search_window = window
+
+        query_frame = ttk.Frame(window)
+        query_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.search_entry = ttk.Entry(query_frame)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        self.search_entry.bind("<Return>", lambda e: self.search())
+        self.search_all_rooms = tk.BooleanVar(value=False)
+        ttk.Checkbutton(query_frame, text="All rooms", variable=self.search_all_rooms).pack(side=tk.LEFT, padx=5)
+        ttk.Button(query_frame, text="Search", command=self.search).pack(side=tk.LEFT)
+
+        self.search_results = tk.Listbox(window, font=("Helvetica", 10))
+        self.search_results.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.search_more_button = ttk.Button(window, text="More Results",
+                                             command=lambda: self.search(self.search_cursor))
+        self.search_more_button.pack(pady=5)
+        self.search_more_button.state(['disabled'])
+        self.search_cursor = None
+
+    def search(self, before=None):
+        """Ask the server for a page of matching messages; before continues a previous search"""
+        query = self.search_entry.get().strip()
+        if not query or not self.connected:
+            return
+        if before is None:
+            self.search_results.delete(0, tk.END)
+        request = {"event": "search", "query": query, "all_rooms": self.search_all_rooms.get()}
+        if before is not None:
+            request["before"] = before
+        try:
+            self.client.sendall(encode_frame(FRAME_CONTROL, request))
+            self.search_more_button.state(['disabled'])  # Until the page arrives
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to search: {e}")
+
+    def display_search_results(self, payload):
+        """Append a page of search hits to the search window"""
+        if not (self.search_window and self.search_window.winfo_exists()):
+            return
+        if payload.get("error"):
+            self.search_results.insert(tk.END, payload["error"])
+            return
+        for hit in payload.get("hits", []):
+            prefix = f"#{hit['room']}  " if payload.get("all_rooms") else ""
+            self.search_results.insert(tk.END, prefix + hit["text"])
+        if not self.search_results.size():
+            self.search_results.insert(tk.END, "No messages found")
+        self.search_cursor = payload.get("next")
+        if self.search_cursor is not None:
+            self.search_more_button.state(['!disabled'])
 
     def send_message(self):
         """Send a message to the chat room"""
@@ -301,58 +537,361 @@ class ModernChatClient:
         if message and self.connected:
             timestamp = datetime.now().strftime("%H:%M")
             formatted_message = f"[{timestamp}] {self.username}: {message}"
+            # Shown greyed out until the server acknowledges it; noted before
+            # sending, since the ack can arrive before sendall() returns
+            self.sent_count += 1
+            tag = f"own-{self.sent_count}"
+            self.text_area.tag_config(tag, foreground="grey")
+            with self.unacked_lock:
+                self.unacked.append((formatted_message, tag))
             try:
-                self.client.send(formatted_message.encode())
-                self.display_message(formatted_message)
+                self.client.sendall(encode_frame(FRAME_CHAT, {"text": formatted_message}))
+                self.display_message(formatted_message, tag=tag)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to send message: {e}")
                 self.connected = False
                 self.back_to_login()  # Return to login if message sending fails
             self.message_entry.delete(0, tk.END)
 
-    def receive_messages(self):
-        """Receive and display messages"""
+    def receive_messages(self, session, action=None):
+        """Receive and display messages, reconnecting if the connection drops
+
+        action is set when the room is already shown from the cache and the
+        connection still has to be made here.
+        """
+        if action and not self.finish_join(session, action):
+            return
         while self.running and self.connected:
             try:
-                message = self.client.recv(1024).decode()
-                if not message:
-                    self.connected = False
-                    break
-                if message == "left_room":
+                frame_type, payload = self.read_frame()
+                if frame_type == FRAME_CONTROL and payload.get("event") == "left_room":
+                    print("Successfully left the room")
                     self.connected = False
                     break
-                self.root.after(0, self.display_message, message)
+                if frame_type == FRAME_CHAT:
+                    # Notices such as joins and leaves have no seq, they aren't in the history
+                    self.display_message(payload.get("text", ""), stored="seq" in payload)
+                    if "seq" in payload:
+                        self.note_seq(payload["seq"], payload.get("text", ""))
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "sent":
+                    self.note_seq(payload["seq"], payload.get("text", ""))  # Our own message, already shown
+                    self.settle_own(payload.get("text", ""))
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "rate_limited":
+                    self.settle_own(None)
+                    self.display_message("⚠️ You are sending messages too fast, some were not delivered.",
+                                         stored=False)
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "search_results":
+                    self.root.after(0, self.display_search_results, payload)
+                elif frame_type == FRAME_HISTORY and payload.get("older"):
+                    self.root.after(0, self.display_older_page, payload.get("messages", []),
+                                    payload.get("first_seq", 0), payload.get("has_more", False))
             except socket.timeout:
                 # Timeout is normal, continue the loop
                 continue
             except socket.error:
-                if not self.is_leaving:  # Only show error if we're not already leaving
+                self.connected = False
+                if self.is_leaving or not self.running:
+                    break
+                if self.reconnect(session):
+                    continue
+                if self.running and self.session == session:
                     self.root.after(0, lambda: messagebox.showerror("Connection Error", "Lost connection to server"))
                     self.root.after(0, self.back_to_login)
-                self.connected = False
                 break
             except Exception as e:
                 print(f"Error receiving message: {e}")
                 self.connected = False
                 break
 
-    def display_message(self, message):
-        """Display received message in the text area"""
+    def finish_join(self, session, action):
+        """Connect for a room already shown from the cache; True once in the room"""
+        try:
+            response, history = self.open_session(action, self.last_seq + 1)
+        except (socket.error, ValueError):
+            # Keep showing the cache while retrying
+            if self.reconnect(session):
+                return True
+            if self.running and self.session == session:
+                self.root.after(0, self.connect_failed)
+            return False
+        if response not in ("room_joined", "room_created"):
+            self.close_client()
+            if self.running and self.session == session:
+                self.root.after(0, self.join_failed, response)
+            return False
+        if not self.running or self.session != session:
+            self.close_client()
+            return False
+        self.connected = True
+        self.resync(history, opening=True)
+        return True
+
+    def join_failed(self, response):
+        messagebox.showerror("Error", self.join_error(response))
+        self.leave_chat()
+
+    def connect_failed(self):
+        messagebox.showerror("Connection Error", "Could not connect to server. Make sure the server is running.")
+        self.leave_chat()
+
+    def reconnect(self, session):
+        """Rejoin after a dropped connection with exponential backoff; True once back in the room"""
+        self.flush_cache()
+        delay = RECONNECT_BASE_DELAY
+        for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+            self.display_message(f"⚠️ Connection lost, reconnecting (attempt {attempt} of {RECONNECT_ATTEMPTS})...",
+                                 stored=False)
+            # Jitter, so a room full of clients doesn't come back all at once
+            time.sleep(random.uniform(delay / 2, delay))
+            if not self.running or self.session != session:
+                return False
+            try:
+                response, history = self.open_session("join", self.last_seq + 1)
+                if response == "room_not_found":
+                    # Everyone was dropped and the room closed; bring it back
+                    response, history = self.open_session("create", self.last_seq + 1)
+                if response in ("room_joined", "room_created"):
+                    if not self.running or self.session != session:
+                        self.close_client()
+                        return False
+                    self.connected = True
+                    self.resync(history)
+                    self.display_message("✅ Reconnected", stored=False)
+                    return True
+            except (socket.error, ValueError):
+                pass
+            self.close_client()
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+
+    def resync(self, history, opening=False):
+        """Show the history sent on a join: a fresh page, the messages missed, or a fresh page after a long gap
+
+        opening marks the newer messages fetched for a room shown from the cache.
+        """
+        if not history:
+            return
+        messages = history.get("messages", [])
+        first_seq = history.get("first_seq", 0)
+        server = self.server_key()
+        if not history.get("delta"):
+            if history.get("reset"):
+                # Too much was missed to fill in, start over from the newest page
+                self.pending_lines.clear()
+                self.display_message(None)
+                self.cache.reset(server, self.room)
+            self.oldest_seq = first_seq
+            self.has_more_history = history.get("has_more", False)
+            self.root.after(0, self.update_load_older_button)
+        elif opening and messages:
+            self.display_message("──── New since your last visit ────", stored=False)
+        shown = self.settle_unacked(messages)
+        for message in shown if history.get("delta") else messages:
+            self.display_message(message)
+        self.last_seq = first_seq + len(messages) - 1
+        self.cache.add(server, self.room, enumerate(messages, first_seq))
+        self.flush_cache()
+
+    def update_load_older_button(self):
+        try:
+            self.load_older_button.state(['!disabled' if self.has_more_history else 'disabled'])
+        except tk.TclError:
+            pass  # Back at the login screen
+
+    def settle_own(self, text):
+        """Match an ack from the server against our unacknowledged messages
+
+        The server handles our messages in order, so any sent before the one
+        acknowledged were dropped. A text of None means the oldest one was
+        rejected by the rate limit.
+        """
+        outcomes = []
+        with self.unacked_lock:
+            while self.unacked:
+                own_text, tag = self.unacked.popleft()
+                delivered = text is not None and own_text == text
+                outcomes.append((tag, delivered))
+                if delivered or text is None:
+                    break
+        for tag, delivered in outcomes:
+            self.root.after(0, self.mark_own, tag, delivered)
+
+    def settle_unacked(self, messages):
+        """Settle our messages left unacknowledged by a dropped connection against the history from the rejoin
+
+        The ones in it were stored and are already on screen; the rest were
+        lost with the connection. None is sent again, so nothing can reach
+        the room twice. Returns messages without the ones already shown.
+        """
+        with self.unacked_lock:
+            unacked = list(self.unacked)
+            self.unacked.clear()
+        shown = []
+        for message in messages:
+            texts = [text for text, _ in unacked]
+            if message not in texts:
+                shown.append(message)
+                continue
+            # Any sent before this one and not in the history were dropped
+            i = texts.index(message)
+            for j, (_, tag) in enumerate(unacked[:i + 1]):
+                self.root.after(0, self.mark_own, tag, j == i)
+            unacked = unacked[i + 1:]
+        for _, tag in unacked:
+            self.root.after(0, self.mark_own, tag, False)
+        return shown
+
+    def mark_own(self, tag, delivered):
+        """Restyle one of our own lines once the server accepted or dropped it"""
+        try:
+            if delivered:
+                self.text_area.tag_delete(tag)  # Drawn like any other line from now on
+            else:
+                self.text_area.tag_config(tag, foreground="red", overstrike=True)
+        except tk.TclError:
+            pass  # Back at the login screen
+
+    def display_message(self, message, stored=True, tag=None):
+        """Queue a line for the text area; safe to call from any thread
+
+        stored is False for local notices that aren't part of the room history.
+        tag marks one of our own messages until the server acknowledges it.
+        A message of None clears the text area instead.
+        """
+        self.pending_lines.append((message, stored, tag))
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.root.after(1000 // RENDER_FPS, self.render_pending)
+
+    def render_pending(self):
+        """Draw queued lines in one batch, then trim the scrollback"""
+        self.render_scheduled = False
+        batch = []
+        while self.pending_lines and len(batch) < MAX_LINES_PER_FRAME:
+            batch.append(self.pending_lines.popleft())
+        if self.pending_lines:
+            self.render_scheduled = True
+            self.root.after(1000 // RENDER_FPS, self.render_pending)
+        if not batch:
+            return
         try:
+            # Only follow new messages if the user hasn't scrolled up to read
+            at_bottom = self.text_area.yview()[1] >= 0.999
             self.text_area.config(state='normal')
-            self.text_area.insert(tk.END, message + "\n")
+            plain = []
+            for message, stored, tag in batch:
+                if message is None:
+                    self.text_area.delete("1.0", tk.END)
+                    self.line_kinds.clear()
+                    plain = []
+                    continue
+                if tag or ATTACHMENT_LINE.search(message):
+                    self.text_area.insert(tk.END, "".join(plain))
+                    plain = []
+                    self.insert_message(tk.END, message, tag)
+                else:
+                    plain.append(message + "\n")
+                self.line_kinds.append(stored)
+            self.text_area.insert(tk.END, "".join(plain))
+            self.trim_scrollback()
             self.text_area.config(state='disabled')
-            self.text_area.see(tk.END)
+            if at_bottom:
+                self.text_area.see(tk.END)
         except Exception as e:
             print(f"Error updating GUI: {e}")
 
+    def trim_scrollback(self):
+        """Drop the oldest lines past MAX_SCROLLBACK; "Load Older" can bring them back"""
+        excess = len(self.line_kinds) - MAX_SCROLLBACK
+        if excess <= 0:
+            return
+        self.text_area.delete("1.0", f"{excess + 1}.0")
+        trimmed = sum(self.line_kinds.popleft() for _ in range(excess))
+        if trimmed:
+            self.oldest_seq += trimmed
+            self.has_more_history = True
+            self.load_older_button.state(['!disabled'])
+
+    def insert_message(self, index, message, tag=None):
+        """Insert one message line; attachment lines get a clickable download link
+
+        tag marks one of our own messages, drawn as pending until it is acknowledged.
+        """
+        match = ATTACHMENT_LINE.search(message)
+        if not match:
+            self.text_area.insert(index, message + "\n", tag or ())
+            return
+        name, attachment_id = match.groups()
+        tag = f"attachment-{attachment_id}"
+        self.text_area.tag_config(tag, foreground="blue", underline=True)
+        self.text_area.tag_bind(tag, "<Button-1>",
+                                lambda e: self.download_attachment(attachment_id, name))
+        self.text_area.insert(index, message[:match.start()] + f'shared "{name}" ', (),
+                              "⬇ download", (tag,), "\n", ())
+
+    def attach_file(self):
+        """Pick a file and upload it on its own connection, then share it in the room"""
+        path = filedialog.askopenfilename(title="Attach File")
+        if path and self.connected:
+            threading.Thread(target=self.upload_attachment, args=(path,), daemon=True).start()
+
+    def upload_attachment(self, path):
+        """Upload thread: stream the file to the server's spool"""
+        try:
+            size = os.path.getsize(path)
+            with socket.create_connection((HOST, PORT), timeout=30) as sock, open(path, 'rb') as f:
+                sock.sendall(encode_frame(FRAME_UPLOAD, {"size": size}))
+                sock.sendfile(f)
+                _, reply = read_reply(sock)
+            if reply.get("event") != "upload_done":
+                raise ValueError(reply.get("reason", reply.get("event")))
+            self.root.after(0, self.share_attachment, reply["id"], os.path.basename(path))
+        except Exception as e:
+            self.root.after(0, lambda error=e: messagebox.showerror("Error", f"Failed to upload {path}: {error}"))
+
+    def share_attachment(self, attachment_id, name):
+        """Post an uploaded attachment to the room (on the GUI thread, like other sends)"""
+        if self.connected:
+            try:
+                self.client.sendall(encode_frame(FRAME_CONTROL, {"event": "attach", "id": attachment_id,
+                                                                 "name": name}))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to share attachment: {e}")
+
+    def download_attachment(self, attachment_id, name):
+        """Ask where to save an attachment and download it in the background"""
+        path = filedialog.asksaveasfilename(title="Save Attachment", initialfile=name)
+        if path:
+            threading.Thread(target=self.save_attachment, args=(attachment_id, path), daemon=True).start()
+
+    def save_attachment(self, attachment_id, path):
+        """Download thread: stream an attachment from the server into a file"""
+        try:
+            with socket.create_connection((HOST, PORT), timeout=30) as sock:
+                sock.sendall(encode_frame(FRAME_DOWNLOAD, {"id": attachment_id}))
+                _, reply = read_reply(sock)
+                if reply.get("event") != "download_start":
+                    raise ValueError("the server doesn't have this attachment")
+                remaining = reply["size"]
+                with open(path, 'wb') as f:
+                    while remaining:
+                        data = sock.recv(min(RECV_SIZE, remaining))
+                        if not data:
+                            raise ConnectionError("download cut short")
+                        f.write(data)
+                        remaining -= len(data)
+            self.display_message(f"Saved attachment to {path}", stored=False)
+        except Exception as e:
+            self.root.after(0, lambda error=e: messagebox.showerror("Error", f"Failed to download attachment: {error}"))
+
     def on_closing(self):
         """Handle window closing"""
         if messagebox.askyesno("Exit", "Are you sure you want to exit the application?"):
             self.running = False
+            self.cache.close()
             if self.client and self.connected:
                 try:
-                    self.client.send("exit".encode())
+                    self.client.sendall(encode_frame(FRAME_CONTROL, {"event": "exit"}))
                 except:
                     pass
                 self.client.close()
@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+import time
+
+# Messages seen in each room, keyed by server ("host:port"), room and seq, so a
+# room can be shown from disk the moment it is opened. Each room keeps its
+# newest ROOM_CACHE_LIMIT messages; past TOTAL_CACHE_LIMIT messages overall the
+# least recently opened rooms are dropped.
+ROOM_CACHE_LIMIT = 5000
+TOTAL_CACHE_LIMIT = 100000
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    server TEXT NOT NULL,
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (server, room, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rooms (
+    server TEXT NOT NULL,
+    room TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (server, room)
+) WITHOUT ROWID;
+"""
+
+
+class MessageCache:
+    """Client-side SQLite cache of room messages.
+
+    add() only queues messages; flush() writes what is queued in one
+    transaction and prunes the room, so the receive thread doesn't commit
+    once per message. Safe to use from the GUI and the receive thread.
+    """
+
+    def __init__(self, path, room_limit=ROOM_CACHE_LIMIT, total_limit=TOTAL_CACHE_LIMIT):
+        self.room_limit = room_limit
+        self.total_limit = total_limit
+        self.lock = threading.Lock()
+        self.pending = []  # [(server, room, seq, text)] not written yet
+        try:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")  # Losing the last few on a crash is fine
+            self.conn.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            print(f"Message cache disabled, can't open {path}: {e}")
+            self.conn = None
+
+    def newest(self, server, room, limit):
+        """Return (first_seq, messages) for up to limit newest cached messages with no gaps.
+
+        Marks the room as just used. messages is empty if nothing is cached.
+        """
+        if not self.conn:
+            return 0, []
+        with self.lock:
+            self._flush()
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO rooms (server, room, last_used) VALUES (?, ?, ?)",
+                                  (server, room, time.time()))
+            rows = self.conn.execute(
+                "SELECT seq, text FROM messages WHERE server = ? AND room = ? ORDER BY seq DESC LIMIT ?",
+                (server, room, limit)).fetchall()
+        # Stop at the first gap; whatever is missing gets fetched as part of the delta
+        run = rows[:1]
+        for seq, text in rows[1:]:
+            if seq != run[-1][0] - 1:
+                break
+            run.append((seq, text))
+        if not run:
+            return 0, []
+        return run[-1][0], [text for _, text in reversed(run)]
+
+    def add(self, server, room, records):
+        """Queue (seq, text) records of a room for the next flush()."""
+        with self.lock:
+            self.pending.extend((server, room, seq, text) for seq, text in records)
+
+    def reset(self, server, room):
+        """Forget a room's messages, e.g. when the server could only send a fresh page."""
+        if not self.conn:
+            return
+        with self.lock:
+            self.pending = [record for record in self.pending if record[:2] != (server, room)]
+            with self.conn:
+                self.conn.execute("DELETE FROM messages WHERE server = ? AND room = ?", (server, room))
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.conn or not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO messages (server, room, seq, text) VALUES (?, ?, ?, ?)",
+                                      batch)
+                for server, room in {record[:2] for record in batch}:
+                    self.conn.execute("DELETE FROM messages WHERE server = ? AND room = ? AND seq <= "
+                                      "(SELECT MAX(seq) FROM messages WHERE server = ? AND room = ?) - ?",
+                                      (server, room, server, room, self.room_limit))
+                self._prune_rooms()
+        except sqlite3.Error as e:
+            print(f"Error writing {len(batch)} messages to the cache: {e}")
+
+    def _prune_rooms(self):
+        """Drop least recently opened rooms until the cache is under total_limit."""
+        total = self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if total <= self.total_limit:
+            return
+        sizes = self.conn.execute(
+            "SELECT r.server, r.room, COUNT(m.seq) FROM rooms r JOIN messages m"
+            " ON m.server = r.server AND m.room = r.room"
+            " GROUP BY r.server, r.room ORDER BY r.last_used").fetchall()
+        for server, room, count in sizes[:-1]:  # Never the room in use
+            self.conn.execute("DELETE FROM messages WHERE server = ? AND room = ?", (server, room))
+            self.conn.execute("DELETE FROM rooms WHERE server = ? AND room = ?", (server, room))
+            total -= count
+            if total <= self.total_limit:
+                break
+
+    def close(self):
+        if self.conn:
+            self.flush()
+            self.conn.close()
+            self.conn = None
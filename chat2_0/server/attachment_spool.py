@@ -0,0 +1,88 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+# Attachments are stored once per content under <spool>/<first 2 hex>/<sha256>,
+# so the same file shared twice (or in two rooms) takes up space only once.
+ATTACHMENT_ID = re.compile(r"[0-9a-f]{64}")
+STALE_UPLOAD_SECONDS = 3600
+
+
+class SpoolUpload:
+    """An attachment being received: written to a temp file and hashed as it arrives."""
+
+    def __init__(self, spool):
+        self.spool = spool
+        fd, self.tmp_path = tempfile.mkstemp(dir=spool.tmp_dir, suffix=".part")
+        self.file = os.fdopen(fd, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        """Move the upload to its content address and return its id."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        attachment_id = self.digest.hexdigest()
+        path = self.spool.path_for(attachment_id, existing=False)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)  # Already spooled, keep the first copy
+        else:
+            os.replace(self.tmp_path, path)
+        return attachment_id
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class AttachmentSpool:
+    """Content-addressed store for uploaded attachments."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # Uploads cut off by a crash; recent ones may belong to another worker process
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            if time.time() - os.path.getmtime(path) > STALE_UPLOAD_SECONDS:
+                os.remove(path)
+
+    def begin(self):
+        return SpoolUpload(self)
+
+    def path_for(self, attachment_id, existing=True):
+        """Path of an attachment, or None for a malformed id (or a missing file if existing)."""
+        if not isinstance(attachment_id, str) or not ATTACHMENT_ID.fullmatch(attachment_id):
+            return None
+        path = os.path.join(self.directory, attachment_id[:2], attachment_id)
+        if existing and not os.path.isfile(path):
+            return None
+        return path
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def attachment_message(username, name, size, attachment_id):
+    """The chat line that stands in for an attachment in the room and its history."""
+    # Keep the name to one line without the quotes that delimit it
+    name = os.path.basename(name.replace("\\", "/")).replace('"', "'").replace("\n", " ").strip() or "file"
+    return f'📎 {username} shared "{name}" ({format_size(size)}) attachment:{attachment_id}'
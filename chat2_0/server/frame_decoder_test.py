@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """server2_0, imported from a scratch directory since importing it creates the attachment spool."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    try:
+        import server2_0
+    finally:
+        os.chdir(cwd)
+    return server2_0
+
+
+def test_frame_split_across_feeds(server):
+    data = server.encode_frame(server.FRAME_CHAT, {"text": "hello"})
+    decoder = server.FrameDecoder()
+    for i in range(len(data) - 1):
+        assert decoder.feed(data[i:i + 1]) == []
+    assert decoder.feed(data[-1:]) == [(server.FRAME_CHAT, {"text": "hello"})]
+    assert decoder.buffer == bytearray()
+
+
+def test_frames_merged_in_one_feed(server):
+    frames = [(server.FRAME_HELLO, {"username": "a", "room": "r", "action": "join"}),
+              (server.FRAME_CHAT, {"text": "one"}),
+              (server.FRAME_CONTROL, {"event": "exit"})]
+    data = b"".join(server.encode_frame(frame_type, payload) for frame_type, payload in frames)
+    assert server.FrameDecoder().feed(data) == frames
+
+
+def test_partial_frame_after_complete_one_is_kept(server):
+    first = server.encode_frame(server.FRAME_CHAT, {"text": "first"})
+    second = server.encode_frame(server.FRAME_CHAT, {"text": "second"})
+    decoder = server.FrameDecoder()
+    assert decoder.feed(first + second[:5]) == [(server.FRAME_CHAT, {"text": "first"})]
+    assert decoder.feed(second[5:]) == [(server.FRAME_CHAT, {"text": "second"})]
+
+
+def test_raw_data_after_upload_frame_is_left_in_the_buffer(server):
+    data = server.encode_frame(server.FRAME_UPLOAD, {"size": 4}) + b"\x00\x01\x02\x03"
+    decoder = server.FrameDecoder()
+    assert decoder.feed(data) == [(server.FRAME_UPLOAD, {"size": 4})]
+    assert bytes(decoder.buffer) == b"\x00\x01\x02\x03"
+
+
+def test_bad_magic_is_rejected(server):
+    with pytest.raises(server.ProtocolError):
+        server.FrameDecoder().feed(b"GET / HTTP/1.1\r\n")
+
+
+def test_oversized_frame_is_rejected(server):
+    header = server.FRAME_HEADER.pack(server.FRAME_MAGIC, server.FRAME_VERSION, server.FRAME_CHAT,
+                                      server.MAX_FRAME_SIZE + 1)
+    with pytest.raises(server.ProtocolError):
+        server.FrameDecoder().feed(header)
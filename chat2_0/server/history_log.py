@@ -0,0 +1,544 @@
+import argparse
+import bisect
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+# Each record is a fixed header followed by the UTF-8 message text
+RECORD_HEADER = struct.Struct("!IIQd")  # payload length, crc32, seq, timestamp
+# Sparse index entry written every INDEX_INTERVAL records of a segment
+INDEX_ENTRY = struct.Struct("!QdQ")  # seq, timestamp, byte offset in the segment
+
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024  # Roll to a new segment file past this size
+DEFAULT_INDEX_INTERVAL = 64
+
+# Group commit: appended records are flushed (and maybe fsynced) together
+# every COMMIT_INTERVAL seconds or COMMIT_BATCH messages, whichever is first.
+#   never  - flush to the OS only; survives a crash of the server, not of the machine
+#   batch  - fsync once per group commit
+#   always - fsync every message before append() returns (slow, no batching)
+FSYNC_POLICIES = ("never", "batch", "always")
+DEFAULT_FSYNC_POLICY = "batch"
+DEFAULT_COMMIT_INTERVAL = 0.01
+DEFAULT_COMMIT_BATCH = 256
+
+
+def fsync_directory(directory):
+    """Make renames and new files in directory durable; not possible on Windows."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data, fsync=True):
+    """Replace path with data so readers see either the old file or the new one, never half.
+
+    With fsync the new file also survives a crash once this returns.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync:
+        fsync_directory(os.path.dirname(path) or ".")
+
+
+class CommitStats:
+    """Counts group commits and how many messages each one carried."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.messages = 0
+        self.fsyncs = 0
+        self.max_batch = 0
+        self.batch_sizes = {}  # {power of two: commits with a batch size up to it}
+
+    def record(self, batch, fsyncs=0):
+        bucket = 1 << max(batch - 1, 0).bit_length()
+        with self.lock:
+            self.commits += 1
+            self.messages += batch
+            self.fsyncs += fsyncs
+            self.max_batch = max(self.max_batch, batch)
+            self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "fsync": self.policy,
+                "commits": self.commits,
+                "messages": self.messages,
+                "fsyncs": self.fsyncs,
+                "avg_batch": round(self.messages / self.commits, 2) if self.commits else 0,
+                "max_batch": self.max_batch,
+                "batch_sizes": {f"<={size}": count for size, count in sorted(self.batch_sizes.items())},
+            }
+
+
+class GroupCommitter:
+    """Background flusher shared by every open RoomLog.
+
+    append() only writes into the log's file buffer and marks it dirty; this
+    thread commits all dirty logs at once, so a burst of messages costs one
+    flush and at most one fsync per room instead of one per message.
+    """
+
+    def __init__(self, fsync=DEFAULT_FSYNC_POLICY, interval=DEFAULT_COMMIT_INTERVAL,
+                 batch=DEFAULT_COMMIT_BATCH):
+        self.fsync = fsync
+        self.interval = interval
+        self.batch = batch
+        self.stats = CommitStats(fsync)
+        self.cond = threading.Condition()
+        self.dirty = set()
+        self.marked = 0  # Messages appended so far
+        self.committed = 0  # ... and how many of them are committed
+        self.closing = False
+        self.flush_now = False  # Set by sync() to cut the commit interval short
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def mark(self, log):
+        """Note one message appended to log; called with the log's lock held."""
+        with self.cond:
+            self.dirty.add(log)
+            self.marked += 1
+            if self.marked - self.committed in (1, self.batch):
+                self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.dirty and not self.closing:
+                    self.cond.wait()
+                deadline = time.monotonic() + self.interval
+                while self.marked - self.committed < self.batch and not self.closing and not self.flush_now:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                dirty, self.dirty = self.dirty, set()
+                self.flush_now = False
+                target = self.marked
+                if not dirty and self.closing:
+                    break
+            batch = fsyncs = 0
+            for log in dirty:
+                try:
+                    committed, synced = log.commit(self.fsync == "batch")
+                    batch += committed
+                    fsyncs += synced
+                except (OSError, ValueError) as e:
+                    print(f"Error committing {log.directory}: {e}")
+            if batch:
+                self.stats.record(batch, fsyncs)
+            with self.cond:
+                self.committed = target
+                self.cond.notify_all()
+
+    def sync(self):
+        """Block until everything appended so far is committed."""
+        with self.cond:
+            target = self.marked
+            self.flush_now = True
+            self.cond.notify_all()
+            while self.committed < target and self.thread.is_alive():
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class Segment:
+    """One segment file of a room log plus its sparse index."""
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.index = []  # [(seq, timestamp, offset)], sorted by seq and timestamp
+        self.size = 0
+        self.next_seq = base_seq
+        self.last_ts = 0.0
+
+    def load_index(self):
+        """Read the index file, ignoring a torn last entry."""
+        self.index = []
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        self.index = [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+    def write_index(self, fsync=True):
+        """Rewrite the whole index file from memory, atomically."""
+        atomic_write(self.index_path, b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index), fsync)
+
+    def index_matches_file(self):
+        """Whether the index file holds exactly the in-memory entries and nothing torn after them."""
+        size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        return size == len(self.index) * INDEX_ENTRY.size
+
+    def offset_for_seq(self, seq):
+        """Byte offset of the closest indexed record at or before seq."""
+        i = bisect.bisect_right([entry[0] for entry in self.index], seq) - 1
+        return self.index[i][2] if i >= 0 else 0
+
+    def offset_for_ts(self, timestamp):
+        """Byte offset of the closest indexed record strictly before timestamp."""
+        i = bisect.bisect_left([entry[1] for entry in self.index], timestamp) - 1
+        return self.index[i][2] if i >= 0 else 0
+
+    def first_ts(self):
+        return self.index[0][1] if self.index else 0.0
+
+
+def iter_records(path, offset=0):
+    """Yield (offset, seq, timestamp, message, end_offset) until the data stops being valid."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc, seq, timestamp = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            end = offset + RECORD_HEADER.size + length
+            yield offset, seq, timestamp, payload.decode(), end
+            offset = end
+
+
+class RoomLog:
+    """Append-only, length-delimited message log for one room.
+
+    Messages get consecutive sequence numbers and are written to rolling
+    segment files. Every segment keeps a sparse (seq, timestamp, offset) index,
+    so reading the last N messages or everything since a time only scans from
+    the nearest index entry instead of from the start of the history.
+
+    Without a committer every append is flushed straight away. With one, the
+    committer's thread flushes appends in groups; readers flush first so they
+    always see every appended message. Group commits fsync outside the lock,
+    so appends carry on while the disk catches up.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 index_interval=DEFAULT_INDEX_INTERVAL, committer=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.committer = committer
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()  # One commit at a time, taken before `lock`
+        self.segments = []
+        self.log_file = None
+        self.index_file = None
+        self.uncommitted = 0  # Messages written to the file buffers since the last commit
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        """Load every segment and recover the active one after a crash."""
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for base in bases:
+            segment = Segment(self.directory, base)
+            segment.load_index()
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+            open(self.segments[0].path, 'ab').close()
+
+        # Sealed segments are trusted; rebuild an index only if it went missing
+        for segment in self.segments[:-1]:
+            if not segment.index:
+                self._recover(segment)
+            else:
+                segment.size = os.path.getsize(segment.path)
+        self._recover(self.segments[-1])
+
+        # Sealed segments end where the next one begins
+        for previous, segment in zip(self.segments, self.segments[1:]):
+            previous.next_seq = segment.base_seq
+            segment.last_ts = max(segment.last_ts, previous.last_ts, previous.first_ts())
+
+        active = self.segments[-1]
+        self.log_file = open(active.path, 'ab')
+        self.index_file = open(active.index_path, 'ab')
+
+    def _recover(self, segment):
+        """Scan a segment from its last index entry and cut off any torn tail."""
+        # Without fsync the index can outlive the data it points at
+        file_size = os.path.getsize(segment.path)
+        loaded = list(segment.index)
+        while segment.index and segment.index[-1][2] >= file_size:
+            segment.index.pop()
+        start = segment.index[-1][2] if segment.index else 0
+        valid = {entry[2] for entry in segment.index}
+        end = start
+        segment.next_seq = segment.index[-1][0] if segment.index else segment.base_seq
+        segment.last_ts = segment.index[-1][1] if segment.index else 0.0
+        for offset, seq, timestamp, _, record_end in iter_records(segment.path, start):
+            if (seq - segment.base_seq) % self.index_interval == 0 and offset not in valid:
+                segment.index.append((seq, timestamp, offset))
+            segment.next_seq = seq + 1
+            segment.last_ts = timestamp
+            end = record_end
+
+        if file_size > end:
+            print(f"Truncating torn record at {segment.path}:{end}")
+            with open(segment.path, 'r+b') as f:
+                f.truncate(end)
+        segment.index = [entry for entry in segment.index if entry[2] < end]
+        segment.size = end
+        # Entries are appended to the index file from here on, so it must match memory exactly
+        if segment.index != loaded or not segment.index_matches_file():
+            segment.write_index(self._fsync_enabled())
+
+    @property
+    def first_seq(self):
+        return self.segments[0].base_seq
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].next_seq
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def append(self, message, timestamp=None, sync=True):
+        """Append one message and return its sequence number.
+
+        Under the "always" policy, sync=False returns before the fsync, for a
+        caller that can't block on the disk; it calls sync() later instead.
+        """
+        payload = message.encode()
+        with self.lock:
+            active = self.segments[-1]
+            if active.size >= self.segment_bytes and active.next_seq > active.base_seq:
+                active = self._roll()
+            # Timestamps never go backwards so "since T" can binary search them
+            timestamp = max(time.time() if timestamp is None else timestamp, active.last_ts)
+            seq = active.next_seq
+            record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq, timestamp) + payload
+            self.log_file.write(record)
+            if (seq - active.base_seq) % self.index_interval == 0:
+                entry = (seq, timestamp, active.size)
+                active.index.append(entry)
+                self.index_file.write(INDEX_ENTRY.pack(*entry))
+            active.size += len(record)
+            active.next_seq = seq + 1
+            active.last_ts = timestamp
+            self.uncommitted += 1
+            if self.committer is None:
+                self._commit(False)
+            elif self.committer.fsync != "always":
+                self.committer.mark(self)
+                return seq
+        if self.committer is not None and sync:
+            # "always": durable before returning; appends racing with this one share the fsync
+            self.sync()
+        return seq
+
+    def sync(self):
+        """Commit everything appended so far, with an fsync unless the policy is "never"."""
+        committed, fsyncs = self.commit(self._fsync_enabled())
+        if committed and self.committer is not None:
+            self.committer.stats.record(committed, fsyncs)
+
+    def _flush(self):
+        """Hand buffered records to the OS, data before index; caller holds the lock.
+
+        Returns how many messages that committed.
+        """
+        committed, self.uncommitted = self.uncommitted, 0
+        if committed and self.log_file is not None:
+            self.log_file.flush()
+            self.index_file.flush()
+        return committed
+
+    def _commit(self, fsync):
+        """Flush, and fsync if asked, all under the lock; for rolling and closing.
+
+        Returns (messages committed, fsyncs done).
+        """
+        committed = self._flush()
+        if not committed or not fsync or self.log_file is None:
+            return committed, 0
+        os.fsync(self.log_file.fileno())
+        os.fsync(self.index_file.fileno())
+        return committed, 1
+
+    def commit(self, fsync=False):
+        """Make everything appended so far visible to readers, and durable if fsync.
+
+        Only the flush holds the lock. The fsync runs on duplicates of the
+        file descriptors, which stay valid even if the segment rolls or the
+        log closes meanwhile. The commit lock keeps a second commit from
+        returning before the fsync of records the first one flushed.
+        """
+        with self.commit_lock:
+            with self.lock:
+                committed = self._flush()
+                if not committed or not fsync or self.log_file is None:
+                    return committed, 0
+                fds = [os.dup(f.fileno()) for f in (self.log_file, self.index_file)]
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            return committed, 1
+
+    def _roll(self):
+        """Seal the active segment and start a new one at the next sequence number."""
+        previous = self.segments[-1]
+        committed, fsyncs = self._commit(self._fsync_enabled())
+        if committed and self.committer:
+            self.committer.stats.record(committed, fsyncs)
+        self.log_file.close()
+        self.index_file.close()
+        segment = Segment(self.directory, previous.next_seq)
+        segment.last_ts = previous.last_ts
+        self.segments.append(segment)
+        self.log_file = open(segment.path, 'ab')
+        self.index_file = open(segment.index_path, 'ab')
+        if self._fsync_enabled():
+            fsync_directory(self.directory)
+        return segment
+
+    def _fsync_enabled(self):
+        return self.committer is not None and self.committer.fsync != "never"
+
+    def _snapshot(self):
+        with self.lock:
+            # Readers open the files separately, so hand them anything still buffered
+            if self.uncommitted and self.log_file:
+                self.log_file.flush()
+                self.index_file.flush()
+            return list(self.segments), self.next_seq
+
+    def read_range(self, start_seq, limit=None):
+        """Return up to limit (seq, timestamp, message) records starting at start_seq."""
+        if limit is not None and limit <= 0:
+            return []
+        segments, end_seq = self._snapshot()
+        start_seq = max(start_seq, segments[0].base_seq)
+        i = max(bisect.bisect_right([s.base_seq for s in segments], start_seq) - 1, 0)
+        records = []
+        for segment in segments[i:]:
+            for _, seq, timestamp, message, _ in iter_records(segment.path, segment.offset_for_seq(start_seq)):
+                if seq >= end_seq:
+                    return records
+                if seq < start_seq:
+                    continue
+                records.append((seq, timestamp, message))
+                if limit is not None and len(records) >= limit:
+                    return records
+        return records
+
+    def read_last(self, count):
+        """Return the most recent count records, oldest first."""
+        return self.read_range(max(self.next_seq - count, self.first_seq))
+
+    def read_since(self, timestamp, limit=None):
+        """Return up to limit records written at or after timestamp."""
+        if limit is not None and limit <= 0:
+            return []
+        segments, end_seq = self._snapshot()
+        i = max(bisect.bisect_left([s.first_ts() for s in segments], timestamp) - 1, 0)
+        records = []
+        for segment in segments[i:]:
+            for _, seq, ts, message, _ in iter_records(segment.path, segment.offset_for_ts(timestamp)):
+                if seq >= end_seq:
+                    return records
+                if ts < timestamp:
+                    continue
+                records.append((seq, ts, message))
+                if limit is not None and len(records) >= limit:
+                    return records
+        return records
+
+    def close(self):
+        with self.lock:
+            committed, fsyncs = self._commit(self._fsync_enabled())
+            if committed and self.committer:
+                self.committer.stats.record(committed, fsyncs)
+            for f in (self.log_file, self.index_file):
+                if f:
+                    f.close()
+            self.log_file = self.index_file = None
+
+
+def migrate_json_room(history_dir, room):
+    """Convert chat_history/<room>.json into a room log. Returns the number of messages moved.
+
+    The log is built in a temporary directory and renamed into place, so a
+    crash halfway through leaves the JSON file as the source of truth.
+    """
+    json_path = os.path.join(history_dir, f"{room}.json")
+    log_dir = os.path.join(history_dir, room)
+    if os.path.isdir(log_dir):
+        return 0
+
+    with open(json_path, 'r') as f:
+        messages = json.load(f)
+    # The JSON format never stored send times, the file's mtime is the best we have
+    timestamp = os.path.getmtime(json_path)
+
+    tmp_dir = log_dir + ".migrating"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    log = RoomLog(tmp_dir)
+    for message in messages:
+        log.append(str(message), timestamp)
+    log.close()
+    for name in os.listdir(tmp_dir):
+        with open(os.path.join(tmp_dir, name), 'rb') as f:
+            os.fsync(f.fileno())
+    os.replace(tmp_dir, log_dir)
+    os.replace(json_path, json_path + ".migrated")
+    fsync_directory(history_dir)
+    return len(messages)
+
+
+def migrate_json_history(history_dir):
+    """One-shot migration of every legacy <room>.json file in history_dir."""
+    for name in sorted(os.listdir(history_dir)):
+        if not name.endswith(".json"):
+            continue
+        room = name[:-len(".json")]
+        try:
+            moved = migrate_json_room(history_dir, room)
+            print(f"Migrated {moved} messages for room {room}")
+        except Exception as e:
+            print(f"Error migrating history for room {room}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate JSON chat history to append-only room logs")
+    parser.add_argument('history_dir', nargs='?', default="chat_history", help="The chat history directory")
+    args = parser.parse_args()
+    migrate_json_history(args.history_dir)
@@ -0,0 +1,131 @@
+import os
+
+import history_log
+from history_log import RoomLog
+
+
+def make_log(path, count, **kwargs):
+    log = RoomLog(str(path), **kwargs)
+    for i in range(count):
+        log.append(f"m{i}", 1000.0 + i)
+    return log
+
+
+def test_read_range_limit_zero_returns_nothing(tmp_path):
+    log = make_log(tmp_path / "room", 5)
+    assert log.read_range(0, 0) == []
+    assert log.read_range(3, 0) == []
+    assert log.read_since(1000.0, 0) == []
+    log.close()
+
+
+def test_paging_to_the_start_does_not_repeat_a_message(tmp_path):
+    log = make_log(tmp_path / "room", 5)
+    first_page = log.read_range(2, 3)
+    # The page before the one starting at seq 2, the way the server asks for it
+    older_page = log.read_range(0, 2)
+    last_page = log.read_range(0, 0)
+    seqs = [seq for seq, _, _ in older_page + first_page + last_page]
+    assert seqs == [0, 1, 2, 3, 4]
+    log.close()
+
+
+def messages(records):
+    return [message for _, _, message in records]
+
+
+def test_truncated_record_is_cut_off_on_reopen(tmp_path):
+    log = make_log(tmp_path / "room", 10)
+    path = log.segments[-1].path
+    log.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)  # A crash in the middle of the last record
+
+    log = RoomLog(str(tmp_path / "room"))
+    assert log.next_seq == 9
+    assert messages(log.read_last(2)) == ["m7", "m8"]
+    assert log.append("after") == 9
+    assert messages(log.read_range(8)) == ["m8", "after"]
+    log.close()
+
+
+def test_torn_header_and_stale_index_are_recovered(tmp_path):
+    log = make_log(tmp_path / "room", 10, index_interval=2)
+    path = log.segments[-1].path
+    offset = log.segments[-1].index[-1][2]  # Where the last indexed record (seq 8) starts
+    log.close()
+    with open(path, "r+b") as f:
+        f.truncate(offset)  # The index still points at the records cut off here
+        f.seek(offset)
+        f.write(b"\x00\x00\x00")
+
+    log = RoomLog(str(tmp_path / "room"), index_interval=2)
+    assert os.path.getsize(path) == offset
+    assert log.next_seq == 8
+    assert messages(log.read_range(0)) == [f"m{i}" for i in range(8)]
+    assert log.append("after") == 8
+    log.close()
+
+
+def test_read_range_edges(tmp_path):
+    log = make_log(tmp_path / "room", 5)
+    assert messages(log.read_range(0)) == ["m0", "m1", "m2", "m3", "m4"]
+    assert messages(log.read_range(3, 10)) == ["m3", "m4"]
+    assert log.read_range(5) == []
+    assert log.read_range(50, 3) == []
+    assert messages(log.read_last(10)) == ["m0", "m1", "m2", "m3", "m4"]
+    log.close()
+
+
+def test_read_range_across_segments(tmp_path):
+    log = make_log(tmp_path / "room", 200, segment_bytes=512, index_interval=4)
+    assert len(log.segments) > 3
+    assert [seq for seq, _, _ in log.read_range(0)] == list(range(200))
+    assert messages(log.read_range(95, 10)) == [f"m{i}" for i in range(95, 105)]
+    log.close()
+
+    reopened = RoomLog(str(tmp_path / "room"), segment_bytes=512, index_interval=4)
+    assert messages(reopened.read_range(150, 3)) == ["m150", "m151", "m152"]
+    reopened.close()
+
+
+def test_read_since_edges(tmp_path):
+    log = make_log(tmp_path / "room", 5)
+    assert messages(log.read_since(0)) == ["m0", "m1", "m2", "m3", "m4"]
+    assert messages(log.read_since(1002.0)) == ["m2", "m3", "m4"]
+    assert messages(log.read_since(1002.5, 1)) == ["m3"]
+    assert log.read_since(1005.0) == []
+    log.close()
+
+
+def test_timestamps_never_go_backwards(tmp_path):
+    log = make_log(tmp_path / "room", 3)
+    log.append("late", 500.0)
+    assert log.read_last(1)[0][1] == 1002.0
+    assert messages(log.read_since(1002.0)) == ["m2", "late"]
+    log.close()
+
+
+def test_reopening_a_clean_log_leaves_the_index_alone(tmp_path):
+    log = make_log(tmp_path / "room", 10, index_interval=2)
+    index_path = log.segments[-1].index_path
+    log.close()
+    inode = os.stat(index_path).st_ino
+
+    log = RoomLog(str(tmp_path / "room"), index_interval=2)
+    assert os.stat(index_path).st_ino == inode  # Not replaced by a rewrite
+    log.close()
+
+
+def test_torn_index_entry_is_rewritten(tmp_path):
+    log = make_log(tmp_path / "room", 10, index_interval=2)
+    index_path = log.segments[-1].index_path
+    log.close()
+    with open(index_path, "ab") as f:
+        f.write(b"\x00\x00\x00")
+
+    log = RoomLog(str(tmp_path / "room"), index_interval=2)
+    assert os.path.getsize(index_path) % history_log.INDEX_ENTRY.size == 0
+    log.append("after")
+    assert messages(log.read_range(9)) == ["m9", "after"]
+    log.close()
@@ -0,0 +1,299 @@
+import sqlite3
+import threading
+import time
+
+from history_log import (CommitStats, DEFAULT_COMMIT_BATCH, DEFAULT_COMMIT_INTERVAL,
+                         DEFAULT_FSYNC_POLICY)
+
+# One database holds every room. Messages are keyed by (room, seq) like the
+# room logs, with an FTS5 index over their text for searching.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_room_seq ON messages (room, seq);
+CREATE INDEX IF NOT EXISTS messages_room_ts ON messages (room, ts);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (text, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+SEARCH_PAGE_SIZE = 20
+READER_POOL_SIZE = 4  # Idle read connections kept open for reuse
+# PRAGMA synchronous for each fsync policy; FULL syncs the WAL on every commit
+SYNCHRONOUS = {"never": "OFF", "batch": "FULL", "always": "FULL"}
+
+
+class SqliteHistory:
+    """Chat history for every room in one SQLite database in WAL mode.
+
+    Appends only queue the row; a writer thread group-commits what piles up
+    within `interval` seconds (or `batch` rows) in a single transaction, so a
+    busy server pays for one commit per batch rather than one per message.
+    Reads of a room add its queued rows from memory instead of waiting for
+    them; only search, which needs the full-text index, waits for a commit.
+    The "always" fsync policy commits every row on its own.
+    """
+
+    def __init__(self, path, fsync=DEFAULT_FSYNC_POLICY, interval=DEFAULT_COMMIT_INTERVAL,
+                 batch=DEFAULT_COMMIT_BATCH):
+        self.path = path
+        self.fsync = fsync
+        self.interval = 0 if fsync == "always" else interval
+        self.batch = 1 if fsync == "always" else batch
+        self.stats = CommitStats(fsync)
+        self.readers = []  # Idle read connections
+        self.readers_lock = threading.Lock()
+        self.pending = []  # [(room, seq, ts, text)] not yet handed to the writer
+        self.writing = []  # ... and the batch the writer is committing
+        self.queued = 0
+        self.committed = 0
+        self.closing = False
+        self.flush_now = False  # Set by sync() to cut the commit interval short
+        self.cond = threading.Condition()
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            print("SQLite was built without FTS5, search falls back to a full scan")
+            self.has_fts = False
+        conn.commit()
+        self._return_reader(conn)
+        self.writer_thread = threading.Thread(target=self._run, daemon=True)
+        self.writer_thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[self.fsync]}")
+        return conn
+
+    def _borrow_reader(self):
+        with self.readers_lock:
+            if self.readers:
+                return self.readers.pop()
+        return self._connect()
+
+    def _return_reader(self, conn):
+        with self.readers_lock:
+            if len(self.readers) < READER_POOL_SIZE:
+                self.readers.append(conn)
+                return
+        conn.close()
+
+    def _query(self, sql, params):
+        """Run a read-only query on a pooled connection and return every row."""
+        conn = self._borrow_reader()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self._return_reader(conn)
+
+    def _queued_rows(self, room):
+        """(seq, ts, text) of a room's rows that are queued or being written, oldest first."""
+        with self.cond:
+            return [row[1:] for row in self.writing + self.pending if row[0] == room]
+
+    def _run(self):
+        """Writer thread: commit queued rows a batch at a time."""
+        conn = self._connect()
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                deadline = time.monotonic() + self.interval
+                while len(self.pending) < self.batch and not self.closing and not self.flush_now:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.pending = self.pending[:self.batch], self.pending[self.batch:]
+                self.writing = batch
+                self.flush_now = self.flush_now and bool(self.pending)
+            if not batch:
+                break
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO messages (room, seq, ts, text) VALUES (?, ?, ?, ?)", batch)
+                self.stats.record(len(batch), 0 if self.fsync == "never" else 1)
+            except sqlite3.Error as e:
+                print(f"Error saving {len(batch)} messages to {self.path}: {e}")
+            with self.cond:
+                self.writing = []
+                self.committed += len(batch)
+                self.cond.notify_all()
+        conn.close()
+
+    def append(self, room, seq, timestamp, text):
+        with self.cond:
+            self.pending.append((room, seq, timestamp, text))
+            self.queued += 1
+            if len(self.pending) in (1, self.batch):
+                self.cond.notify_all()
+
+    def sync(self, room=None):
+        """Block until everything appended so far is committed.
+
+        With room, return at once unless that room has rows queued.
+        """
+        with self.cond:
+            if room is not None and not any(row[0] == room for row in self.writing + self.pending):
+                return
+            target = self.queued
+            self.flush_now = True
+            self.cond.notify_all()
+            while self.committed < target and self.writer_thread.is_alive():
+                self.cond.wait()
+
+    def _with_queued(self, rows, queued, limit):
+        """Follow committed rows with the queued ones past them, up to limit."""
+        if queued:
+            last_seq = rows[-1][0] if rows else -1
+            rows += [row for row in queued if row[0] > last_seq]
+        return rows if limit is None else rows[:limit]
+
+    def room_bounds(self, room):
+        """Return (first_seq, next_seq, last_ts) of a room's stored messages."""
+        # Queued rows first: once committed they are in the table anyway
+        queued = self._queued_rows(room)
+        first, last, last_ts = self._query(
+            "SELECT MIN(seq), MAX(seq), MAX(ts) FROM messages WHERE room = ?", (room,))[0]
+        if queued:
+            first = queued[0][0] if first is None else first
+            last, last_ts = queued[-1][0], queued[-1][1]
+        if first is None:
+            return 0, 0, 0.0
+        return first, last + 1, last_ts
+
+    def read_range(self, room, start_seq, limit=None):
+        queued = [row for row in self._queued_rows(room) if row[0] >= start_seq]
+        rows = self._query(
+            "SELECT seq, ts, text FROM messages WHERE room = ? AND seq >= ? ORDER BY seq LIMIT ?",
+            (room, start_seq, -1 if limit is None else limit))
+        return self._with_queued(rows, queued, limit)
+
+    def read_since(self, room, timestamp, limit=None):
+        queued = [row for row in self._queued_rows(room) if row[1] >= timestamp]
+        rows = self._query(
+            "SELECT seq, ts, text FROM messages WHERE room = ? AND ts >= ? ORDER BY seq LIMIT ?",
+            (room, timestamp, -1 if limit is None else limit))
+        return self._with_queued(rows, queued, limit)
+
+    def import_records(self, room, records):
+        """Copy (seq, timestamp, text) records of an existing room log in one transaction."""
+        self.sync(room)
+        conn = self._borrow_reader()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO messages (room, seq, ts, text) VALUES (?, ?, ?, ?)",
+                                 ((room, seq, ts, text) for seq, ts, text in records))
+        finally:
+            self._return_reader(conn)
+
+    def search(self, text, room=None, before=None, limit=SEARCH_PAGE_SIZE):
+        """Newest-first messages containing every word of text, in one room or all of them.
+
+        Returns (hits, next_cursor); pass next_cursor back as before for the
+        next page. It is None on the last page.
+        """
+        self.sync(room)
+        words = text.split()
+        if not words:
+            return [], None
+        conditions, params = [], []
+        if self.has_fts:
+            # Quote every word so FTS5 operators in the text are searched for literally
+            query = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+            sql = ("SELECT m.id, m.room, m.seq, m.ts, m.text FROM messages_fts"
+                   " JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?")
+            params.append(query)
+        else:
+            sql = "SELECT m.id, m.room, m.seq, m.ts, m.text FROM messages m WHERE 1"
+            for word in words:
+                conditions.append("m.text LIKE ?")
+                params.append(f"%{word}%")
+        if room is not None:
+            conditions.append("m.room = ?")
+            params.append(room)
+        if before is not None:
+            conditions.append("m.id < ?")
+            params.append(before)
+        for condition in conditions:
+            sql += " AND " + condition
+        sql += " ORDER BY m.id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        rows = self._query(sql, params)
+        hits = [{"room": r[1], "seq": r[2], "ts": r[3], "text": r[4]} for r in rows[:limit]]
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return hits, next_cursor
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.writer_thread.join()
+        with self.readers_lock:
+            readers, self.readers = self.readers, []
+        for conn in readers:
+            conn.close()
+
+
+class SqliteRoomLog:
+    """One room's view of a SqliteHistory, with the same interface as RoomLog.
+
+    Sequence numbers are handed out here so append() returns at once; the row
+    itself is written by the history's writer thread.
+    """
+
+    def __init__(self, history, room):
+        self.history = history
+        self.room = room
+        self.lock = threading.Lock()
+        self.first_seq, self.next_seq, self.last_ts = history.room_bounds(room)
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def append(self, message, timestamp=None, sync=True):
+        """Queue one message and return its sequence number.
+
+        sync is there to match RoomLog.append(); the writer thread commits either way.
+        """
+        with self.lock:
+            # Timestamps never go backwards, same as in the room logs
+            timestamp = max(time.time() if timestamp is None else timestamp, self.last_ts)
+            seq = self.next_seq
+            self.history.append(self.room, seq, timestamp, message)
+            self.next_seq = seq + 1
+            self.last_ts = timestamp
+            return seq
+
+    def import_log(self, log):
+        """Take over the messages of an existing room log; only for a room with none yet."""
+        self.history.import_records(self.room, log.read_range(log.first_seq))
+        self.first_seq, self.next_seq, self.last_ts = self.history.room_bounds(self.room)
+
+    def read_range(self, start_seq, limit=None):
+        """Return up to limit (seq, timestamp, message) records starting at start_seq."""
+        return self.history.read_range(self.room, start_seq, limit)
+
+    def read_last(self, count):
+        """Return the most recent count records, oldest first."""
+        return self.read_range(max(self.next_seq - count, self.first_seq))
+
+    def read_since(self, timestamp, limit=None):
+        """Return up to limit records written at or after timestamp."""
+        return self.history.read_since(self.room, timestamp, limit)
+
+    def close(self):
+        pass  # The database stays open for the other rooms
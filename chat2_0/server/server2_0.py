@@ -1,42 +1,937 @@
 import socket
 import threading
+import asyncio
 import argparse
+import multiprocessing
+import selectors
+import hashlib
+import http.server
+import bisect
+import struct
 import time
 import json
 import os
+from collections import OrderedDict, deque
+from itertools import islice
+from functools import lru_cache
+
+from history_log import (RoomLog, GroupCommitter, migrate_json_room, FSYNC_POLICIES,
+                         DEFAULT_FSYNC_POLICY, DEFAULT_COMMIT_INTERVAL, DEFAULT_COMMIT_BATCH)
+from history_sqlite import SqliteHistory, SqliteRoomLog
+from attachment_spool import AttachmentSpool, attachment_message
 
 # Default host and port
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 5000
 
+# Server modes: one thread per connection, or every connection on one asyncio loop
+SERVER_MODES = ("threaded", "asyncio")
+DEFAULT_MODE = "threaded"
+
+# Sharded mode: a front acceptor reads each handshake, picks the worker
+# process that owns the room on a consistent hash ring and passes it the
+# socket. Needs socket.send_fds (Unix).
+HASH_RING_REPLICAS = 64  # Virtual nodes per worker
+# Each handoff on a worker's control channel is a 4 byte length and a JSON
+# message, sent together with the client's socket.
+CONTROL_HEADER = struct.Struct("!I")
+MAX_HANDOFF_FDS = 16  # Sockets taken per recv on the control channel
+PROBE_TIMEOUT = 10  # Seconds a new connection gets to send its hello before the acceptor drops it
+HANDOFF_TIMEOUT = 5  # Seconds the acceptor waits for a worker's control channel to take a handoff
+
+# Per-connection and per-room events are only printed with --verbose; the
+# numbers are available from the opt-in stats endpoint (--stats-port) instead.
+VERBOSE = False
+RATE_WINDOW = 60  # Seconds over which room message rates are averaged
+LATENCY_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+# Framed wire protocol (must match client2_0.py)
+# Every frame is an 8 byte header (magic, version, type, payload length)
+# followed by a JSON payload. The magic starts with a NUL byte, which never
+# begins a plain-text username, so old clients are still told apart.
+FRAME_MAGIC = b"\x00C"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBI")
+MAX_FRAME_SIZE = 1024 * 1024
+FRAME_HELLO = 1     # client -> server: {"username", "room", "action"}
+FRAME_HISTORY = 2   # server -> client: {"messages": [...], "first_seq": int, "has_more": bool, "older": bool}
+FRAME_CHAT = 3      # both ways: {"text": str}
+FRAME_CONTROL = 4   # both ways: {"event": str}, plus "before": int for "load_older"
+# Attachments travel on their own connection, which starts with one of these
+# instead of a hello, so large files never go through the chat broadcast path
+FRAME_UPLOAD = 5    # client -> server: {"size": int}, then exactly size raw bytes
+FRAME_DOWNLOAD = 6  # client -> server: {"id": str}; the reply is "download_start" then raw bytes
+RAW_FOLLOWS = (FRAME_UPLOAD,)  # Frames followed by unframed data
+RECV_SIZE = 65536
+
+# Uploads are spooled by SHA-256 under ATTACHMENT_DIR; rooms only get a
+# chat line referencing the id, shared with an "attach" control frame.
+DEFAULT_MAX_ATTACHMENT_BYTES = 100 * 1024 * 1024
+MAX_ATTACHMENT_BYTES = DEFAULT_MAX_ATTACHMENT_BYTES
+
+# Joins get the newest page of history; older pages are sent when the client
+# asks for them with a "load_older" control frame carrying its oldest seq.
+HISTORY_PAGE_SIZE = 50
+# A reconnecting client sends the seq after the last message it saw as "since"
+# in its hello and gets only what it missed, up to this many messages; past
+# that (or once the log no longer reaches back that far) it gets the newest
+# page with "reset" set, as on a fresh join.
+MAX_DELTA_MESSAGES = 1000
+
+# Where history is stored: per-room append-only logs, or one SQLite database
+# (chat_history/history.db) that also supports searching across rooms
+HISTORY_BACKENDS = ("log", "sqlite")
+DEFAULT_HISTORY_BACKEND = "log"
+HISTORY_BACKEND = DEFAULT_HISTORY_BACKEND
+# History writes are group-committed by a background flusher (see history_log)
+FSYNC_POLICY = DEFAULT_FSYNC_POLICY
+COMMIT_INTERVAL = DEFAULT_COMMIT_INTERVAL
+COMMIT_BATCH = DEFAULT_COMMIT_BATCH
+
+# In-memory room state. Each resident room keeps a ring buffer of its newest
+# messages (older ones stay on disk). Rooms with nobody in them close their log
+# but stay resident for a quick re-create until the total passes the memory
+# budget or there are more than ROOM_MAX_IDLE of them, then the least recently
+# used ones are evicted and reloaded lazily on next use.
+DEFAULT_RING_SIZE = 200
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+DEFAULT_MAX_IDLE_ROOMS = 1000
+ROOM_RING_SIZE = DEFAULT_RING_SIZE
+ROOM_MEMORY_BUDGET = DEFAULT_MEMORY_BUDGET
+ROOM_MAX_IDLE = DEFAULT_MAX_IDLE_ROOMS
+
+# Outbound queue limits per client. Past the drop mark new chat messages for
+# that client are discarded; past the disconnect mark, or after too many drops
+# in a row, it is evicted as a slow consumer. A drop mark of 0 disables dropping.
+DEFAULT_DROP_BYTES = 256 * 1024
+DEFAULT_DISCONNECT_BYTES = 1024 * 1024
+DEFAULT_MAX_DROPS = 1000
+OUTBOUND_DROP_BYTES = DEFAULT_DROP_BYTES
+OUTBOUND_DISCONNECT_BYTES = DEFAULT_DISCONNECT_BYTES
+OUTBOUND_MAX_DROPS = DEFAULT_MAX_DROPS
+CLOSE_LINGER = 1.0  # Seconds a closing client gets to flush its queue
+
+# Flood protection: token buckets charged for every chat message, one per
+# client and one per room, checked before anything is fanned out. A rate of
+# 0 disables that bucket. Over the limit, "drop" discards the message and
+# tells the sender, "slow" stops reading from the sender until a token frees
+# up, so TCP backpressure slows the flooder down.
+FLOOD_POLICIES = ("drop", "slow")
+DEFAULT_FLOOD_POLICY = "drop"
+DEFAULT_CLIENT_RATE = 20.0  # Messages per second
+DEFAULT_CLIENT_BURST = 40
+DEFAULT_ROOM_RATE = 500.0
+DEFAULT_ROOM_BURST = 1000
+FLOOD_POLICY = DEFAULT_FLOOD_POLICY
+CLIENT_RATE = DEFAULT_CLIENT_RATE
+CLIENT_BURST = DEFAULT_CLIENT_BURST
+ROOM_RATE = DEFAULT_ROOM_RATE
+ROOM_BURST = DEFAULT_ROOM_BURST
+
+# Write coalescing. Outbound frames for a client are held for up to
+# COALESCE_DELAY seconds (or until MAX_BATCH_BYTES pile up) and then written
+# with a single sendmsg()/writev, instead of one send per message.
+# A delay of 0 switches coalescing off. Plain-text clients are never batched
+# since they read one message per recv().
+DEFAULT_COALESCE_MS = 2
+COALESCE_DELAY = DEFAULT_COALESCE_MS / 1000
+MAX_BATCH_BYTES = 64 * 1024
+MAX_BATCH_BUFFERS = 512  # Stay well under the kernel's IOV_MAX (1024 on Linux)
+
 # Thread-safe data structures
-clients = {}  # {client_socket: {"username": str, "room": str}}
+clients = {}  # {ClientConnection: {"username": str, "room": str}}
 active_rooms = set()  # Track active rooms
-room_history = {}  # {room_name: [message1, message2, ...]}
-lock = threading.Lock()  # Lock for thread-safe operations
+room_members = {}  # {room_name: set(ClientConnection)}, kept in step with clients
+room_history = {}  # {room_name: deque([message1, ...], maxlen=ROOM_RING_SIZE)}, resident rooms only
+room_logs = {}  # {room_name: RoomLog | SqliteRoomLog}, the history on disk
+history_store = None  # The SqliteHistory, opened on first use with the sqlite backend
+history_committer = None  # The GroupCommitter for room logs, started on first use
+history_cache = {}  # {room_name: EncodedHistory}, guarded by the room lock
+room_bytes = {}  # {room_name: bytes of messages held in its ring buffer}
+resident_rooms = OrderedDict()  # Rooms with history in memory, least recently used first
+memory_gauges = {"resident_rooms": 0, "resident_bytes": 0, "evicted_rooms": 0}
+memory_lock = threading.Lock()  # Guards room_bytes, resident_rooms and memory_gauges
+lock = threading.Lock()  # Lock for clients, active_rooms and the room dictionaries
+outbound_stats = {"dropped_messages": 0, "evicted_clients": 0}  # Slow-consumer counters
+flood_stats = {"dropped_client": 0, "dropped_room": 0, "slowed": 0}  # Messages over a rate limit
+transfer_stats = {"uploads": 0, "upload_bytes": 0, "downloads": 0, "download_bytes": 0}
+traffic_totals = {"bytes_in": 0, "bytes_out": 0, "send_calls": 0}  # From connections that have closed
+stats_lock = threading.Lock()
+room_rates = {}  # {room_name: RateMeter}, marked under the room lock
+room_buckets = {}  # {room_name: TokenBucket}
+started_at = time.time()
+# Per-room locks guard a room's member set and history, so busy rooms don't
+# serialize behind each other. Always take `lock` first when holding both.
+room_locks = {}  # {room_name: threading.Lock}, resident rooms only
+logs_lock = threading.Lock()  # Guards room_logs so appends don't need the global lock
+closing_logs = {}  # {room_name: RoomLog} taken out of room_logs, closed once `lock` is released
 
 # Create a directory for chat history if it doesn't exist
 HISTORY_DIR = "chat_history"
 if not os.path.exists(HISTORY_DIR):
     os.makedirs(HISTORY_DIR)
+ATTACHMENT_DIR = "chat_attachments"
+attachment_spool = AttachmentSpool(ATTACHMENT_DIR)
 
-def load_room_history(room):
-    """Load chat history for a room from file."""
-    history_file = os.path.join(HISTORY_DIR, f"{room}.json")
-    if os.path.exists(history_file):
+class ProtocolError(Exception):
+    """Raised when a client sends bytes that aren't a valid frame."""
+
+def encode_frame(frame_type, payload):
+    """Encode one frame: header followed by the JSON payload."""
+    return frame_from_body(frame_type, json.dumps(payload).encode())
+
+def frame_from_body(frame_type, body):
+    """Put a header in front of an already encoded JSON payload."""
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, len(body)) + body
+
+class FrameDecoder:
+    """Incrementally split a byte stream into (frame_type, payload) tuples."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every frame that is now complete."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            magic, version, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                raise ProtocolError(f"bad frame header {magic!r} v{version}")
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = json.loads(self.buffer[offset + FRAME_HEADER.size:end].decode())
+            frames.append((frame_type, payload))
+            offset = end
+            if frame_type in RAW_FOLLOWS:
+                break  # The rest of the buffer isn't frames; the caller reads it
+        del self.buffer[:offset]
+        return frames
+
+def encode_chat(message, framed, seq=None):
+    """Encode a chat line for a framed or a plain-text client.
+
+    Framed clients also get the message's seq, unless it is a notice that
+    isn't kept in the history.
+    """
+    if framed:
+        if seq is None:
+            return encode_frame(FRAME_CHAT, {"text": message})
+        return encode_frame(FRAME_CHAT, {"text": message, "seq": seq})
+    return message.encode()
+
+@lru_cache(maxsize=None)
+def encode_control(event, framed):
+    """Encode a control reply such as "room_joined" or "left_room"."""
+    if framed:
+        return encode_frame(FRAME_CONTROL, {"event": event})
+    return event.encode()
+
+def log_event(message):
+    """Print a per-connection event, only when running with --verbose."""
+    if VERBOSE:
+        print(message)
+
+def count_stat(name, amount=1, counters=outbound_stats):
+    """Bump one of the server-wide counters."""
+    with stats_lock:
+        counters[name] += amount
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram in microseconds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_US):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last bucket is everything above the top bound
+        self.total_us = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        micros = seconds * 1e6
+        i = bisect.bisect_left(self.bounds, micros)
+        with self.lock:
+            self.counts[i] += 1
+            self.total_us += micros
+
+    def snapshot(self):
+        with self.lock:
+            counts, total_us = list(self.counts), self.total_us
+        count = sum(counts)
+        labels = [f"le_{bound}" for bound in self.bounds] + ["inf"]
+        return {"count": count, "mean_us": round(total_us / count, 1) if count else 0,
+                "buckets": dict(zip(labels, counts))}
+
+class RateMeter:
+    """Message counter with per-second buckets for a rate over the last RATE_WINDOW seconds."""
+
+    def __init__(self):
+        self.total = 0
+        self.buckets = [0] * RATE_WINDOW
+        self.stamps = [0] * RATE_WINDOW  # Which second each bucket currently counts
+
+    def mark(self):
+        now = int(time.time())
+        i = now % RATE_WINDOW
+        if self.stamps[i] != now:
+            self.stamps[i] = now
+            self.buckets[i] = 0
+        self.buckets[i] += 1
+        self.total += 1
+
+    def rate(self):
+        now = int(time.time())
+        recent = sum(count for count, stamp in zip(self.buckets, self.stamps) if now - stamp < RATE_WINDOW)
+        return round(recent / RATE_WINDOW, 3)
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token. Returns 0 on success, else the seconds until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+history_write_latency = LatencyHistogram()
+fan_out_latency = LatencyHistogram()
+
+class ClientConnection:
+    """State for one connected client, shared by both server modes.
+
+    send() never blocks: data goes onto the client's outbound queue and the
+    transport drains it on its own. Subclasses provide _write() (called with
+    send_lock held), queued_bytes() and abort() for their transport. Messages
+    broadcast before the join handshake completes are held back so they
+    can't land between the history and "room_joined" replies.
+    """
+
+    def __init__(self):
+        self.username = None
+        self.room = None
+        self.framed = None  # Decided by the first bytes the client sends
+        self.decoder = FrameDecoder()
+        self.handshake = []  # Plain-text clients send username, room and action separately
+        self.joined = False
+        self.ready = False
+        self.closed = False
+        self.pending = []
+        self.dropped = 0
+        self.drops_in_row = 0
+        self.bytes_in = 0  # Updated by the reader only
+        self.bytes_out = 0  # Updated under send_lock
+        self.bucket = TokenBucket(CLIENT_RATE, CLIENT_BURST) if CLIENT_RATE else None
+        self.flood_notified = False  # Told about the current run of dropped messages
+        self.send_calls = 0  # Write syscalls made for this client
+        self.send_lock = threading.Lock()
+        self.unsynced_acks = []  # "sent" acks waiting for an fsync that can't run on the event loop
+
+    # Whether events are handled on the asyncio event loop, where nothing may wait on the disk
+    on_loop = False
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def queued_bytes(self):
+        raise NotImplementedError
+
+    def abort(self):
+        """Drop the connection at once, discarding anything still queued."""
+        raise NotImplementedError
+
+    def send(self, data, droppable=True):
+        """Queue data for the client, applying the slow-consumer policy.
+
+        Raises socket.error if the client is closed or has just been evicted,
+        so fan_out() can clean it up like any other failed socket.
+        """
+        with self.send_lock:
+            if self.closed:
+                raise socket.error("connection closed")
+            if not self.ready:
+                self.pending.append(data)
+                return len(data)
+            queued = self.queued_bytes() + len(data)
+            if queued > OUTBOUND_DISCONNECT_BYTES or self.drops_in_row >= OUTBOUND_MAX_DROPS:
+                self.closed = True
+            elif droppable and OUTBOUND_DROP_BYTES and queued > OUTBOUND_DROP_BYTES:
+                self.dropped += 1
+                self.drops_in_row += 1
+                count_stat("dropped_messages")
+                return 0
+            else:
+                self.drops_in_row = 0
+                self._write(data)
+                return len(data)
+
+        count_stat("evicted_clients")
+        print(f"Evicting slow consumer {self.username} ({queued} bytes queued, {self.dropped} dropped)")
+        self.abort()
+        raise socket.error("slow consumer evicted")
+
+    def count_closed(self):
+        """Fold this connection's traffic into the server totals once it is gone."""
+        with stats_lock:
+            traffic_totals["bytes_in"] += self.bytes_in
+            traffic_totals["bytes_out"] += self.bytes_out
+            traffic_totals["send_calls"] += self.send_calls
+
+    def flush(self):
+        """Write out anything being held back for coalescing right away."""
+
+    def send_reply(self, data):
+        """Queue a handshake reply, ahead of anything held back in pending."""
+        with self.send_lock:
+            self._write(data)
+        self.flush()
+
+    def mark_ready(self):
+        """Finish the handshake and flush anything broadcast in the meantime."""
+        with self.send_lock:
+            self.ready = True
+            for data in self.pending:
+                self._write(data)
+            self.pending = []
+
+    def resume(self, handoff):
+        """Pick up a handshake the sharding acceptor already read. Returns its event.
+
+        The acceptor stops reading at the end of the first frame, so anything
+        after it (like an upload's data) is still waiting in the socket.
+        """
+        self.framed = handoff["framed"]
+        return [(handoff.get("event", "hello"), handoff["hello"])]
+
+    def feed(self, data):
+        """Parse received bytes into ("hello" | "chat" | "leave" | "exit" | ..., value) events."""
+        if self.framed is None:
+            self.framed = data[:1] == FRAME_MAGIC[:1]
+
+        if self.framed:
+            events = []
+            for frame_type, payload in self.decoder.feed(data):
+                if frame_type == FRAME_HELLO and not self.joined:
+                    events.append(("hello", payload))
+                elif frame_type == FRAME_UPLOAD and not self.joined:
+                    events.append(("upload", payload))
+                    break
+                elif frame_type == FRAME_DOWNLOAD and not self.joined:
+                    events.append(("download", payload))
+                elif frame_type == FRAME_CHAT and self.joined:
+                    events.append(("chat", str(payload.get("text", ""))))
+                elif frame_type == FRAME_CONTROL and payload.get("event") in ("leave", "exit"):
+                    events.append((payload["event"], None))
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "load_older" and self.joined:
+                    events.append(("load_older", int(payload.get("before", 0))))
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "search" and self.joined:
+                    events.append(("search", payload))
+                elif frame_type == FRAME_CONTROL and payload.get("event") == "attach" and self.joined:
+                    events.append(("attach", payload))
+            return events
+
+        # Compatibility path for plain-text clients: one recv is one message
+        message = data.decode(errors="replace")
+        if not self.joined:
+            self.handshake.append(message)
+            if len(self.handshake) < 3:
+                return []
+            username, room, action = self.handshake
+            return [("hello", {"username": username, "room": room, "action": action})]
+        if message.lower() in ("exit", "leave"):
+            return [(message.lower(), None)]
+        return [("chat", message)]
+
+def send_buffers(sock, buffers):
+    """Send every buffer using as few sendmsg() (writev) calls as possible.
+
+    Returns the number of calls made.
+    """
+    if not hasattr(sock, "sendmsg"):  # Windows
+        sock.sendall(b"".join(buffers))
+        return 1
+    views = [memoryview(data) for data in buffers]
+    first = calls = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_BATCH_BUFFERS])
+        calls += 1
+        # Skip what went out, and trim the buffer it stopped in
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+    return calls
+
+class SocketClient(ClientConnection):
+    """A client served over a blocking socket.
+
+    Its own thread reads; a second writer thread drains the outbound queue,
+    so a peer that stops reading never blocks the thread broadcasting to it.
+    The writer lets a burst build up for COALESCE_DELAY and sends it in one go.
+    """
+
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.flush_now = False  # Set by flush() to send what is queued without waiting to coalesce
+        self.wakeup = threading.Condition(self.send_lock)
+        self.writer_thread = threading.Thread(target=self._drain, daemon=True)
+        self.writer_thread.start()
+
+    def _write(self, data):
+        was_empty = not self.outbound
+        self.outbound.append(data)
+        self.outbound_bytes += len(data)
+        self.bytes_out += len(data)
+        # The writer only needs waking for a new batch or a full one
+        if was_empty or self.outbound_bytes >= MAX_BATCH_BYTES:
+            self.wakeup.notify()
+
+    def queued_bytes(self):
+        return self.outbound_bytes
+
+    def flush(self):
+        with self.send_lock:
+            if self.outbound:
+                self.flush_now = True
+                self.wakeup.notify()
+
+    def _drain(self):
+        """Writer thread: send queued data until the client is closed and flushed."""
+        while True:
+            with self.wakeup:
+                while not self.outbound and not self.closed:
+                    self.wakeup.wait()
+                if not self.outbound:
+                    break
+                if not self.framed:
+                    batch = [self.outbound.popleft()]
+                else:
+                    deadline = time.monotonic() + COALESCE_DELAY
+                    while self.outbound_bytes < MAX_BATCH_BYTES and not self.closed and not self.flush_now:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.wakeup.wait(remaining)
+                    batch = list(self.outbound)
+                    self.outbound.clear()
+                self.flush_now = False
+            try:
+                calls = send_buffers(self.sock, batch)
+            except socket.error:
+                self.abort()
+                break
+            with self.send_lock:
+                self.outbound_bytes -= sum(len(data) for data in batch)
+                self.send_calls += calls
         try:
-            with open(history_file, 'r') as f:
-                return json.load(f)
-        except:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def abort(self):
+        with self.send_lock:
+            self.closed = True
+            self.outbound.clear()
+            self.outbound_bytes = 0
+            self.wakeup.notify()
+        try:
+            # Wakes up both the reader's recv() and the writer's sendall()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        """Stop accepting data, give the writer a moment to flush, then close."""
+        with self.send_lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.writer_thread.join(CLOSE_LINGER)
+        if self.writer_thread.is_alive():
+            self.abort()
+
+# asyncio mode: clients with a batch waiting, flushed together once per tick
+unflushed_clients = set()
+flush_tick = None
+
+def flush_unflushed():
+    global flush_tick
+    flush_tick = None
+    for client in list(unflushed_clients):
+        client.flush()
+
+class AsyncClient(ClientConnection):
+    """A client served on the asyncio event loop through a StreamWriter.
+
+    The transport's write buffer is the outbound queue; the event loop drains it.
+    Writes are collected in a batch and handed to the transport together on
+    the next flush tick, so a burst costs one send instead of one per message.
+    """
+
+    on_loop = True
+
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+        self.batch = []
+        self.batch_bytes = 0
+
+    def _write(self, data):
+        if self.writer.is_closing():
+            raise socket.error("connection closed")
+        self.bytes_out += len(data)
+        if not COALESCE_DELAY or not self.framed:
+            self.writer.write(data)
+            self.send_calls += 1
+            return
+        self.batch.append(data)
+        self.batch_bytes += len(data)
+        if self.batch_bytes >= MAX_BATCH_BYTES:
+            self.flush()
+            return
+        unflushed_clients.add(self)
+        global flush_tick
+        if flush_tick is None:
+            flush_tick = asyncio.get_running_loop().call_later(COALESCE_DELAY, flush_unflushed)
+
+    def flush(self):
+        unflushed_clients.discard(self)
+        if self.batch and not self.writer.is_closing():
+            self.writer.writelines(self.batch)
+            self.send_calls += 1
+        self.batch = []
+        self.batch_bytes = 0
+
+    def queued_bytes(self):
+        return self.writer.transport.get_write_buffer_size() + self.batch_bytes
+
+    def abort(self):
+        self.closed = True
+        unflushed_clients.discard(self)
+        self.batch = []
+        self.batch_bytes = 0
+        self.writer.transport.abort()
+
+    def close(self):
+        self.closed = True
+        self.flush()
+        self.writer.close()
+
+def get_history_store():
+    """Open (once) the SQLite history database; caller holds logs_lock."""
+    global history_store
+    if history_store is None:
+        history_store = SqliteHistory(os.path.join(HISTORY_DIR, "history.db"),
+                                      FSYNC_POLICY, COMMIT_INTERVAL, COMMIT_BATCH)
+    return history_store
+
+def get_history_committer():
+    """Start (once) the group committer shared by the room logs; caller holds logs_lock."""
+    global history_committer
+    if history_committer is None:
+        history_committer = GroupCommitter(FSYNC_POLICY, COMMIT_INTERVAL, COMMIT_BATCH)
+    return history_committer
+
+def close_history():
+    """Commit anything still buffered or queued for the history on shutdown."""
+    if history_committer is not None:
+        history_committer.close()
+    if history_store is not None:
+        history_store.close()
+
+def get_room_log(room):
+    """Open (once) the history log for a room.
+
+    A room still stored in the old chat_history/<room>.json format is
+    migrated the first time it is opened. With the sqlite backend, a room
+    that only has an append-only log so far is copied into the database.
+    """
+    with logs_lock:
+        if room not in room_logs:
+            # A log still being closed must finish before its files are opened again
+            closing = closing_logs.pop(room, None)
+            if closing is not None:
+                closing.close()
+            log_dir = os.path.join(HISTORY_DIR, room)
+            if os.path.exists(os.path.join(HISTORY_DIR, f"{room}.json")):
+                try:
+                    migrate_json_room(HISTORY_DIR, room)
+                except Exception as e:
+                    print(f"Error migrating history for room {room}: {e}")
+            if HISTORY_BACKEND == "sqlite":
+                log = SqliteRoomLog(get_history_store(), room)
+                if not len(log) and os.path.isdir(log_dir):
+                    old_log = RoomLog(log_dir)
+                    log.import_log(old_log)
+                    old_log.close()
+                room_logs[room] = log
+            else:
+                room_logs[room] = RoomLog(log_dir, committer=get_history_committer())
+        return room_logs[room]
+
+def load_room_history(room):
+    """Load the newest ring buffer's worth of chat history for a room from its log."""
+    try:
+        return [message for _, _, message in get_room_log(room).read_last(ROOM_RING_SIZE)]
+    except Exception as e:
+        print(f"Error loading history for room {room}: {e}")
+        return []
+
+def encode_history(messages, first_seq, has_more, older=False):
+    """Encode one page of history; first_seq is the cursor for the next older page."""
+    return encode_frame(FRAME_HISTORY, {"messages": messages, "first_seq": first_seq,
+                                        "has_more": has_more, "older": older})
+
+class EncodedHistory:
+    """The newest history page of a room, kept JSON-encoded message by message.
+
+    Each new message is encoded once when it arrives; a join only joins the
+    encoded parts, and the assembled reply is reused by every join until the
+    next message. Guarded by the room lock.
+    """
+
+    def __init__(self, messages, first_seq, log_first_seq):
+        self.parts = deque((json.dumps(message).encode() for message in messages),
+                           maxlen=HISTORY_PAGE_SIZE)
+        self.next_seq = first_seq + len(self.parts)
+        self.log_first_seq = log_first_seq
+        self.replies = {}  # {framed: bytes}, dropped on every append
+
+    def append(self, message):
+        self.parts.append(json.dumps(message).encode())
+        self.next_seq += 1
+        self.replies.clear()
+
+    def reply(self, framed):
+        """The encoded history reply for a framed or a plain-text client."""
+        if framed not in self.replies:
+            body = b"[" + b", ".join(self.parts) + b"]"
+            if framed:
+                first_seq = self.next_seq - len(self.parts)
+                has_more = b"true" if first_seq > self.log_first_seq else b"false"
+                body = (b'{"messages": ' + body + b', "first_seq": ' + str(first_seq).encode()
+                        + b', "has_more": ' + has_more + b', "older": false}')
+                body = frame_from_body(FRAME_HISTORY, body)
+            self.replies[framed] = body
+        return self.replies[framed]
+
+def get_history_cache(room):
+    """Return the room's encoded history page, building it if needed; caller holds the room lock."""
+    if room not in history_cache:
+        messages, first_seq, _ = recent_history_page(room)
+        history_cache[room] = EncodedHistory(messages, first_seq, get_room_log(room).first_seq)
+    return history_cache[room]
+
+def recent_history_page(room):
+    """Return (messages, first_seq, has_more) for the newest page; caller holds the room lock."""
+    log = get_room_log(room)
+    ring = room_history[room]
+    messages = list(islice(ring, max(len(ring) - HISTORY_PAGE_SIZE, 0), None))
+    first_seq = log.next_seq - len(messages)
+    return messages, first_seq, first_seq > log.first_seq
+
+def delta_history(room, since):
+    """Encode the messages from seq `since` on for a reconnecting client; caller holds the room lock."""
+    log = get_room_log(room)
+    if not log.first_seq <= since <= log.next_seq or log.next_seq - since > MAX_DELTA_MESSAGES:
+        messages, first_seq, has_more = recent_history_page(room)
+        return encode_frame(FRAME_HISTORY, {"messages": messages, "first_seq": first_seq,
+                                            "has_more": has_more, "older": False, "reset": True})
+    ring = room_history[room]
+    ring_first_seq = log.next_seq - len(ring)
+    if since >= ring_first_seq:
+        messages = list(islice(ring, since - ring_first_seq, None))
+    else:
+        # Only the part older than the ring comes from disk
+        records = log.read_range(since, ring_first_seq - since)
+        messages = [message for _, _, message in records] + list(ring)
+    return encode_frame(FRAME_HISTORY, {"messages": messages, "first_seq": since,
+                                        "has_more": since > log.first_seq, "older": False, "delta": True})
+
+def older_history_page(room, before):
+    """Return (messages, first_seq, has_more) for the page just before seq `before`."""
+    log = get_room_log(room)
+    before = min(before, log.next_seq)
+    first_seq = max(before - HISTORY_PAGE_SIZE, log.first_seq)
+    records = log.read_range(first_seq, max(before - first_seq, 0))
+    return [message for _, _, message in records], first_seq, first_seq > log.first_seq
+
+def search_history(room, request):
+    """Run a search request from a client in `room` and encode the reply.
+
+    Searches the client's room, or every room when the request sets
+    all_rooms; "before" is the cursor from the previous page of hits.
+    """
+    query = str(request.get("query", ""))
+    scope = None if request.get("all_rooms") else room
+    reply = {"event": "search_results", "query": query, "all_rooms": scope is None}
+    if HISTORY_BACKEND != "sqlite":
+        reply.update(hits=[], next=None, error="Search needs the server's sqlite history backend")
+        return encode_frame(FRAME_CONTROL, reply)
+    with logs_lock:
+        store = get_history_store()
+    before = request.get("before")
+    try:
+        hits, next_cursor = store.search(query, scope, None if before is None else int(before))
+        reply.update(hits=hits, next=next_cursor)
+    except Exception as e:
+        print(f"Error searching history for {query!r}: {e}")
+        reply.update(hits=[], next=None, error="Search failed")
+    return encode_frame(FRAME_CONTROL, reply)
+
+def history_reply(room, kind, value):
+    """Encode the reply to a load_older or search request; both read from disk."""
+    if kind == "load_older":
+        messages, first_seq, has_more = older_history_page(room, value)
+        return encode_history(messages, first_seq, has_more, older=True)
+    return search_history(room, value)
+
+def make_resident(room):
+    """Load a room's ring buffer if it isn't in memory; caller holds `lock` and the room lock."""
+    if room not in room_history:
+        room_history[room] = deque(load_room_history(room), maxlen=ROOM_RING_SIZE)
+        size = sum(len(message.encode()) for message in room_history[room])
+        with memory_lock:
+            room_bytes[room] = size
+            memory_gauges["resident_rooms"] += 1
+            memory_gauges["resident_bytes"] += size
+    with memory_lock:
+        resident_rooms[room] = True
+        resident_rooms.move_to_end(room)
+
+def remember_message(room, message):
+    """Push a message into the room's ring buffer; caller holds the room lock."""
+    ring = room_history[room]
+    added = len(message.encode())
+    if len(ring) == ring.maxlen:
+        added -= len(ring[0].encode())  # Falls off the front, it's still on disk
+    ring.append(message)
+    with memory_lock:
+        room_bytes[room] += added
+        memory_gauges["resident_bytes"] += added
+        resident_rooms.move_to_end(room)
+
+def detach_room_log(room):
+    """Take a room's log out of use; returns [(room, log)] for close_room_logs(), or [].
+
+    Closing a log fsyncs it, so it waits for close_room_logs() once `lock` is
+    released. Until then the log stays in closing_logs, and opening the room
+    again finishes the close first.
+    """
+    with logs_lock:
+        log = room_logs.pop(room, None)
+        if log is None:
             return []
-    return []
+        closing_logs[room] = log
+    return [(room, log)]
 
-def save_room_history(room, history):
-    """Save chat history for a room to file."""
-    history_file = os.path.join(HISTORY_DIR, f"{room}.json")
+def close_room_logs(detached):
+    """Close logs taken out by detach_room_log(); call without holding `lock`.
+
+    Called on the event loop, the closes (which fsync) run in the default executor.
+    """
+    if not detached:
+        return
     try:
-        with open(history_file, 'w') as f:
-            json.dump(history, f)
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None  # Threaded mode, or already in an executor thread
+    if loop is not None:
+        loop.run_in_executor(None, close_room_logs, detached)
+        return
+    for room, log in detached:
+        log.close()
+        with logs_lock:
+            if closing_logs.get(room) is log:
+                del closing_logs[room]
+
+def close_room_log(room):
+    """Detach a room's log so an empty room doesn't hold its files open; reopened on next use."""
+    if HISTORY_BACKEND == "sqlite":
+        return []  # Rooms share the database connection, there is nothing to release
+    return detach_room_log(room)
+
+def evict_idle_rooms():
+    """Evict least recently used empty rooms past the memory budget or idle room cap; caller holds `lock`.
+
+    Returns the detached room logs for the caller to close with close_room_logs().
+    """
+    detached = []
+    with memory_lock:
+        candidates = [room for room in resident_rooms if room not in active_rooms]
+        over_count = len(candidates) - ROOM_MAX_IDLE
+        if memory_gauges["resident_bytes"] <= ROOM_MEMORY_BUDGET and over_count <= 0:
+            return detached
+
+    evicted = freed = 0
+    for room in candidates:
+        with room_locks[room]:
+            room_history.pop(room, None)
+            history_cache.pop(room, None)
+            room_rates.pop(room, None)
+            room_buckets.pop(room, None)
+            # The room has no members; a straggler holding the lock re-checks membership
+            room_locks.pop(room, None)
+        detached += detach_room_log(room)
+        with memory_lock:
+            size = room_bytes.pop(room, 0)
+            resident_rooms.pop(room, None)
+            memory_gauges["resident_rooms"] -= 1
+            memory_gauges["resident_bytes"] -= size
+            memory_gauges["evicted_rooms"] += 1
+            evicted += 1
+            freed += size
+            done = memory_gauges["resident_bytes"] <= ROOM_MEMORY_BUDGET and evicted >= over_count
+        if done:
+            break
+    if evicted:
+        log_event(f"Evicted {evicted} idle rooms ({freed} bytes), {memory_gauges['resident_rooms']} rooms / "
+                  f"{memory_gauges['resident_bytes']} bytes resident")
+    return detached
+
+def append_room_history(room, message, sync=True):
+    """Append one message to a room's log on disk and return its seq (None if it failed).
+
+    With sync=False an "always" fsync is left to sync_room_history().
+    """
+    started = time.perf_counter()
+    try:
+        seq = get_room_log(room).append(message, sync=sync)
+        history_write_latency.observe(time.perf_counter() - started)
+        return seq
+    except Exception as e:
+        print(f"Error saving history for room {room}: {e}")
+        return None
+
+def sync_room_history(room):
+    """Fsync the appends append_room_history() made with sync=False; blocks, so never on the event loop."""
+    with logs_lock:
+        log = room_logs.get(room) or closing_logs.get(room)
+    if log is None:
+        return  # Closed, and closing commits everything
+    try:
+        log.sync()
     except Exception as e:
         print(f"Error saving history for room {room}: {e}")
 
@@ -48,166 +943,879 @@ def create_server(host, port):
     server.listen()
     return server
 
+def fan_out(message, room, sender_socket=None, seq=None):
+    """Send a message to every member of a room; the caller holds the room lock.
+
+    Returns the clients whose sockets failed, for the caller to remove once
+    it has released the lock.
+    """
+    started = time.perf_counter()
+    encoded = {}  # Encode once per protocol, not once per recipient
+    disconnected_clients = []
+    for client in room_members.get(room, ()):
+        if client != sender_socket:
+            if client.framed not in encoded:
+                encoded[client.framed] = encode_chat(message, client.framed, seq)
+            try:
+                client.send(encoded[client.framed])
+            except socket.error:
+                disconnected_clients.append(client)
+    fan_out_latency.observe(time.perf_counter() - started)
+    return disconnected_clients
+
 def broadcast(message, room, sender_socket=None):
     """Send a message to all users in a specific chat room."""
-    with lock:
-        disconnected_clients = []
-        for client, info in clients.items():
-            if info["room"] == room and client != sender_socket:
-                try:
-                    client.send(message.encode())
-                except socket.error:
-                    disconnected_clients.append(client)
-        
-        # Clean up disconnected clients
-        for client in disconnected_clients:
-            remove_client(client)
+    room_lock = room_locks.get(room)
+    if room_lock is None:
+        return
+    with room_lock:
+        disconnected_clients = fan_out(message, room, sender_socket)
+
+    # Clean up disconnected clients (outside the lock, remove_client takes it again)
+    for client in disconnected_clients:
+        remove_client(client)
 
 def remove_client(client):
     """Remove a client from the active clients list and clean up the room."""
+    detached = []
     with lock:
         if client in clients:
             room = clients[client]["room"]
             username = clients[client]["username"]
             del clients[client]
-            print(f"Cleaned up client connection for {username}")
-            
-            # Check if room is empty by counting remaining clients in the room
-            remaining_clients = sum(1 for info in clients.values() if info["room"] == room)
+            log_event(f"Cleaned up client connection for {username}")
+
+            # The member index tells us straight away whether the room is empty
+            with room_locks[room]:
+                members = room_members.get(room, set())
+                members.discard(client)
+                remaining_clients = len(members)
+                if remaining_clients == 0:
+                    room_members.pop(room, None)
             if remaining_clients == 0:
                 active_rooms.discard(room)
-                print(f"Room {room} is now empty and has been removed")
+                log_event(f"Room {room} is now empty and has been removed")
+                detached = close_room_log(room) + evict_idle_rooms()
             else:
-                print(f"Room {room} still has {remaining_clients} clients")
+                log_event(f"Room {room} still has {remaining_clients} clients")
+    close_room_logs(detached)
 
-def handle_client(client):
-    """Handle communication for a single client."""
+def admit_client(client, hello):
+    """Create or join a room for a new client.
+
+    Returns (admitted, replies). Replies are sent in order by the caller; a
+    plain-text client gets separate replies that need a pause between them,
+    a framed client gets a single buffer.
+    """
+    username = str(hello.get("username", "")).strip()
+    room = str(hello.get("room", "")).strip()
+    action = hello.get("action")
+    framed = client.framed
+    # Only framed clients track seqs, so only they can ask for a delta
+    since = hello.get("since") if framed else None
+    if not isinstance(since, int) or isinstance(since, bool):
+        since = None
+
+    with lock:
+        if not username or not room:
+            return False, [encode_control("invalid_action", framed)]
+        if action == "create":
+            if room in active_rooms:
+                return False, [encode_control("room_exists", framed)]
+            active_rooms.add(room)
+            room_lock = room_locks.setdefault(room, threading.Lock())
+            with room_lock:
+                # Load existing history if it isn't still resident
+                make_resident(room)
+                room_members[room] = {client}
+                # Re-creating a room the client was in: catch it up from the log
+                history = delta_history(room, since) if since is not None else b""
+            replies = [history + encode_control("room_created", framed)]
+            log_event(f"Created new room: {room}")
+        elif action == "join":
+            if room not in active_rooms:
+                return False, [encode_control("room_not_found", framed)]
+            with room_locks[room]:
+                # Load existing history if not already loaded
+                make_resident(room)
+                # Only the newest page goes out, already encoded, or what a
+                # reconnecting client missed
+                if since is not None:
+                    history = delta_history(room, since)
+                else:
+                    history = get_history_cache(room).reply(framed)
+                if framed:
+                    replies = [history + encode_control("room_joined", framed)]
+                else:
+                    replies = [history, encode_control("room_joined", framed)]
+                room_members[room].add(client)
+            log_event(f"User {username} joined room: {room}")
+        else:
+            return False, [encode_control("invalid_action", framed)]
+
+        # Add client to clients dictionary
+        clients[client] = {"username": username, "room": room}
+        client.username = username
+        client.room = room
+        client.joined = True
+        detached = evict_idle_rooms()
+
+    close_room_logs(detached)
+    return True, replies
+
+def announce_join(client, action):
+    """Tell the room about a client that just created or joined it."""
+    log_event(f"📢 {client.username} {'created' if action == 'create' else 'joined'} room: {client.room}")
+    broadcast(f"🔵 {client.username} joined the chat!", client.room, client)
+
+def flood_delay(client):
+    """Charge one chat message to the client's and its room's token buckets.
+
+    Returns (0, None) if it may go out, else (seconds until it may, "client" | "room").
+    """
+    if client.bucket:
+        wait = client.bucket.take()
+        if wait:
+            return wait, "client"
+    if ROOM_RATE:
+        bucket = room_buckets.get(client.room)
+        if bucket is None:
+            bucket = room_buckets.setdefault(client.room, TokenBucket(ROOM_RATE, ROOM_BURST))
+        wait = bucket.take()
+        if wait:
+            if client.bucket:
+                client.bucket.refund()  # The message didn't go out after all
+            return wait, "room"
+    return 0, None
+
+def reject_flood(client, delay, scope):
+    """Drop a message over the rate limit; the sender hears about it once per run of drops."""
+    count_stat(f"dropped_{scope}", counters=flood_stats)
+    if client.flood_notified:
+        return
+    client.flood_notified = True
+    log_event(f"Rate limiting {client.username} in {client.room} ({scope} limit)")
+    if client.framed:
+        reply = encode_frame(FRAME_CONTROL, {"event": "rate_limited", "scope": scope,
+                                             "retry_after": round(delay, 3)})
+    else:
+        reply = encode_chat("⚠️ You are sending messages too fast, some were not delivered.", False)
     try:
-        # Set socket timeout for receiving messages
-        client.settimeout(1.0)  # 1 second timeout
-        
-        # Receive client information
-        username = client.recv(1024).decode()
-        if not username:
-            print("Empty username received")
-            return
-            
-        room = client.recv(1024).decode()
-        if not room:
-            print("Empty room received")
+        client.send(reply, droppable=False)
+    except socket.error:
+        pass  # The reader finds out on its next recv
+
+def handle_event(client, kind, value):
+    """Handle one chat/attach/leave/exit/load_older/search event. Returns False when the connection should close."""
+    username, room = client.username, client.room
+    if kind in ("load_older", "search"):
+        client.send(history_reply(room, kind, value), droppable=False)
+        return True
+    elif kind == "exit":
+        log_event(f"❌ {username} left the chat.")
+        broadcast(f"❌ {username} left the chat.", room, client)
+        return False
+    elif kind == "leave":
+        log_event(f"❌ {username} left the room.")
+        broadcast(f"❌ {username} left the room.", room, client)
+        remove_client(client)
+        client.send(encode_control("left_room", client.framed), droppable=False)  # Inform the client they left
+        return False
+    elif kind == "attach":
+        attachment_id = value.get("id")
+        path = attachment_spool.path_for(attachment_id)
+        if path is None:
+            client.send(encode_frame(FRAME_CONTROL, {"event": "attach_failed", "id": attachment_id}),
+                        droppable=False)
+            return True
+        # The room only gets a reference; the sender sees it too since the server wrote it
+        value = attachment_message(username, str(value.get("name", "")), os.path.getsize(path), attachment_id)
+        sender = None
+    else:
+        sender = client
+
+    # Record and fan out under the room lock only, so other rooms carry on meanwhile
+    room_lock = room_locks.get(room)
+    if room_lock is None:
+        return False  # Removed from an empty room that has since been evicted
+    with room_lock:
+        if client not in room_members.get(room, ()):
+            return False  # Removed (e.g. as a slow consumer) while this event was read
+        if room in room_history:
+            remember_message(room, value)
+        if room in history_cache:
+            history_cache[room].append(value)
+        room_rates.setdefault(room, RateMeter()).mark()
+        # An "always" fsync would stall the event loop; there the ack waits for it instead
+        defer_sync = client.on_loop and FSYNC_POLICY == "always" and HISTORY_BACKEND == "log"
+        seq = append_room_history(room, value, sync=not defer_sync)
+        disconnected_clients = fan_out(value, room, sender, seq)
+        if sender is not None and client.framed and seq is not None:
+            # The sender shows its own line without waiting; it only needs the seq
+            # (and the text, to tell which of its messages the seq belongs to)
+            ack = encode_frame(FRAME_CONTROL, {"event": "sent", "seq": seq, "text": value})
+            if defer_sync:
+                client.unsynced_acks.append(ack)
+            else:
+                try:
+                    client.send(ack)
+                except socket.error:
+                    disconnected_clients.append(client)
+
+    for other in disconnected_clients:
+        remove_client(other)
+    return True
+
+def start_upload(client, request):
+    """Open a spool file for an upload request. Returns (upload, size) or (None, 0) after refusing it."""
+    size = request.get("size")
+    if not isinstance(size, int) or not 0 <= size <= MAX_ATTACHMENT_BYTES:
+        client.send_reply(encode_frame(FRAME_CONTROL, {"event": "upload_failed",
+                                                       "reason": f"size limit is {MAX_ATTACHMENT_BYTES} bytes"}))
+        return None, 0
+    upload = attachment_spool.begin()
+    # Whatever arrived along with the request frame is the start of the file
+    first = bytes(client.decoder.buffer[:size])
+    del client.decoder.buffer[:size]
+    upload.write(first)
+    return upload, size - len(first)
+
+def finish_upload(client, upload):
+    attachment_id = upload.finish()
+    log_event(f"📎 Spooled attachment {attachment_id} ({upload.size} bytes)")
+    count_stat("uploads", counters=transfer_stats)
+    count_stat("upload_bytes", upload.size, counters=transfer_stats)
+    client.send_reply(encode_frame(FRAME_CONTROL, {"event": "upload_done", "id": attachment_id,
+                                                   "size": upload.size}))
+
+def open_download(client, request):
+    """Open a requested attachment. Returns (file, size), or (None, 0) after replying "not_found"."""
+    path = attachment_spool.path_for(request.get("id"))
+    if path is None:
+        client.send_reply(encode_frame(FRAME_CONTROL, {"event": "not_found", "id": request.get("id")}))
+        return None, 0
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    count_stat("downloads", counters=transfer_stats)
+    count_stat("download_bytes", size, counters=transfer_stats)
+    return f, size
+
+def serve_transfer(client, sock, kind, request):
+    """Serve an upload or download connection on a blocking socket."""
+    if kind == "upload":
+        upload, remaining = start_upload(client, request)
+        if upload is None:
             return
-            
-        action = client.recv(1024).decode()
-        if not action:
-            print("Empty action received")
+        try:
+            while remaining:
+                data = sock.recv(min(RECV_SIZE, remaining))
+                if not data:
+                    raise ConnectionError("upload cut short")
+                client.bytes_in += len(data)
+                upload.write(data)
+                remaining -= len(data)
+        except BaseException:
+            upload.discard()
+            raise
+        finish_upload(client, upload)
+        return
+
+    f, size = open_download(client, request)
+    if f is None:
+        return
+    with f:
+        # Straight onto the socket rather than through the writer thread,
+        # which has nothing queued on a transfer connection
+        sock.sendall(encode_frame(FRAME_CONTROL, {"event": "download_start", "id": request["id"], "size": size}))
+        client.bytes_out += sock.sendfile(f)  # os.sendfile where the platform has it
+
+async def serve_transfer_async(client, reader, writer, kind, request):
+    """Serve an upload or download connection on the event loop."""
+    if kind == "upload":
+        upload, remaining = start_upload(client, request)
+        if upload is None:
             return
+        try:
+            while remaining:
+                data = await reader.read(min(RECV_SIZE, remaining))
+                if not data:
+                    raise ConnectionError("upload cut short")
+                client.bytes_in += len(data)
+                upload.write(data)
+                remaining -= len(data)
+        except BaseException:
+            upload.discard()
+            raise
+        finish_upload(client, upload)
+        return
 
-        # Handle room creation/joining
-        with lock:
-            if action == "create":
-                if room in active_rooms:
-                    client.send("room_exists".encode())
-                    client.close()
+    f, size = open_download(client, request)
+    if f is None:
+        return
+    with f:
+        writer.write(encode_frame(FRAME_CONTROL, {"event": "download_start", "id": request["id"], "size": size}))
+        await writer.drain()
+        # Uses os.sendfile for plain sockets on Unix
+        client.bytes_out += await asyncio.get_running_loop().sendfile(writer.transport, f)
+
+def handle_client(sock, handoff=None):
+    """Handle communication for a single client."""
+    client = SocketClient(sock)
+    events = client.resume(handoff) if handoff else []
+    try:
+        while True:
+            for kind, value in events:
+                if kind == "hello":
+                    admitted, replies = admit_client(client, value)
+                    for i, reply in enumerate(replies):
+                        if i:
+                            time.sleep(0.1)  # Plain-text clients need each reply in its own recv
+                        client.send_reply(reply)
+                    if not admitted:
+                        return
+                    client.mark_ready()
+                    announce_join(client, value.get("action"))
+                    continue
+                if kind in ("upload", "download"):
+                    serve_transfer(client, sock, kind, value)
                     return
-                active_rooms.add(room)
-                # Load existing history if any
-                room_history[room] = load_room_history(room)
-                client.send("room_created".encode())
-                print(f"Created new room: {room}")
-            elif action == "join":
-                if room not in active_rooms:
-                    client.send("room_not_found".encode())
-                    client.close()
+                if kind in ("chat", "attach"):
+                    delay, scope = flood_delay(client)
+                    if delay and FLOOD_POLICY == "slow":
+                        count_stat("slowed", counters=flood_stats)
+                    while delay and FLOOD_POLICY == "slow":
+                        time.sleep(delay)  # Nothing is read meanwhile, so the sender backs up
+                        delay, scope = flood_delay(client)
+                    if delay:
+                        reject_flood(client, delay, scope)
+                        continue
+                    client.flood_notified = False
+                if not handle_event(client, kind, value):
                     return
-                # Load existing history if not already loaded
-                if room not in room_history:
-                    room_history[room] = load_room_history(room)
-                # Send history to the new client
-                history_json = json.dumps(room_history[room])
-                client.send(history_json.encode())
-                time.sleep(0.1)  # Small delay between sends
-                client.send("room_joined".encode())
-                print(f"User {username} joined room: {room}")
-            else:
-                client.send("invalid_action".encode())
-                client.close()
-                return
 
-            # Add client to clients dictionary
-            clients[client] = {"username": username, "room": room}
+            # Blocking recv: abort() shuts the socket down to wake it up
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                if not client.joined:
+                    log_event("Client disconnected before joining a room")
+                break
+            client.bytes_in += len(data)
+            events = client.feed(data)
+
+    except socket.error as e:
+        log_event(f"Socket error for {client.username}: {e}")
+    except Exception as e:
+        print(f"Error handling client: {e}")
+    finally:
+        remove_client(client)
+        client.close()
+        client.count_closed()
 
-        print(f"📢 {username} {'created' if action == 'create' else 'joined'} room: {room}")
-        broadcast(f"🔵 {username} joined the chat!", room, client)
+async def send_synced_acks(client):
+    """Send the acks handle_event() held back, once the fsync they wait for is done off the loop."""
+    await asyncio.get_running_loop().run_in_executor(None, sync_room_history, client.room)
+    acks, client.unsynced_acks = client.unsynced_acks, []
+    for ack in acks:
+        client.send(ack)
 
+async def handle_client_async(reader, writer, handoff=None):
+    """Handle communication for a single client on the asyncio event loop."""
+    client = AsyncClient(writer)
+    if handoff:
+        events = client.resume(handoff)
+    else:
+        events = []
+        log_event(f"✅ New connection from {writer.get_extra_info('peername')}")
+    try:
         while True:
-            try:
-                message = client.recv(1024).decode()
-                if not message:
-                    break
-                if message.lower() == "exit":
-                    print(f"❌ {username} left the chat.")
-                    broadcast(f"❌ {username} left the chat.", room, client)
-                    break
-                elif message.lower() == "leave":
-                    print(f"❌ {username} left the room.")
-                    broadcast(f"❌ {username} left the room.", room, client)
-                    remove_client(client)
-                    client.send("left_room".encode())  # Inform the client they left
-                    break
-                
-                # Add message to room history
-                with lock:
-                    if room in room_history:
-                        room_history[room].append(message)
-                        # Save history to file
-                        save_room_history(room, room_history[room])
-                
-                broadcast(message, room, client)
-            except socket.timeout:
-                # Timeout is normal, continue the loop
-                continue
-            except socket.error:
-                print(f"Socket error for {username}")
+            for kind, value in events:
+                if kind == "hello":
+                    # Admitting may open the room's log and read history from disk
+                    admitted, replies = await asyncio.get_running_loop().run_in_executor(
+                        None, admit_client, client, value)
+                    for i, reply in enumerate(replies):
+                        if i:
+                            await asyncio.sleep(0.1)  # Plain-text clients need each reply in its own recv
+                        client.send_reply(reply)
+                        await writer.drain()
+                    if not admitted:
+                        return
+                    client.mark_ready()
+                    announce_join(client, value.get("action"))
+                    continue
+                if kind in ("upload", "download"):
+                    await serve_transfer_async(client, reader, writer, kind, value)
+                    await writer.drain()
+                    return
+                if kind in ("load_older", "search"):
+                    # Disk reads and searches stay off the event loop
+                    reply = await asyncio.get_running_loop().run_in_executor(
+                        None, history_reply, client.room, kind, value)
+                    client.send(reply, droppable=False)
+                    continue
+                if kind in ("chat", "attach"):
+                    delay, scope = flood_delay(client)
+                    if delay and FLOOD_POLICY == "slow":
+                        count_stat("slowed", counters=flood_stats)
+                    while delay and FLOOD_POLICY == "slow":
+                        await asyncio.sleep(delay)  # Nothing is read meanwhile, so the sender backs up
+                        delay, scope = flood_delay(client)
+                    if delay:
+                        reject_flood(client, delay, scope)
+                        continue
+                    client.flood_notified = False
+                if not handle_event(client, kind, value):
+                    await writer.drain()
+                    return
+                if client.unsynced_acks:
+                    await send_synced_acks(client)
+            await writer.drain()
+
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                if not client.joined:
+                    log_event("Client disconnected before joining a room")
                 break
+            client.bytes_in += len(data)
+            events = client.feed(data)
 
+    except (ConnectionError, OSError) as e:
+        log_event(f"Socket error for {client.username}: {e}")
     except Exception as e:
         print(f"Error handling client: {e}")
     finally:
         remove_client(client)
-        try:
-            client.close()
-        except socket.error:
-            pass
+        client.close()
+        client.count_closed()
 
-def main():
-    """Main server function."""
-    parser = argparse.ArgumentParser(description="Start the server")
-    parser.add_argument('host', type=str, nargs='?', default=DEFAULT_HOST, help="The host address")
-    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help="The port number")
+async def serve_async(host, port):
+    """Accept and serve every connection on a single asyncio event loop."""
+    server = await asyncio.start_server(handle_client_async, host, port, reuse_address=True)
+    print(f"🚀 Server started on {host}:{port} (asyncio mode)")
+    print("Press Ctrl+C to stop the server")
+    async with server:
+        await server.serve_forever()
 
-    args = parser.parse_args()
+def serve_threaded(host, port):
+    """Accept connections and serve each one on its own daemon thread."""
+    server = create_server(host, port)
+    print(f"🚀 Server started on {host}:{port} (threaded mode)")
+    print("Press Ctrl+C to stop the server")
 
     try:
-        server = create_server(args.host, args.port)
-        print(f"🚀 Server started on {args.host}:{args.port}")
-        print("Press Ctrl+C to stop the server")
-
         while True:
             try:
                 client, address = server.accept()
-                print(f"✅ New connection from {address}")
+                log_event(f"✅ New connection from {address}")
                 threading.Thread(target=handle_client, args=(client,), daemon=True).start()
             except Exception as e:
                 print(f"Error accepting connection: {e}")
                 continue
-
-    except KeyboardInterrupt:
-        print("\nShutting down server...")
     finally:
         try:
             server.close()
         except socket.error:
             pass
 
+def collect_stats(mode):
+    """Snapshot every metric as a JSON-serialisable dict (called by the stats endpoint)."""
+    with lock:
+        connections = list(clients.items())
+    rooms = {}
+    bytes_in = bytes_out = send_calls = queued_total = queued_max = 0
+    for client, info in connections:
+        queued = client.queued_bytes()
+        bytes_in += client.bytes_in
+        bytes_out += client.bytes_out
+        send_calls += client.send_calls
+        queued_total += queued
+        queued_max = max(queued_max, queued)
+        room = rooms.setdefault(info["room"], {"members": 0, "queued_bytes": 0, "max_queued_bytes": 0})
+        room["members"] += 1
+        room["queued_bytes"] += queued
+        room["max_queued_bytes"] = max(room["max_queued_bytes"], queued)
+    for name, room in rooms.items():
+        meter = room_rates.get(name)
+        room["messages"] = meter.total if meter else 0
+        room["messages_per_s"] = meter.rate() if meter else 0
+
+    with stats_lock:
+        outbound = dict(outbound_stats)
+        flood = dict(flood_stats)
+        transfers = dict(transfer_stats)
+        bytes_in += traffic_totals["bytes_in"]
+        bytes_out += traffic_totals["bytes_out"]
+        send_calls += traffic_totals["send_calls"]
+    with memory_lock:
+        memory = dict(memory_gauges)
+    durability = history_store if HISTORY_BACKEND == "sqlite" else history_committer
+    outbound.update(queued_bytes=queued_total, max_queued_bytes=queued_max,
+                    send_calls=send_calls, coalesce_ms=COALESCE_DELAY * 1000)
+    cpu = os.times()
+    return {
+        "mode": mode,
+        "pid": os.getpid(),
+        "uptime_s": round(time.time() - started_at, 1),
+        "cpu_s": round(cpu.user + cpu.system, 3),
+        "connections": len(connections),
+        "rooms": rooms,
+        "outbound": outbound,
+        "flood": flood,
+        "attachments": transfers,
+        "traffic": {"bytes_in": bytes_in, "bytes_out": bytes_out},
+        "memory": memory,
+        "durability": durability.stats.snapshot() if durability else None,
+        "history_write_latency_us": history_write_latency.snapshot(),
+        "fan_out_latency_us": fan_out_latency.snapshot(),
+    }
+
+def start_stats_server(port, mode):
+    """Serve collect_stats() as JSON on http://127.0.0.1:<port>/ from a daemon thread."""
+
+    class StatsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(collect_stats(mode), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the server output
+
+    # Localhost only: the stats include room names
+    stats_server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StatsHandler)
+    threading.Thread(target=stats_server.serve_forever, daemon=True).start()
+    print(f"📊 Stats on http://127.0.0.1:{port}/")
+    return stats_server
+
+def first_frame_remaining(buffer):
+    """Bytes still missing from the first frame in buffer: the rest of its header, or of its payload."""
+    if len(buffer) < FRAME_HEADER.size:
+        return FRAME_HEADER.size - len(buffer)
+    return FRAME_HEADER.size + FRAME_HEADER.unpack_from(buffer)[3] - len(buffer)
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hash ring mapping room names to worker indexes.
+
+    Each worker owns HASH_RING_REPLICAS points on the ring, so changing the
+    worker count only moves the rooms next to the added or removed points.
+    """
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self.ring = sorted((ring_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.keys = [point for point, _ in self.ring]
+
+    def node_for(self, key):
+        i = bisect.bisect(self.keys, ring_hash(key)) % len(self.keys)
+        return self.ring[i][1]
+
+class HandoffReader:
+    """Split a worker's control stream back into (handoff, socket) pairs.
+
+    A handoff may arrive over several recvs, or several in one. Each client
+    socket comes in with the first bytes of its message, so sockets are
+    matched to messages in order.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.fds = deque()
+
+    def feed(self, data, fds):
+        """Add received bytes and sockets and return every handoff that is now complete."""
+        self.buffer += data
+        self.fds.extend(fds)
+        handoffs = []
+        while len(self.buffer) >= CONTROL_HEADER.size:
+            end = CONTROL_HEADER.size + CONTROL_HEADER.unpack_from(self.buffer)[0]
+            if len(self.buffer) < end:
+                break
+            message = bytes(self.buffer[CONTROL_HEADER.size:end])
+            del self.buffer[:end]
+            if not self.fds:
+                print("Handoff arrived without a socket, skipping it")
+                continue
+            sock = socket.socket(fileno=self.fds.popleft())
+            try:
+                handoffs.append((json.loads(message), sock))
+            except ValueError as e:
+                print(f"Dropping a malformed handoff: {e}")
+                sock.close()
+        return handoffs
+
+def run_worker(index, control, args):
+    """Worker process: serve the sockets the acceptor hands over for its rooms."""
+    configure(args)
+    print(f"🧩 Worker {index} started (pid {os.getpid()}, {args.mode} mode)")
+    if args.stats_port:
+        # Each worker owns different rooms, so each serves its own stats
+        start_stats_server(args.stats_port + 1 + index, args.mode)
+    try:
+        if args.mode == "asyncio":
+            asyncio.run(run_worker_async(control))
+        else:
+            reader = HandoffReader()
+            while True:
+                message, fds, _, _ = socket.recv_fds(control, RECV_SIZE, MAX_HANDOFF_FDS)
+                if not message:
+                    break
+                for handoff, sock in reader.feed(message, fds):
+                    try:
+                        threading.Thread(target=handle_client, args=(sock, handoff), daemon=True).start()
+                    except Exception as e:
+                        print(f"Error taking over a connection: {e}")
+                        sock.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_history()
+
+async def run_worker_async(control):
+    """Asyncio worker: take handed-over sockets from the control channel on the event loop."""
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    control.setblocking(False)
+    reader = HandoffReader()
+
+    async def serve_handoff(sock, handoff):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await handle_client_async(reader, writer, handoff)
+
+    def on_control():
+        try:
+            message, fds, _, _ = socket.recv_fds(control, RECV_SIZE, MAX_HANDOFF_FDS)
+        except BlockingIOError:
+            return
+        if not message:
+            loop.remove_reader(control.fileno())
+            stopped.set_result(None)
+            return
+        for handoff, sock in reader.feed(message, fds):
+            try:
+                loop.create_task(serve_handoff(sock, handoff))
+            except Exception as e:
+                print(f"Error taking over a connection: {e}")
+                sock.close()
+
+    loop.add_reader(control.fileno(), on_control)
+    await stopped
+
+def start_worker(index, args):
+    """Start worker `index` and return (process, acceptor end of its control channel)."""
+    parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Spawn rather than fork, so a worker doesn't inherit the acceptor's end of
+    # every control channel and notices when the acceptor goes away
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=run_worker, args=(index, child_end, args), daemon=True)
+    process.start()
+    child_end.close()
+    # A stalled worker can't hold up the acceptor for longer than this
+    parent_end.settimeout(HANDOFF_TIMEOUT)
+    return process, parent_end
+
+def serve_sharded(args):
+    """Front acceptor: read each handshake and pass the socket to the room's worker."""
+    ring = HashRing(range(args.workers))
+    workers = [start_worker(i, args) for i in range(args.workers)]
+    server = create_server(args.host, args.port)
+    server.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    probes = OrderedDict()  # {sock: deadline} for connections yet to send a hello, oldest first
+    print(f"🚀 Server started on {args.host}:{args.port} ({args.workers} {args.mode} workers)")
+    print("Press Ctrl+C to stop the server")
+
+    def hand_off(sock, probe, kind, hello):
+        # Attachments are shared by every worker, so transfers can go anywhere
+        key = str(hello.get("room", "")).strip() if kind == "hello" else str(sock.fileno())
+        index = ring.node_for(key)
+        process, control = workers[index]
+        if not process.is_alive():
+            print(f"Worker {index} died, restarting it")
+            control.close()
+            workers[index] = process, control = start_worker(index, args)
+        message = json.dumps({"framed": probe.framed, "event": kind, "hello": hello}).encode()
+        data = CONTROL_HEADER.pack(len(message)) + message
+        sock.setblocking(True)
+        sent = 0
+        try:
+            sent = socket.send_fds(control, [data], [sock.fileno()])
+            if sent < len(data):
+                control.sendall(data[sent:])  # The socket went along with the first part
+        except OSError:
+            if sent:
+                # Part of a message went out, so the channel is out of step for good
+                print(f"Worker {index} stalled in the middle of a handoff, restarting it")
+                process.kill()
+                process.join(1)
+            raise
+        finally:
+            sock.close()  # The worker has its own copy of the descriptor now
+
+    def stop_probing(sock):
+        selector.unregister(sock)
+        probes.pop(sock, None)
+
+    try:
+        while True:
+            for key, _ in selector.select(timeout=1):
+                if key.fileobj is server:
+                    try:
+                        sock, address = server.accept()
+                    except BlockingIOError:
+                        continue
+                    log_event(f"✅ New connection from {address}")
+                    sock.setblocking(False)
+                    # ClientConnection's parser works without a transport; use it to read the hello
+                    selector.register(sock, selectors.EVENT_READ, ClientConnection())
+                    probes[sock] = time.monotonic() + PROBE_TIMEOUT
+                    continue
+
+                sock, probe = key.fileobj, key.data
+                try:
+                    if probe.framed is None:
+                        # Peek, so a plain-text client's first message is still read in one recv
+                        head = sock.recv(1, socket.MSG_PEEK)
+                        probe.framed = head == FRAME_MAGIC[:1] if head else None
+                    # Never read past the first frame: whatever follows it
+                    # (chat frames, an upload's data) is for the worker
+                    size = RECV_SIZE
+                    if probe.framed:
+                        size = min(first_frame_remaining(probe.decoder.buffer), RECV_SIZE)
+                    data = sock.recv(size)
+                    events = probe.feed(data) if data else None
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except Exception as e:
+                    print(f"Error reading handshake: {e}")
+                    events = None
+                if events is None:
+                    stop_probing(sock)
+                    sock.close()
+                    continue
+                first = next(((kind, value) for kind, value in events
+                              if kind in ("hello", "upload", "download")), None)
+                if first is not None:
+                    stop_probing(sock)
+                    try:
+                        hand_off(sock, probe, *first)
+                    except Exception as e:
+                        print(f"Error handing off connection: {e}")
+                        sock.close()
+
+            # Connections that never finish their hello would otherwise stay open forever
+            now = time.monotonic()
+            while probes:
+                sock, deadline = next(iter(probes.items()))
+                if deadline > now:
+                    break
+                log_event(f"Dropping a connection that sent no hello in {PROBE_TIMEOUT}s")
+                stop_probing(sock)
+                sock.close()
+    finally:
+        server.close()
+        for process, control in workers:
+            control.close()
+            process.join(1)
+
+def configure(args):
+    """Apply command line settings to the module-level configuration."""
+    global OUTBOUND_DROP_BYTES, OUTBOUND_DISCONNECT_BYTES, OUTBOUND_MAX_DROPS
+    OUTBOUND_DROP_BYTES = args.drop_bytes
+    OUTBOUND_DISCONNECT_BYTES = args.disconnect_bytes
+    OUTBOUND_MAX_DROPS = args.max_drops
+    global ROOM_RING_SIZE, ROOM_MEMORY_BUDGET, ROOM_MAX_IDLE
+    ROOM_RING_SIZE = args.ring_size
+    ROOM_MEMORY_BUDGET = args.memory_budget
+    ROOM_MAX_IDLE = args.max_idle_rooms
+    global COALESCE_DELAY
+    COALESCE_DELAY = args.coalesce_ms / 1000
+    global HISTORY_BACKEND, FSYNC_POLICY, COMMIT_INTERVAL, COMMIT_BATCH
+    HISTORY_BACKEND = args.history_backend
+    FSYNC_POLICY = args.fsync
+    COMMIT_INTERVAL = args.commit_interval_ms / 1000
+    COMMIT_BATCH = args.commit_batch
+    global FLOOD_POLICY, CLIENT_RATE, CLIENT_BURST, ROOM_RATE, ROOM_BURST
+    FLOOD_POLICY = args.flood_policy
+    CLIENT_RATE, CLIENT_BURST = args.client_rate, args.client_burst
+    ROOM_RATE, ROOM_BURST = args.room_rate, args.room_burst
+    global MAX_ATTACHMENT_BYTES
+    MAX_ATTACHMENT_BYTES = args.max_attachment_bytes
+    global VERBOSE
+    VERBOSE = args.verbose
+
+def main():
+    """Main server function."""
+    parser = argparse.ArgumentParser(description="Start the server")
+    parser.add_argument('host', type=str, nargs='?', default=DEFAULT_HOST, help="The host address")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help="The port number")
+    parser.add_argument('-m', '--mode', choices=SERVER_MODES, default=DEFAULT_MODE,
+                        help="Connection handling: a thread per client, or one asyncio event loop")
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="Shard rooms across this many worker processes (0 = single process)")
+    parser.add_argument('--drop-bytes', type=int, default=DEFAULT_DROP_BYTES,
+                        help="Outbound bytes queued for a client before its new messages are dropped (0 = never)")
+    parser.add_argument('--disconnect-bytes', type=int, default=DEFAULT_DISCONNECT_BYTES,
+                        help="Outbound bytes queued for a client before it is disconnected as a slow consumer")
+    parser.add_argument('--max-drops', type=int, default=DEFAULT_MAX_DROPS,
+                        help="Messages dropped in a row for a client before it is disconnected")
+    parser.add_argument('--history-backend', choices=HISTORY_BACKENDS, default=DEFAULT_HISTORY_BACKEND,
+                        help="Keep history in per-room logs, or in one SQLite database that can be searched")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=DEFAULT_FSYNC_POLICY,
+                        help="fsync history never, once per group commit, or after every message")
+    parser.add_argument('--commit-interval-ms', type=float, default=DEFAULT_COMMIT_INTERVAL * 1000,
+                        help="Longest a history write waits to be group-committed")
+    parser.add_argument('--commit-batch', type=int, default=DEFAULT_COMMIT_BATCH,
+                        help="Messages that trigger a group commit before the interval is up")
+    parser.add_argument('--ring-size', type=int, default=DEFAULT_RING_SIZE,
+                        help="Newest messages kept in memory per room")
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET,
+                        help="Bytes of room history kept in memory before idle rooms are evicted")
+    parser.add_argument('--max-idle-rooms', type=int, default=DEFAULT_MAX_IDLE_ROOMS,
+                        help="Empty rooms kept in memory for a quick re-create before the oldest are evicted")
+    parser.add_argument('--client-rate', type=float, default=DEFAULT_CLIENT_RATE,
+                        help="Chat messages per second allowed per client (0 = unlimited)")
+    parser.add_argument('--client-burst', type=int, default=DEFAULT_CLIENT_BURST,
+                        help="Messages a client may send in a burst above its rate")
+    parser.add_argument('--room-rate', type=float, default=DEFAULT_ROOM_RATE,
+                        help="Chat messages per second allowed per room (0 = unlimited)")
+    parser.add_argument('--room-burst', type=int, default=DEFAULT_ROOM_BURST,
+                        help="Messages a room may take in a burst above its rate")
+    parser.add_argument('--flood-policy', choices=FLOOD_POLICIES, default=DEFAULT_FLOOD_POLICY,
+                        help="Over a rate limit, drop the message and tell the sender, or stop reading from them")
+    parser.add_argument('--max-attachment-bytes', type=int, default=DEFAULT_MAX_ATTACHMENT_BYTES,
+                        help="Largest attachment a client may upload")
+    parser.add_argument('--coalesce-ms', type=float, default=DEFAULT_COALESCE_MS,
+                        help="Hold outbound messages up to this long to send them in one batch (0 = off)")
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help="Serve live stats as JSON on this localhost port (workers use the next ports up)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Print every connection, join and leave")
+
+    args = parser.parse_args()
+    if args.workers and not hasattr(socket, "send_fds"):
+        parser.error("--workers needs socket.send_fds, which this platform doesn't have")
+    configure(args)
+    if args.stats_port and not args.workers:
+        start_stats_server(args.stats_port, args.mode)
+
+    try:
+        if args.workers:
+            serve_sharded(args)
+        elif args.mode == "asyncio":
+            asyncio.run(serve_async(args.host, args.port))
+        else:
+            serve_threaded(args.host, args.port)
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
+    finally:
+        close_history()
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Worker processes in the PyInstaller build
     main()
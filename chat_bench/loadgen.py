@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import ipaddress
+import json
+import math
+import os
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# Headless load generator for the chat servers. Opens many simulated clients
+# on localhost, speaks the real create/join/message protocol and reports
+# join latency, throughput and end-to-end delivery latency as JSON.
+#
+#   python loadgen.py --target v2 --spawn --clients 2000 --room-size 20 --rate 1
+#   python loadgen.py --target v1 --spawn --clients 200 --rate 5
+#
+# With --stats-port (v2 only) the server's own stats endpoint is read before
+# and after the measured phase to report its CPU time and send syscalls.
+#
+# The v2 server drops messages over its flood limits, by default 20 msg/s per
+# client and 500 msg/s per room. Keep --rate (and --rate times --room-size)
+# under them, or pass "--client-rate 0 --room-rate 0" in --server-args; the
+# report counts the "rate_limited" notices the server sent back.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    "v2": os.path.join(REPO_DIR, "chat2_0", "server", "server2_0.py"),
+    "v1": os.path.join(REPO_DIR, "chat", "server.py"),
+}
+DEFAULT_PORTS = {"v2": 5000, "v1": 1060}
+
+# Framed wire protocol (must match chat2_0/server/server2_0.py)
+FRAME_MAGIC = b"\x00C"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBI")
+FRAME_HELLO = 1
+FRAME_CHAT = 3
+FRAME_CONTROL = 4
+
+MARKER = "LG"  # Load messages look like "LG <client> <seq> <send time ns> <padding>"
+
+
+def encode_frame(frame_type, payload):
+    body = json.dumps(payload).encode()
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, len(body)) + body
+
+
+async def read_frame(reader):
+    """Read one (frame_type, payload) from a framed server."""
+    magic, version, frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError("Invalid frame from server")
+    return frame_type, json.loads(await reader.readexactly(length))
+
+
+def percentiles(samples):
+    """p50/p99/p999/max of samples in nanoseconds, reported in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[max(math.ceil(p * len(samples)) - 1, 0)] / 1e6, 3)
+
+    return {"count": len(samples), "p50": pick(0.50), "p99": pick(0.99),
+            "p999": pick(0.999), "max": round(samples[-1] / 1e6, 3)}
+
+
+class Stats:
+    """Counters and latency samples shared by every simulated client."""
+
+    def __init__(self):
+        self.join_latencies = []
+        self.delivery_latencies = []
+        self.join_failures = 0
+        self.errors = 0
+        self.sent = 0
+        self.delivered = 0
+        self.rate_limited = 0  # v2 notices; one per run of messages dropped by a flood limit
+        self.measuring = False
+        self.measure_from_ns = 0  # Messages sent before this are warmup traffic
+
+    def record_delivery(self, text):
+        if not text.startswith(MARKER + " "):
+            return  # Join/leave notices and other traffic
+        parts = text.split(" ", 4)
+        if len(parts) >= 4 and self.measuring and int(parts[3]) >= self.measure_from_ns:
+            self.delivered += 1
+            self.delivery_latencies.append(time.perf_counter_ns() - int(parts[3]))
+
+
+class SimClient:
+    """One simulated user: a connection, a receive loop and a send loop."""
+
+    def __init__(self, target, index, room, stats, message_size):
+        self.target = target
+        self.index = index
+        self.room = room
+        self.stats = stats
+        self.message_size = message_size
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.seq = 0
+        self.sent = 0
+
+    async def connect(self, host, port, action):
+        """Connect and finish the handshake. Returns True once the client is in its room."""
+        started = time.perf_counter_ns()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            if self.target == "v2":
+                self.writer.write(encode_frame(FRAME_HELLO, {
+                    "username": f"load{self.index}", "room": self.room, "action": action}))
+                while True:
+                    frame_type, payload = await read_frame(self.reader)
+                    if frame_type == FRAME_CONTROL:
+                        break
+                if payload.get("event") not in ("room_created", "room_joined"):
+                    raise ConnectionError(payload.get("event"))
+            else:
+                # The v1 server has no rooms or handshake; everyone shares one broadcast
+                self.writer.write(f"Server: load{self.index} has joined the chat.\n".encode("ascii"))
+                await self.writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self.stats.join_failures += 1
+            print(f"Client {self.index} failed to join {self.room}: {e}", file=sys.stderr)
+            return False
+        self.stats.join_latencies.append(time.perf_counter_ns() - started)
+        self.receiver = asyncio.create_task(self.receive())
+        return True
+
+    def make_message(self):
+        self.seq += 1
+        text = f"{MARKER} {self.index} {self.seq} {time.perf_counter_ns()} "
+        return text + "x" * max(self.message_size - len(text), 0)
+
+    async def send_loop(self, rate, until):
+        """Send messages at `rate` per second until the monotonic deadline."""
+        interval = 1.0 / rate
+        # Spread clients out so they don't all fire on the same tick
+        await asyncio.sleep(interval * (self.index % 97) / 97)
+        next_send = time.monotonic()
+        try:
+            while time.monotonic() < until:
+                message = self.make_message()
+                if self.target == "v2":
+                    self.writer.write(encode_frame(FRAME_CHAT, {"text": message}))
+                else:
+                    self.writer.write((message + "\n").encode("ascii"))
+                self.stats.sent += 1
+                self.sent += 1
+                await self.writer.drain()
+                next_send += interval
+                await asyncio.sleep(max(next_send - time.monotonic(), 0))
+        except OSError:
+            self.stats.errors += 1
+
+    async def receive(self):
+        try:
+            if self.target == "v2":
+                while True:
+                    frame_type, payload = await read_frame(self.reader)
+                    if frame_type == FRAME_CHAT:
+                        self.stats.record_delivery(payload.get("text", ""))
+                    elif frame_type == FRAME_CONTROL and payload.get("event") == "rate_limited":
+                        if self.stats.measuring:
+                            self.stats.rate_limited += 1
+            else:
+                # v1 relays raw bytes, so messages can arrive merged or split
+                buffer = b""
+                while True:
+                    data = await self.reader.read(65536)
+                    if not data:
+                        break
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        self.stats.record_delivery(line.decode("ascii", errors="replace"))
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+
+    async def close(self):
+        if self.receiver:
+            self.receiver.cancel()
+        if self.writer:
+            try:
+                if self.target == "v2":
+                    self.writer.write(encode_frame(FRAME_CONTROL, {"event": "exit"}))
+                self.writer.close()
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+
+def fetch_server_stats(host, port):
+    with urllib.request.urlopen(f"http://{host}:{port}/", timeout=5) as response:
+        return json.load(response)
+
+
+def server_usage(before, after, seconds, deliveries):
+    """CPU and send syscalls the server spent between two stats snapshots."""
+    cpu = after["cpu_s"] - before["cpu_s"]
+    calls = after["outbound"]["send_calls"] - before["outbound"]["send_calls"]
+    return {
+        "cpu_s": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / seconds, 1) if seconds else 0,
+        "cpu_us_per_delivery": round(cpu * 1e6 / deliveries, 2) if deliveries else 0,
+        "send_calls": calls,
+        "send_calls_per_s": round(calls / seconds, 1) if seconds else 0,
+        "deliveries_per_send_call": round(deliveries / calls, 2) if calls else 0,
+    }
+
+
+async def run_load(args):
+    stats = Stats()
+    run_id = f"{os.getpid()}-{int(time.time())}"
+    room_size = args.room_size if args.target == "v2" else args.clients
+    rooms = [[] for _ in range(math.ceil(args.clients / room_size))]
+    for i in range(args.clients):
+        room = f"load-{run_id}-{i // room_size}"
+        rooms[i // room_size].append(SimClient(args.target, i, room, stats, args.message_size))
+
+    # Join phase: each room's first client creates it, the rest join at once
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client, action):
+        async with connect_slots:
+            return await client.connect(args.host, args.port, action)
+
+    async def fill_room(members):
+        if not await connect(members[0], "create"):
+            return []
+        joined = await asyncio.gather(*(connect(client, "join") for client in members[1:]))
+        return [members[0]] + [client for client, ok in zip(members[1:], joined) if ok]
+
+    join_started = time.monotonic()
+    joined_rooms = await asyncio.gather(*(fill_room(m) for m in rooms))
+    connected = [client for members in joined_rooms for client in members]
+    join_seconds = time.monotonic() - join_started
+
+    # Message phase, after a short warmup that isn't measured
+    until = time.monotonic() + args.warmup + args.duration
+    senders = [asyncio.create_task(client.send_loop(args.rate, until)) for client in connected]
+    await asyncio.sleep(args.warmup)
+    if args.stats_port:
+        server_before = await asyncio.to_thread(fetch_server_stats, args.host, args.stats_port)
+    stats.measure_from_ns = time.perf_counter_ns()
+    stats.measuring = True
+    sent_before = stats.sent
+    client_sent_before = {client: client.sent for client in connected}
+    measure_started = time.monotonic()
+    await asyncio.gather(*senders)
+    measured_seconds = time.monotonic() - measure_started
+    await asyncio.sleep(args.drain)  # Let in-flight messages land
+    stats.measuring = False
+    sent = stats.sent - sent_before
+    if args.stats_port:
+        server_after = await asyncio.to_thread(fetch_server_stats, args.host, args.stats_port)
+
+    await asyncio.gather(*(client.close() for client in connected))
+
+    # Each message reaches everyone else who made it into the sender's room (v1 has one room)
+    expected_deliveries = sum((client.sent - client_sent_before[client]) * (len(members) - 1)
+                              for members in joined_rooms for client in members)
+    report = {
+        "target": args.target,
+        "server_args": args.server_args,
+        "clients": args.clients,
+        "connected": len(connected),
+        "join_failures": stats.join_failures,
+        "rooms": len(rooms),
+        "room_size": room_size,
+        "rate_per_client": args.rate,
+        "message_size": args.message_size,
+        "duration_s": round(measured_seconds, 3),
+        "join_phase_s": round(join_seconds, 3),
+        "join_latency_ms": percentiles(stats.join_latencies),
+        "sent": sent,
+        "delivered": stats.delivered,
+        "expected_deliveries": expected_deliveries,
+        "rate_limited": stats.rate_limited,
+        "throughput": {
+            "sent_per_s": round(sent / measured_seconds, 1) if measured_seconds else 0,
+            "delivered_per_s": round(stats.delivered / measured_seconds, 1) if measured_seconds else 0,
+        },
+        "delivery_latency_ms": percentiles(stats.delivery_latencies),
+        "errors": stats.errors,
+    }
+    if args.stats_port:
+        # The window runs through the drain, when the last deliveries go out
+        report["server"] = server_usage(server_before, server_after,
+                                        measured_seconds + args.drain, stats.delivered)
+    return report
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on {host}:{port}")
+
+
+def spawn_server(args, workdir):
+    """Start the target server in a scratch directory so its chat history is thrown away."""
+    command = [sys.executable, SERVERS[args.target], args.host, "-p", str(args.port)]
+    if args.stats_port:
+        command += ["--stats-port", str(args.stats_port)]
+    command += shlex.split(args.server_args)
+    process = subprocess.Popen(command, cwd=workdir, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def raise_fd_limit():
+    """Thousands of clients need thousands of sockets; lift the soft limit if we can."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat servers on localhost")
+    parser.add_argument('--target', choices=sorted(SERVERS), default="v2",
+                        help="v2 = chat2_0/server/server2_0.py, v1 = chat/server.py")
+    parser.add_argument('--host', default="127.0.0.1", help="Loopback address of the server")
+    parser.add_argument('-p', '--port', type=int, help="Server port (defaults to the target's port)")
+    parser.add_argument('--spawn', action='store_true', help="Start the server for the run and stop it after")
+    parser.add_argument('--server-args', default="", help="Extra arguments for a spawned server, e.g. \"-m asyncio\"")
+    parser.add_argument('-c', '--clients', type=int, default=100, help="Simulated clients")
+    parser.add_argument('--room-size', type=int, default=10, help="Clients per room (v2 only)")
+    parser.add_argument('--rate', type=float, default=1.0, help="Messages per second sent by each client")
+    parser.add_argument('--message-size', type=int, default=100, help="Bytes per message")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds of measured sending")
+    parser.add_argument('--warmup', type=float, default=1.0, help="Seconds of unmeasured sending first")
+    parser.add_argument('--drain', type=float, default=1.0, help="Seconds to wait for in-flight messages")
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="Handshakes in flight at once")
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help="Read server CPU and send syscalls from this v2 stats port (started with --spawn)")
+    parser.add_argument('-o', '--output', help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    if not ipaddress.ip_address(args.host).is_loopback:
+        parser.error("the load generator only runs against a loopback address")
+    if args.port is None:
+        args.port = DEFAULT_PORTS[args.target]
+    if args.stats_port and args.target != "v2":
+        parser.error("--stats-port needs the v2 server")
+    raise_fd_limit()
+
+    server = None
+    with tempfile.TemporaryDirectory(prefix="chat-loadgen-") as workdir:
+        try:
+            if args.spawn:
+                server = spawn_server(args, workdir)
+            report = asyncio.run(run_load(args))
+        finally:
+            if server:
+                server.terminate()
+                server.wait(5)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()